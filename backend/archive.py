@@ -0,0 +1,217 @@
+import gzip
+import json
+import os
+import time
+from collections import namedtuple
+from datetime import date, datetime, timezone
+from itertools import groupby
+from typing import Iterator, List, Optional, Tuple
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import Session
+
+from models import Score, ScoreArchiveChunk
+
+# Scores older than the hot months are moved out of the scores table into one
+# gzip NDJSON file per month. Inside a file every user's rows are a separate gzip
+# member, newest first, and score_archive_chunks records where each member starts,
+# so reading one player's history decompresses only their part of the month.
+
+SCORE_ARCHIVE_DIR = os.getenv("SCORE_ARCHIVE_DIR", os.path.join(os.path.dirname(__file__), "score_archive"))
+# Whole months kept in the scores table, counting the current one
+SCORE_HOT_MONTHS = int(os.getenv("SCORE_HOT_MONTHS", 3))
+
+ArchivedScore = namedtuple("ArchivedScore", "id score timestamp")
+
+
+def as_utc(timestamp: datetime) -> datetime:
+    # SQLite hands back naive timestamps; archived ones are stored in UTC
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+
+def history_key(row) -> Tuple[datetime, int]:
+    # The (timestamp, id) order of score history, which the paging cursors also use
+    return as_utc(row.timestamp), row.id
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def hot_cutoff(today: date, keep_months: int) -> date:
+    # First day of the oldest month that stays in the scores table
+    months = today.year * 12 + today.month - 1 - (max(keep_months, 1) - 1)
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def archive_month(db: Session, month: date, batch_size: int = 5000) -> int:
+    """Move one month of scores into a new archive file and return how many were moved.
+
+    The file is written and synced before anything changes in the database; the
+    chunk rows and the delete then commit together, so a failure leaves the
+    scores where they were.
+    """
+    start = datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+    end_month = next_month(month)
+    end = datetime(end_month.year, end_month.month, 1, tzinfo=timezone.utc)
+    in_month = (Score.timestamp >= start, Score.timestamp < end)
+    rows = (
+        db.query(Score.id, Score.user_id, Score.score, Score.timestamp)
+        .filter(*in_month)
+        .order_by(Score.user_id, Score.timestamp.desc(), Score.id.desc())
+        .yield_per(batch_size)
+    )
+
+    os.makedirs(SCORE_ARCHIVE_DIR, exist_ok=True)
+    # A month archived again (scores that arrived late) gets a file of its own
+    name = f"scores-{month:%Y-%m}-{time.time_ns()}.ndjson.gz"
+    path = os.path.join(SCORE_ARCHIVE_DIR, name)
+    chunks = []
+    max_id = 0
+    try:
+        with open(path + ".tmp", "wb") as f:
+            for user_id, user_rows in groupby(rows, key=lambda row: row.user_id):
+                lines = []
+                best_score = None
+                for row in user_rows:
+                    lines.append(json.dumps(
+                        {"id": row.id, "user_id": user_id, "score": row.score, "timestamp": as_utc(row.timestamp).isoformat()},
+                        separators=(",", ":"),
+                    ))
+                    max_id = max(max_id, row.id)
+                    best_score = row.score if best_score is None else max(best_score, row.score)
+                member = gzip.compress(("\n".join(lines) + "\n").encode())
+                chunks.append({
+                    "user_id": user_id,
+                    "month": month,
+                    "path": name,
+                    "byte_offset": f.tell(),
+                    "byte_length": len(member),
+                    "games": len(lines),
+                    "best_score": best_score,
+                })
+                f.write(member)
+            f.flush()
+            os.fsync(f.fileno())
+        if not chunks:
+            os.remove(path + ".tmp")
+            return 0
+        os.replace(path + ".tmp", path)
+
+        db.execute(insert(ScoreArchiveChunk), chunks)
+        # Bounded by id so a score written while the file was being built stays in the table
+        db.query(Score).filter(*in_month, Score.id <= max_id).delete(synchronize_session=False)
+        db.commit()
+    except Exception:
+        db.rollback()
+        for leftover in (path, path + ".tmp"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    return sum(chunk["games"] for chunk in chunks)
+
+
+def archive_cold_months(db: Session, keep_months: int = SCORE_HOT_MONTHS, batch_size: int = 5000, today: Optional[date] = None):
+    """Archive every month older than the hot ones, yielding (month, scores moved) as it goes.
+
+    user_stats and score_rollups are left alone: they already hold the aggregates
+    of the archived games.
+    """
+    cutoff = hot_cutoff(today or datetime.now(timezone.utc).date(), keep_months)
+    oldest = db.query(func.min(Score.timestamp)).scalar()
+    if oldest is None:
+        return
+    month = month_start(as_utc(oldest).date())
+    while month < cutoff:
+        yield month, archive_month(db, month, batch_size)
+        month = next_month(month)
+
+
+def chunks_statement(user_id: int, through_month: Optional[date] = None):
+    # Newest month first; a month archived more than once has several chunks
+    statement = select(
+        ScoreArchiveChunk.month,
+        ScoreArchiveChunk.path,
+        ScoreArchiveChunk.byte_offset,
+        ScoreArchiveChunk.byte_length,
+        ScoreArchiveChunk.games,
+    ).where(ScoreArchiveChunk.user_id == user_id)
+    if through_month is not None:
+        statement = statement.where(ScoreArchiveChunk.month <= through_month)
+    return statement.order_by(ScoreArchiveChunk.month.desc(), ScoreArchiveChunk.id.desc())
+
+
+def archived_months(db: Session, user_ids) -> set:
+    """The (user_id, first day of month) pairs with scores in the archive."""
+    return set(db.execute(
+        select(ScoreArchiveChunk.user_id, ScoreArchiveChunk.month)
+        .where(ScoreArchiveChunk.user_id.in_(list(user_ids)))
+        .distinct()
+    ).all())
+
+
+def read_chunk(chunk) -> List[ArchivedScore]:
+    with open(os.path.join(SCORE_ARCHIVE_DIR, chunk.path), "rb") as f:
+        f.seek(chunk.byte_offset)
+        data = gzip.decompress(f.read(chunk.byte_length))
+    rows = []
+    for line in data.splitlines():
+        item = json.loads(line)
+        rows.append(ArchivedScore(item["id"], item["score"], datetime.fromisoformat(item["timestamp"])))
+    return rows
+
+
+def read_month(month_chunks) -> List[ArchivedScore]:
+    rows = [row for chunk in month_chunks for row in read_chunk(chunk)]
+    rows.sort(key=history_key, reverse=True)
+    return rows
+
+
+def archived_scores_before(chunks, before: Optional[Tuple[datetime, int]], count: int) -> List[ArchivedScore]:
+    """Up to ``count`` archived scores older than the (timestamp, id) ``before``, newest first."""
+    if before is not None:
+        before = (as_utc(before[0]), before[1])
+    found = []
+    for _, month_chunks in groupby(chunks, key=lambda chunk: chunk.month):
+        if len(found) >= count:
+            break
+        found.extend(row for row in read_month(month_chunks) if before is None or history_key(row) < before)
+    return found[:count]
+
+
+def archived_scores_slice(chunks, offset: int, count: int) -> List[ArchivedScore]:
+    """``count`` archived scores after skipping the newest ``offset``; skipped months are never read."""
+    found = []
+    for _, month_chunks in groupby(chunks, key=lambda chunk: chunk.month):
+        if len(found) >= count:
+            break
+        month_chunks = list(month_chunks)
+        games = sum(chunk.games for chunk in month_chunks)
+        if offset >= games:
+            offset -= games
+            continue
+        found.extend(read_month(month_chunks)[offset:])
+        offset = 0
+    return found[:count]
+
+
+def iter_archived_scores(db: Session) -> Iterator[tuple]:
+    """Every archived (id, user_id, score, timestamp), oldest first per user, in user_id order."""
+    chunks = db.execute(
+        select(
+            ScoreArchiveChunk.user_id,
+            ScoreArchiveChunk.month,
+            ScoreArchiveChunk.path,
+            ScoreArchiveChunk.byte_offset,
+            ScoreArchiveChunk.byte_length,
+        ).order_by(ScoreArchiveChunk.user_id, ScoreArchiveChunk.month, ScoreArchiveChunk.id)
+    ).all()
+    for (user_id, _), month_chunks in groupby(chunks, key=lambda chunk: (chunk.user_id, chunk.month)):
+        for row in reversed(read_month(month_chunks)):
+            yield row.id, user_id, row.score, row.timestamp
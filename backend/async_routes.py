@@ -0,0 +1,184 @@
+from datetime import timedelta
+from typing import List
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from auth import CurrentPrincipal, create_access_token, get_current_principal_async
+from database import get_async_db
+from devices import send_login_to_device
+from events import publish_friend_request
+from friends import add_friendship_statement, get_friend_ids_async, get_pending_counts_async, invalidate_friends, remove_friendship_statement
+from leaderboard import leaderboard
+from passwords import login_throttle, password_hasher
+from scoring import SCORE_WRITE_BEHIND, apply_to_leaderboard, invalidate_score_views, make_entries, record_scores, score_buffer, split_known_users
+from models import FriendRequest, FriendRequestStatus, User
+from schemas import FriendRequestPayload, LeaderboardUser, ScoreData, UserValues
+from sounds import get_sound_profile_async
+from read_models import FastJSONResponse
+from services import PROFILE_SCORES_LIMIT, board_etag, build_user_profile_async, conditional_json, load_profile_user_async, to_leaderboard_user
+
+# Async versions of the hot endpoints, served from the asyncpg engine when DB_MODE=async.
+# They mirror the sync handlers in main.py, including cache and leaderboard side effects.
+router = APIRouter()
+
+
+@router.post("/login")
+async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    await login_throttle.check_login_async(request.client.host if request.client else None, form_data.username)
+
+    result = await db.execute(select(User.id, User.username, User.hashed_password).where(User.email == form_data.username))
+    user = result.first()
+    if not user:
+        raise HTTPException(status_code=400, detail="Invalid credentials")
+    # bcrypt runs in the password process pool, off the event loop
+    valid, new_hash = await password_hasher.verify_async(form_data.password, user.hashed_password)
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid credentials")
+    await login_throttle.login_succeeded_async(form_data.username)
+
+    if new_hash:
+        await db.execute(update(User).where(User.id == user.id).values(hashed_password=new_hash))
+        await db.commit()
+
+    token = create_access_token(
+        sub=user.username,
+        user_id=user.id,
+        expires_delta=timedelta(minutes=60),
+    )
+    send_login_to_device(user.id, user.username, (await get_sound_profile_async(db, user.id)).version)
+    return {"access_token": token, "token_type": "bearer"}
+
+
+@router.get("/me", response_model=UserValues)
+async def get_user_info(
+    scores_limit: int = PROFILE_SCORES_LIMIT,
+    scores_offset: int = 0,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: CurrentPrincipal = Depends(get_current_principal_async),
+):
+    user = await load_profile_user_async(db, current_user.id)
+    return FastJSONResponse(await build_user_profile_async(
+        db, user, include_private=True, scores_limit=scores_limit, scores_offset=scores_offset
+    ))
+
+
+@router.get("/leaderboard/top-scores", response_model=List[LeaderboardUser])
+async def get_top_scores(request: Request):
+    return conditional_json(request, board_etag(leaderboard, 10), lambda: [
+        to_leaderboard_user(entry, rank) for rank, entry in enumerate(leaderboard.top(10), start=1)
+    ])
+
+
+@router.get("/leaderboard/top-players", response_model=List[LeaderboardUser])
+async def get_top_players(request: Request):
+    return conditional_json(request, board_etag(leaderboard, 5), lambda: [
+        to_leaderboard_user(entry, rank) for rank, entry in enumerate(leaderboard.top(5), start=1)
+    ])
+
+
+@router.post("/submit-score")
+async def submit_score(data: ScoreData, db: AsyncSession = Depends(get_async_db)):
+    entries = make_entries([data])
+    entries, unknown = await db.run_sync(split_known_users, entries)
+    if unknown:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    if SCORE_WRITE_BEHIND:
+        score_buffer.add(entries)
+    else:
+        await db.run_sync(record_scores, entries)
+        await db.commit()
+        await db.run_sync(invalidate_score_views, entries)
+    apply_to_leaderboard(entries)
+    return {"status": "score recorded"}
+
+
+@router.post("/friend-request/")
+async def send_friend_request(
+    payload: FriendRequestPayload,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: CurrentPrincipal = Depends(get_current_principal_async),
+):
+    receiver_id = payload.receiver_id
+    if await db.get(User, receiver_id) is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    if receiver_id in await get_friend_ids_async(db, current_user.id):
+        raise HTTPException(status_code=400, detail="Already friends")
+
+    existing_request = await db.execute(
+        select(FriendRequest.id).where(
+            FriendRequest.requester_id == current_user.id,
+            FriendRequest.receiver_id == receiver_id,
+        )
+    )
+    if existing_request.first():
+        raise HTTPException(status_code=400, detail="Friend request already sent")
+
+    friend_request = FriendRequest(requester_id=current_user.id, receiver_id=receiver_id, status=FriendRequestStatus.pending)
+    db.add(friend_request)
+    await db.commit()
+    publish_friend_request(
+        "friend_request_received", friend_request.id, receiver_id, await get_pending_counts_async(db, receiver_id),
+        requester_id=current_user.id, requester_username=current_user.username,
+    )
+    return {"message": "Friend request sent successfully"}
+
+
+@router.post("/friend-requests/{request_id}/accept")
+async def accept_friend_request(
+    request_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: CurrentPrincipal = Depends(get_current_principal_async),
+):
+    friend_request = await db.get(FriendRequest, request_id)
+    if not friend_request:
+        raise HTTPException(status_code=404, detail="Friend request not found")
+    if friend_request.receiver_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Not authorized to accept this request")
+    if friend_request.status == FriendRequestStatus.accepted:
+        return {"message": "Friend request accepted"}
+
+    friend_request.status = FriendRequestStatus.accepted
+    requester_id = friend_request.requester_id
+    await db.execute(add_friendship_statement(db, requester_id, current_user.id))
+    await db.commit()
+    invalidate_friends([requester_id, current_user.id])
+    publish_friend_request(
+        "friend_request_accepted", request_id, requester_id,
+        await get_pending_counts_async(db, requester_id), friend_id=current_user.id,
+    )
+    publish_friend_request(
+        "friend_request_resolved", request_id, current_user.id, await get_pending_counts_async(db, current_user.id)
+    )
+    return {"message": "Friend request accepted"}
+
+
+@router.delete("/friend-request/{request_id}/deny/")
+async def deny_friend_request(
+    request_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: CurrentPrincipal = Depends(get_current_principal_async),
+):
+    friend_request = await db.get(FriendRequest, request_id)
+    if not friend_request or friend_request.receiver_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Friend request not found")
+
+    requester_id = friend_request.requester_id
+    was_accepted = friend_request.status == FriendRequestStatus.accepted
+    if was_accepted:
+        await db.execute(remove_friendship_statement(requester_id, current_user.id))
+    await db.delete(friend_request)
+    await db.commit()
+    if was_accepted:
+        invalidate_friends([requester_id, current_user.id])
+    publish_friend_request(
+        "friend_request_denied", request_id, requester_id, await get_pending_counts_async(db, requester_id)
+    )
+    publish_friend_request(
+        "friend_request_resolved", request_id, current_user.id, await get_pending_counts_async(db, current_user.id)
+    )
+    return {"message": "Friend request denied"}
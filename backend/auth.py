@@ -1,13 +1,22 @@
+import hashlib
 import logging
 import os
-from fastapi import HTTPException, Depends
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+from fastapi import HTTPException, Depends, Header
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from jose import jwt, JWTError
 from datetime import datetime, timedelta, timezone
 from models import User
-from passlib.hash import bcrypt
 
-from database import get_db
+from database import get_async_db, get_db
+from shared_state import PRINCIPALS_CHANNEL, shared_state
 
 logging.basicConfig(level=logging.INFO)
 
@@ -16,12 +25,16 @@ logging.basicConfig(level=logging.INFO)
 SECRET_KEY = os.getenv("SECRET_KEY", "jwt_secret_key12312123")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+# Static token for operator endpoints such as bulk exports; they are disabled while it is unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
 
 
 # Define OAuth2PasswordBearer outside the function
 from fastapi.security import OAuth2PasswordBearer
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
+# For endpoints that also serve anonymous callers; yields None instead of a 401
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login", auto_error=False)
 
 # Function to create a JWT token with JSON-serializable data
 def create_access_token(sub: str, user_id: int, expires_delta: timedelta = None):
@@ -38,33 +51,139 @@ def create_access_token(sub: str, user_id: int, expires_delta: timedelta = None)
     return jwt.encode(to_encode, SECRET_KEY, ALGORITHM)
 
 
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+PRINCIPAL_TTL_SECONDS = float(os.getenv("PRINCIPAL_TTL_SECONDS", 300))
+
+
+# Authenticated identity for endpoints that only need who is calling, not the full user row
+@dataclass(frozen=True)
+class CurrentPrincipal:
+    id: int
+    username: str
+
+
+class TTLCache:
+    """Small thread-safe LRU whose entries also expire at a per-entry deadline."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, expires_at: float):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+# Decoded payloads keyed by token hash, kept until the token expires
+token_cache = TTLCache(TOKEN_CACHE_SIZE)
+principal_cache = TTLCache(PRINCIPAL_CACHE_SIZE)
+
+
 # Function to validate a token
 def validate_token(token: str):
-    SECRET_KEY = os.getenv("SECRET_KEY", "jwt_secret_key12312123")  # Ensure correct secret key
-    ALGORITHM = os.getenv("ALGORITHM", "HS256")
-    
-    logging.info("Decoding with SECRET_KEY: %s", SECRET_KEY)
+    key = hashlib.sha256(token.encode()).hexdigest()
+    payload = token_cache.get(key)
+    if payload is not None:
+        return payload
 
     try:
-        decoded = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return decoded
-    except JWTError as e:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if not payload.get("user_id"):
         raise HTTPException(status_code=401, detail="Invalid token")
 
+    token_cache.put(key, payload, payload.get("exp", time.time()))
+    return payload
+
+
+def invalidate_principal(user_id: int):
+    # Call after changing anything a CurrentPrincipal carries, or deleting the user
+    principal_cache.pop(user_id)
+    shared_state.broadcast(PRINCIPALS_CHANNEL, user_id)
+
+
+shared_state.subscribe(PRINCIPALS_CHANNEL, principal_cache.pop)
+
+
+def cache_principal(user_id: int, username: str) -> CurrentPrincipal:
+    principal = CurrentPrincipal(id=user_id, username=username)
+    principal_cache.put(user_id, principal, time.time() + PRINCIPAL_TTL_SECONDS)
+    return principal
+
+
 # Function to get the current user from a JWT token
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    try:
-        # Decode the JWT token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        # Fetch the user from the database
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-
-        return user  # Return the user object
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    payload = validate_token(token)
+
+    # Fetch the user from the database; the picture column is deferred, so this stays a small row
+    user = db.get(User, payload["user_id"])
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+
+    return user  # Return the user object
+
+
+def get_current_principal(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> CurrentPrincipal:
+    payload = validate_token(token)
+    user_id = payload["user_id"]
+    principal = principal_cache.get(user_id)
+    if principal is not None:
+        # No database round trip; the session is never checked out
+        return principal
+
+    row = db.query(User.id, User.username).filter(User.id == user_id).first()
+    if not row:
+        raise HTTPException(status_code=401, detail="User not found")
+    return cache_principal(row.id, row.username)
+
+
+# Async variant of get_current_user for endpoints served from the asyncpg engine
+async def get_current_user_async(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    payload = validate_token(token)
+
+    user = await db.get(User, payload["user_id"])
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
+
+
+async def get_current_principal_async(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)) -> CurrentPrincipal:
+    payload = validate_token(token)
+    user_id = payload["user_id"]
+    principal = principal_cache.get(user_id)
+    if principal is not None:
+        return principal
+
+    row = (await db.execute(select(User.id, User.username).where(User.id == user_id))).first()
+    if not row:
+        raise HTTPException(status_code=401, detail="User not found")
+    return cache_principal(row.id, row.username)
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
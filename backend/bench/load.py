@@ -0,0 +1,211 @@
+"""Replay the production traffic mix against the API and report latency per endpoint.
+
+Two kinds of virtual clients run side by side for ``--duration`` seconds:
+
+* devices post a score every ``--score-interval`` seconds, like the Simon ESP32s;
+* web users log in once, then load random pages with ``--think-ms`` between them.
+
+Without ``--base-url`` the app is imported and driven in-process over ASGI. SQL
+statement counts are read from the Server-Timing header either way. Seed the
+database first with bench.seed and run from backend/ with the same DATABASE_URL:
+
+    DATABASE_URL=sqlite:///./bench.db python -m bench.load --duration 30 --web-users 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from collections import defaultdict
+
+import httpx
+
+# The db entry of the Server-Timing header added by InstrumentationMiddleware
+QUERY_COUNT = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+# (weight, name, method, path template); {user} is a random seeded user
+PAGES = [
+    (30, "GET /leaderboard/top-scores", "GET", "/leaderboard/top-scores"),
+    (30, "GET /leaderboard/top-players", "GET", "/leaderboard/top-players"),
+    (20, "GET /me", "GET", "/me"),
+    (10, "GET /friend-requests/", "GET", "/friend-requests/"),
+    (10, "GET /friend-requests/count", "GET", "/friend-requests/count"),
+    (10, "GET /friends/", "GET", "/friends/"),
+    (10, "GET /user/{id}", "GET", "/user/{user}"),
+    (5, "GET /leaderboards/weekly", "GET", "/leaderboards/weekly"),
+    (5, "GET /users/{id}/stats", "GET", "/users/{user}/stats"),
+    (5, "GET /users/search", "GET", "/users/search?q=user{prefix}"),
+]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile
+    index = max(0, -(-p * len(sorted_values) // 100) - 1)
+    return sorted_values[index]
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.queries = defaultdict(list)
+
+    def record(self, name, seconds, response):
+        if response is None or response.status_code >= 400:
+            self.errors[name] += 1
+            return
+        self.latencies[name].append(seconds)
+        match = QUERY_COUNT.search(response.headers.get("server-timing", ""))
+        if match:
+            self.queries[name].append(int(match.group(1)))
+
+    def summary(self, elapsed):
+        rows = []
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies[name])
+            queries = self.queries[name]
+            rows.append({
+                "endpoint": name,
+                "requests": len(latencies),
+                "errors": self.errors[name],
+                "throughput": len(latencies) / elapsed,
+                "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+                "p95_ms": percentile(latencies, 95) * 1000 if latencies else None,
+                "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+                "queries_per_request": sum(queries) / len(queries) if queries else None,
+            })
+        return rows
+
+
+def print_summary(rows, elapsed):
+    def fmt(value, spec):
+        return "-" if value is None else format(value, spec)
+
+    print(f"{'endpoint':34} {'reqs':>7} {'err':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+    for row in rows:
+        print(
+            f"{row['endpoint']:34} {row['requests']:>7} {row['errors']:>5} {row['throughput']:>8.1f} "
+            f"{fmt(row['p50_ms'], '8.2f')} {fmt(row['p95_ms'], '8.2f')} {fmt(row['p99_ms'], '8.2f')} "
+            f"{fmt(row['queries_per_request'], '8.1f')}"
+        )
+    total = sum(row["requests"] for row in rows)
+    print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+
+
+async def timed(client, results, name, method, url, **kwargs):
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError:
+        response = None
+    results.record(name, time.perf_counter() - start, response)
+    return response
+
+
+async def device(client, results, args, manifest, rng, deadline):
+    # Spread the first posts so devices don't fire in lockstep
+    await asyncio.sleep(rng.random() * args.score_interval)
+    while time.monotonic() < deadline:
+        user_id = manifest["first_user_id"] + rng.randrange(manifest["users"])
+        payload = {"user_id": user_id, "score": int(rng.expovariate(1 / 12)) + 1}
+        await timed(client, results, "POST /submit-score", "POST", "/submit-score", json=payload)
+        await asyncio.sleep(args.score_interval)
+
+
+async def web_user(client, results, args, manifest, rng, deadline):
+    weights = [page[0] for page in PAGES]
+    while time.monotonic() < deadline:
+        me = manifest["first_user_id"] + rng.randrange(manifest["users"])
+        response = await timed(
+            client, results, "POST /login", "POST", "/login",
+            data={"username": f"user{me}@bench.local", "password": manifest["password"]},
+        )
+        if response is None or response.status_code != 200:
+            await asyncio.sleep(1)
+            continue
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        # Stay logged in for a session of page loads, then log in as someone else
+        for _ in range(args.session_pages):
+            if time.monotonic() >= deadline:
+                return
+            _, name, method, path = rng.choices(PAGES, weights)[0]
+            user = manifest["first_user_id"] + rng.randrange(manifest["users"])
+            url = path.format(user=user, prefix=str(user)[:2])
+            await timed(client, results, name, method, url, headers=headers)
+            await asyncio.sleep(rng.expovariate(1000 / args.think_ms) if args.think_ms else 0)
+
+
+async def run(args):
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    rng = random.Random(args.seed)
+
+    lifespan = None
+    if args.base_url:
+        transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=args.web_users + args.devices))
+        base_url = args.base_url
+    else:
+        # The driver logs in far more often than a person would
+        os.environ.setdefault("LOGIN_ATTEMPTS_PER_IP", "1000000000")
+        os.environ.setdefault("LOGIN_ATTEMPTS_PER_ACCOUNT", "1000000000")
+        from main import app
+
+        transport = httpx.ASGITransport(app=app)
+        base_url = "http://bench"
+        lifespan = app.router.lifespan_context(app)
+
+    if lifespan is not None:
+        await lifespan.__aenter__()
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout) as client:
+            if args.warmup:
+                warmup = Results()
+                deadline = time.monotonic() + args.warmup
+                await asyncio.gather(*(
+                    web_user(client, warmup, args, manifest, random.Random(rng.random()), deadline)
+                    for _ in range(args.web_users)
+                ))
+
+            results = Results()
+            started = time.monotonic()
+            deadline = started + args.duration
+            await asyncio.gather(
+                *(device(client, results, args, manifest, random.Random(rng.random()), deadline) for _ in range(args.devices)),
+                *(web_user(client, results, args, manifest, random.Random(rng.random()), deadline) for _ in range(args.web_users)),
+            )
+            elapsed = time.monotonic() - started
+    finally:
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+
+    rows = results.summary(elapsed)
+    print_summary(rows, elapsed)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"elapsed": elapsed, "endpoints": rows}, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the SimonWebby API")
+    parser.add_argument("--base-url", help="Target a running server instead of the in-process app")
+    parser.add_argument("--manifest", default="bench_manifest.json")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=0, help="Seconds of unrecorded web traffic first")
+    parser.add_argument("--devices", type=int, default=10, help="Virtual ESP32s posting scores")
+    parser.add_argument("--score-interval", type=float, default=1.0, help="Seconds between a device's posts")
+    parser.add_argument("--web-users", type=int, default=10, help="Virtual browser sessions")
+    parser.add_argument("--session-pages", type=int, default=20, help="Page loads per login")
+    parser.add_argument("--think-ms", type=float, default=200, help="Mean pause between page loads")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Also write the results to this file")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""Seed a database with synthetic users, friendships, score histories and pictures.
+
+Run from backend/ against the database in DATABASE_URL, e.g.
+
+    DATABASE_URL=sqlite:///./bench.db python -m bench.seed --users 10000 --reset
+
+Every user gets the same password, written with the user count to the manifest
+that bench.load reads.
+"""
+import argparse
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import bindparam, func, insert
+
+from blobs import blob_store
+from database import Base, SessionLocal, engine
+from images import THUMBNAIL_SIZES
+from models import FriendRequest, FriendRequestStatus, Friendship, Score, User
+from passwords import BCRYPT_ROUNDS, _hash_password
+from services import thumbnail_variant
+from stats import rebuild_stats
+
+PASSWORD = "Benchmark1"
+INSERT_BATCH = 5000
+
+
+def insert_batches(db, table, rows):
+    rows = list(rows)
+    for start in range(0, len(rows), INSERT_BATCH):
+        db.execute(insert(table), rows[start:start + INSERT_BATCH])
+
+
+def make_pictures(count: int, size: int):
+    # Random bytes stand in for images: the serving path only moves bytes around
+    pictures = []
+    for _ in range(count):
+        picture_id = blob_store.put(os.urandom(size))
+        for thumb in THUMBNAIL_SIZES:
+            blob_store.put_variant(picture_id, thumbnail_variant(thumb), os.urandom(max(size * thumb // 1024, 256)))
+        pictures.append(picture_id)
+    return pictures
+
+
+def seed(args):
+    rng = random.Random(args.seed)
+    if args.reset:
+        Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    db = SessionLocal()
+    try:
+        first_id = (db.query(func.max(User.id)).scalar() or 0) + 1
+        user_ids = list(range(first_id, first_id + args.users))
+        hashed_password = _hash_password(PASSWORD, BCRYPT_ROUNDS)
+        pictures = make_pictures(args.distinct_pictures, args.picture_bytes) if args.picture_fraction > 0 else []
+
+        started = time.perf_counter()
+        insert_batches(db, User.__table__, (
+            {
+                "id": user_id,
+                "username": f"user{user_id}",
+                "email": f"user{user_id}@bench.local",
+                "hashed_password": hashed_password,
+                "best_score": 0,
+                "profile_picture_id": rng.choice(pictures) if pictures and rng.random() < args.picture_fraction else None,
+            }
+            for user_id in user_ids
+        ))
+        db.commit()
+        print(f"Inserted {len(user_ids)} users in {time.perf_counter() - started:.1f}s")
+
+        started = time.perf_counter()
+        pairs = set()
+        for user_id in user_ids:
+            # Each pair is drawn from one side, so this averages args.friends per user
+            for _ in range(rng.randint(0, args.friends)):
+                other = rng.choice(user_ids)
+                if other != user_id:
+                    pairs.add((min(user_id, other), max(user_id, other)))
+        pairs = sorted(pairs)
+        pending = [pair for pair in pairs if rng.random() < args.pending_fraction]
+        accepted = sorted(set(pairs) - set(pending))
+        insert_batches(db, Friendship.__table__, (
+            {"user_id": a, "friend_id": b} for x, y in accepted for a, b in ((x, y), (y, x))
+        ))
+        insert_batches(db, FriendRequest.__table__, (
+            {"requester_id": a, "receiver_id": b, "status": FriendRequestStatus.accepted} for a, b in accepted
+        ))
+        insert_batches(db, FriendRequest.__table__, (
+            {"requester_id": a, "receiver_id": b, "status": FriendRequestStatus.pending} for a, b in pending
+        ))
+        db.commit()
+        print(f"Inserted {len(accepted)} friendships and {len(pending)} pending requests in {time.perf_counter() - started:.1f}s")
+
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        best = {}
+        scores = []
+        total = 0
+        for user_id in user_ids:
+            for _ in range(rng.randint(0, args.scores * 2)):
+                score = int(rng.expovariate(1 / 12)) + 1
+                best[user_id] = max(best.get(user_id, 0), score)
+                scores.append({
+                    "user_id": user_id,
+                    "score": score,
+                    "timestamp": now - timedelta(seconds=rng.randint(0, args.days * 86400)),
+                })
+            if len(scores) >= INSERT_BATCH * 10:
+                insert_batches(db, Score.__table__, scores)
+                total += len(scores)
+                scores = []
+        insert_batches(db, Score.__table__, scores)
+        total += len(scores)
+        users = User.__table__
+        if best:
+            db.execute(
+                users.update().where(users.c.id == bindparam("seed_user_id")).values(best_score=bindparam("seed_best")),
+                [{"seed_user_id": user_id, "seed_best": score} for user_id, score in best.items()],
+            )
+        db.commit()
+        print(f"Inserted {total} scores in {time.perf_counter() - started:.1f}s")
+
+        started = time.perf_counter()
+        rebuild_stats(db)
+        print(f"Rebuilt stats in {time.perf_counter() - started:.1f}s")
+    finally:
+        db.close()
+
+    with open(args.manifest, "w") as f:
+        json.dump({"first_user_id": user_ids[0], "users": len(user_ids), "password": PASSWORD}, f)
+    print(f"Wrote {args.manifest}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed synthetic data for benchmarks")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--friends", type=int, default=10, help="Average friends per user")
+    parser.add_argument("--pending-fraction", type=float, default=0.1, help="Share of friend pairs left as pending requests")
+    parser.add_argument("--scores", type=int, default=50, help="Average scores per user")
+    parser.add_argument("--days", type=int, default=60, help="Spread score timestamps over this many days")
+    parser.add_argument("--picture-fraction", type=float, default=0.5, help="Share of users with a profile picture")
+    parser.add_argument("--picture-bytes", type=int, default=100 * 1024)
+    parser.add_argument("--distinct-pictures", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--reset", action="store_true", help="Drop and recreate all tables first")
+    parser.add_argument("--manifest", default="bench_manifest.json")
+    seed(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import hashlib
+import os
+import tempfile
+from typing import Optional
+
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "blobs"))
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobStore:
+    """Content-addressed files on local disk, keyed by the SHA-256 of their bytes."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path_for(self, blob_id: str) -> str:
+        # Shard by hash prefix so no single directory grows unbounded
+        return os.path.join(self.root, blob_id[:2], blob_id[2:4], blob_id)
+
+    def variant_path(self, blob_id: str, variant: str) -> str:
+        # Variants are derived from the blob, so they live next to it under the same hash
+        return f"{self.path_for(blob_id)}.{variant}"
+
+    def exists(self, blob_id: Optional[str]) -> bool:
+        return bool(blob_id) and os.path.exists(self.path_for(blob_id))
+
+    def _commit(self, tmp_path: str, blob_id: str) -> str:
+        target = self.path_for(blob_id)
+        if os.path.exists(target):
+            # Same content already stored
+            os.unlink(tmp_path)
+            return blob_id
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(tmp_path, target)
+        return blob_id
+
+    def _tempfile(self):
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".incoming-")
+        return os.fdopen(fd, "wb"), tmp_path
+
+    def put(self, data: bytes) -> str:
+        out, tmp_path = self._tempfile()
+        with out:
+            out.write(data)
+        return self._commit(tmp_path, hashlib.sha256(data).hexdigest())
+
+    def put_variant(self, blob_id: str, variant: str, data: bytes):
+        out, tmp_path = self._tempfile()
+        with out:
+            out.write(data)
+        os.makedirs(os.path.dirname(self.path_for(blob_id)), exist_ok=True)
+        os.replace(tmp_path, self.variant_path(blob_id, variant))
+
+
+blob_store = BlobStore(BLOB_DIR)
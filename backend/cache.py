@@ -0,0 +1,340 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+from starlette.datastructures import Headers
+
+from auth import validate_token
+from metrics import registry
+from shared_state import CACHE_CHANNEL, shared_state
+
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 32 * 1024 * 1024))
+# Bigger responses are served but never stored
+CACHE_MAX_ENTRY_BYTES = int(os.getenv("CACHE_MAX_ENTRY_BYTES", 1024 * 1024))
+
+LEADERBOARD_TAG = "leaderboard"
+
+cache_requests = registry.counter("response_cache_requests_total", "Cacheable requests by result")
+
+
+def user_tag(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def scores_tag(user_id: int) -> str:
+    return f"scores:{user_id}"
+
+
+def friends_tag(user_id: int) -> str:
+    return f"friends:{user_id}"
+
+
+@dataclass
+class CachedResponse:
+    status: int
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes
+    etag: str
+    stored_at: float
+    expires_at: float
+    tags: Tuple[str, ...] = ()
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers)
+
+
+class CacheBackend(ABC):
+    """Storage for cached responses.
+
+    The in-process MemoryCache is the default; a shared store for several workers
+    implements the same methods. ``snapshot`` returns an opaque token for a set of
+    tags that ``set`` compares, so a response computed while one of its tags was
+    invalidated is never stored.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[CachedResponse]:
+        ...
+
+    @abstractmethod
+    def snapshot(self, tags: Iterable[str]):
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: CachedResponse, snapshot) -> bool:
+        ...
+
+    @abstractmethod
+    def invalidate_tags(self, tags: Iterable[str]):
+        ...
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+
+class MemoryCache(CacheBackend):
+    """LRU with per-entry TTL, a total byte budget and a tag index for invalidation."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys_by_tag = defaultdict(set)
+        self._tag_generations = defaultdict(int)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def snapshot(self, tags: Iterable[str]):
+        with self._lock:
+            return tuple(self._tag_generations.get(tag, 0) for tag in tags)
+
+    def set(self, key: str, value: CachedResponse, snapshot) -> bool:
+        with self._lock:
+            if tuple(self._tag_generations.get(tag, 0) for tag in value.tags) != snapshot:
+                return False
+            self._drop(key)
+            self._entries[key] = value
+            self.bytes += value.size
+            for tag in value.tags:
+                self._keys_by_tag[tag].add(key)
+            while self.bytes > self.max_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+            return True
+
+    def invalidate_tags(self, tags: Iterable[str]):
+        with self._lock:
+            for tag in tags:
+                self._tag_generations[tag] += 1
+                for key in list(self._keys_by_tag.pop(tag, ())):
+                    self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            for tag in list(self._keys_by_tag):
+                self._tag_generations[tag] += 1
+            self._entries.clear()
+            self._keys_by_tag.clear()
+            self.bytes = 0
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry.size
+        for tag in entry.tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+
+response_cache = MemoryCache(CACHE_MAX_BYTES)
+
+registry.gauge("response_cache_bytes", "Bytes held by the response cache", lambda: response_cache.bytes)
+registry.gauge("response_cache_entries", "Responses held by the response cache", lambda: len(response_cache))
+
+
+def invalidate_tags(tags: Iterable[str]):
+    tags = list(tags)
+    response_cache.invalidate_tags(tags)
+    shared_state.broadcast(CACHE_CHANNEL, tags)
+
+
+shared_state.subscribe(CACHE_CHANNEL, response_cache.invalidate_tags)
+
+
+class CacheRule:
+    """Caches GET responses for paths matching ``pattern``.
+
+    ``tags`` are format strings over the path parameters plus ``viewer``, the id of
+    the authenticated user; rules marked ``per_user`` are keyed by that id and are
+    only cached for requests with a valid token.
+    """
+
+    def __init__(self, pattern: str, tags: Iterable[str], ttl: float, per_user: bool = False):
+        self.pattern = re.compile(pattern)
+        # Path template for metrics, e.g. /user/{user_id}
+        self.route = re.sub(r"\(\?P<(\w+)>[^)]*\)", r"{\1}", pattern)
+        self.tags = tuple(tags)
+        self.ttl = ttl
+        self.per_user = per_user
+        self.cache_control = "private, no-cache" if per_user else "public, no-cache"
+
+
+def _viewer_id(headers: Headers) -> Optional[int]:
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return validate_token(token)["user_id"]
+    except HTTPException:
+        return None
+
+
+def _not_modified(headers: Headers, entry: CachedResponse) -> bool:
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or entry.etag in [tag.strip() for tag in if_none_match.split(",")]
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(if_modified_since).timestamp() >= int(entry.stored_at)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class ResponseCacheMiddleware:
+    """Serves matching GETs from the response cache, with ETag/Last-Modified and 304s.
+
+    Concurrent misses for one key are coalesced: the first request computes the
+    response and the others wait for it instead of hitting the database too.
+    """
+
+    def __init__(self, app, rules: Iterable[CacheRule], backend: CacheBackend = response_cache):
+        self.app = app
+        self.rules = list(rules)
+        self.backend = backend
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def _match(self, path: str):
+        for rule in self.rules:
+            match = rule.pattern.fullmatch(path)
+            if match:
+                return rule, match.groupdict()
+        return None, None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        rule, params = self._match(scope["path"])
+        if rule is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        viewer = _viewer_id(headers)
+        if rule.per_user and viewer is None:
+            cache_requests.inc(result="bypass")
+            await self.app(scope, receive, send)
+            return
+
+        # Responses served from here never reach the router, so label them for the metrics
+        scope["cache_route"] = rule.route
+        key = f"{scope['path']}?{scope['query_string'].decode('latin-1')}|{viewer if rule.per_user else ''}"
+        entry = self.backend.get(key)
+        if entry is not None:
+            cache_requests.inc(result="hit")
+            await self._respond(send, headers, entry, b"HIT")
+            return
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            entry = await asyncio.shield(pending)
+            if entry is not None:
+                cache_requests.inc(result="coalesced")
+                await self._respond(send, headers, entry, b"HIT")
+            else:
+                await self.app(scope, receive, send)
+            return
+
+        cache_requests.inc(result="miss")
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        entry = None
+        try:
+            tags = tuple(tag.format(viewer=viewer, **params) for tag in rule.tags)
+            snapshot = self.backend.snapshot(tags)
+            messages = []
+
+            async def capture(message):
+                messages.append(message)
+
+            await self.app(scope, receive, capture)
+            entry = self._build_entry(rule, tags, messages)
+            if entry is not None:
+                self.backend.set(key, entry, snapshot)
+        finally:
+            del self._inflight[key]
+            future.set_result(entry)
+
+        if entry is not None:
+            await self._respond(send, headers, entry, b"MISS")
+        else:
+            for message in messages:
+                await send(message)
+
+    def _build_entry(self, rule: CacheRule, tags, messages) -> Optional[CachedResponse]:
+        start = messages[0]
+        if start["status"] != 200:
+            return None
+        body = b"".join(message.get("body", b"") for message in messages[1:])
+        if len(body) > CACHE_MAX_ENTRY_BYTES:
+            return None
+        response_headers = []
+        etag = None
+        cache_control = None
+        for name, value in start.get("headers", []):
+            lowered = name.lower()
+            if lowered == b"set-cookie":
+                return None
+            if lowered in (b"content-length", b"date"):
+                continue
+            if lowered == b"etag":
+                etag = value.decode("latin-1")
+            elif lowered == b"cache-control":
+                cache_control = value
+            response_headers.append((name, value))
+        if etag is None:
+            etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+            response_headers.append((b"etag", etag.encode("latin-1")))
+        if cache_control is None:
+            response_headers.append((b"cache-control", rule.cache_control.encode("latin-1")))
+        now = time.time()
+        response_headers.append((b"last-modified", formatdate(now, usegmt=True).encode("latin-1")))
+        return CachedResponse(
+            status=200,
+            headers=response_headers,
+            body=body,
+            etag=etag,
+            stored_at=now,
+            expires_at=now + rule.ttl,
+            tags=tags,
+        )
+
+    async def _respond(self, send, request_headers: Headers, entry: CachedResponse, result: bytes):
+        headers = entry.headers + [(b"x-cache", result)]
+        if _not_modified(request_headers, entry):
+            headers = [(k, v) for k, v in headers if k.lower() != b"content-type"]
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        headers.append((b"content-length", str(len(entry.body)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": entry.status, "headers": headers})
+        await send({"type": "http.response.body", "body": entry.body})
@@ -0,0 +1,185 @@
+import asyncio
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import httpx
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Base URL of the Simon device; point it at a local stand-in server for testing
+ESP32_URL = os.getenv("ESP32_URL", "http://172.20.10.13:8000")
+DEVICE_QUEUE_SIZE = int(os.getenv("DEVICE_QUEUE_SIZE", 100))
+DEVICE_TIMEOUT_SECONDS = float(os.getenv("DEVICE_TIMEOUT_SECONDS", 2))
+DEVICE_MAX_ATTEMPTS = int(os.getenv("DEVICE_MAX_ATTEMPTS", 3))
+DEVICE_BACKOFF_SECONDS = float(os.getenv("DEVICE_BACKOFF_SECONDS", 0.5))
+# Consecutive failures before the breaker opens, and how long it stays open
+DEVICE_BREAKER_THRESHOLD = int(os.getenv("DEVICE_BREAKER_THRESHOLD", 5))
+DEVICE_BREAKER_COOLDOWN_SECONDS = float(os.getenv("DEVICE_BREAKER_COOLDOWN_SECONDS", 30))
+
+device_messages = registry.counter("device_messages_total", "Device messages by kind and outcome")
+
+
+class CircuitBreaker:
+    """Stops calling a device after repeated failures, then lets one probe through after a cooldown."""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.is_open or self._probing:
+                return False
+            # Half-open: this caller is the probe, everyone else waits for its outcome
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.failures >= self.threshold:
+                # A failed probe reopens the breaker for another cooldown
+                self.opened_at = time.monotonic()
+
+
+class DeviceDispatcher:
+    """Background delivery of messages to one device.
+
+    Requests only enqueue, so their latency never depends on the device. Messages
+    sharing a coalesce key replace each other while queued, so only the latest
+    volume or login is sent.
+    """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.breaker = CircuitBreaker(DEVICE_BREAKER_THRESHOLD, DEVICE_BREAKER_COOLDOWN_SECONDS)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._ids = itertools.count()
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=DEVICE_QUEUE_SIZE)
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=DEVICE_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+        )
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        if self._client is not None:
+            await self._client.aclose()
+        self._loop = None
+
+    def submit(self, kind: str, path: str, payload: dict, coalesce: bool = True):
+        """Queue a message for the device. Safe to call from any thread."""
+        if self._loop is None:
+            device_messages.inc(kind=kind, outcome="not_started")
+            return
+        key = kind if coalesce else f"{kind}:{next(self._ids)}"
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._enqueue(key, kind, path, payload)
+        else:
+            self._loop.call_soon_threadsafe(self._enqueue, key, kind, path, payload)
+
+    def _enqueue(self, key: str, kind: str, path: str, payload: dict):
+        if key in self._pending:
+            # Latest wins; the queued key already guarantees delivery
+            self._pending[key] = (kind, path, payload)
+            device_messages.inc(kind=kind, outcome="coalesced")
+            return
+        try:
+            self._queue.put_nowait(key)
+        except asyncio.QueueFull:
+            device_messages.inc(kind=kind, outcome="dropped")
+            return
+        self._pending[key] = (kind, path, payload)
+
+    async def _run(self):
+        while True:
+            key = await self._queue.get()
+            kind, path, payload = self._pending.pop(key)
+            try:
+                await self._deliver(kind, path, payload)
+            except Exception:
+                logger.exception("Unexpected error delivering %s to device", kind)
+
+    async def _deliver(self, kind: str, path: str, payload: dict):
+        for attempt in range(DEVICE_MAX_ATTEMPTS):
+            if not self.breaker.allow():
+                device_messages.inc(kind=kind, outcome="circuit_open")
+                return
+            try:
+                response = await self._client.post(path, json=payload)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                self.breaker.record_failure()
+                logger.warning("Failed to send %s to device (attempt %d): %s", kind, attempt + 1, e)
+                if attempt < DEVICE_MAX_ATTEMPTS - 1:
+                    await asyncio.sleep(DEVICE_BACKOFF_SECONDS * (2 ** attempt))
+                continue
+            except BaseException:
+                # Unexpected errors and cancellation must not leave a probe marked as running
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+            device_messages.inc(kind=kind, outcome="sent")
+            return
+        device_messages.inc(kind=kind, outcome="failed")
+
+
+device_dispatcher = DeviceDispatcher(ESP32_URL)
+
+
+def send_login_to_device(user_id: int, username: str, settings_version: str):
+    # Tell the Simon device who is playing; it only fetches the sound settings if it lacks this version
+    device_dispatcher.submit("login", "/esp-login", {
+        "user_id": user_id,
+        "username": username,
+        "sound_settings_version": settings_version,
+    })
+
+
+def send_settings_version_to_device(user_id: int, settings_version: str):
+    device_dispatcher.submit("sound_settings", "/sound-settings", {"user_id": user_id, "v": settings_version})
+
+
+def send_volume_to_device(volume: int):
+    device_dispatcher.submit("volume", "/set-volume", {"volume": volume})
@@ -0,0 +1,121 @@
+import bisect
+import threading
+from array import array
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from models import User
+
+# Budget of posting entries scanned per fuzzy lookup. Rare trigrams are read
+# first; common ones say little about a match and would dominate the latency.
+MAX_POSTINGS_SCANNED = 30000
+FUZZY_CANDIDATES = 200
+MIN_SIMILARITY = 0.3
+
+
+def normalize(username: str) -> str:
+    return username.strip().lower()
+
+
+def trigrams(text: str) -> set:
+    # Padded like pg_trgm so short names and word starts still produce trigrams
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class UserDirectory:
+    """In-memory username index for typeahead search.
+
+    A sorted list of lowercased names answers prefix queries with two bisects;
+    a trigram index finds near matches when the prefix runs dry. Loaded once at
+    startup and kept current by ``add``.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._names: List[Tuple[str, int]] = []
+        self._usernames: Dict[int, str] = {}
+        self._postings = defaultdict(lambda: array("i"))
+
+    def __len__(self):
+        return len(self._usernames)
+
+    def load(self, db: Session, batch_size: int = 10000):
+        rows = db.query(User.id, User.username).yield_per(batch_size)
+        names = []
+        usernames = {}
+        postings = defaultdict(lambda: array("i"))
+        for user_id, username in rows:
+            key = normalize(username)
+            names.append((key, user_id))
+            usernames[user_id] = username
+            for gram in trigrams(key):
+                postings[gram].append(user_id)
+        names.sort()
+        with self._lock:
+            self._names, self._usernames, self._postings = names, usernames, postings
+
+    def add(self, user_id: int, username: str):
+        key = normalize(username)
+        with self._lock:
+            if user_id in self._usernames:
+                return
+            bisect.insort(self._names, (key, user_id))
+            self._usernames[user_id] = username
+            for gram in trigrams(key):
+                self._postings[gram].append(user_id)
+
+    def username(self, user_id: int) -> Optional[str]:
+        return self._usernames.get(user_id)
+
+    def _prefix_range(self, prefix: str) -> Tuple[int, int]:
+        lo = bisect.bisect_left(self._names, (prefix,))
+        hi = bisect.bisect_left(self._names, (prefix + "\uffff",))
+        return lo, hi
+
+    def _fuzzy(self, query: str, exclude_prefix: str) -> List[int]:
+        query_grams = trigrams(query)
+        postings = sorted((self._postings[gram] for gram in query_grams if gram in self._postings), key=len)
+        counts = Counter()
+        budget = MAX_POSTINGS_SCANNED
+        for posting in postings:
+            if len(posting) > budget:
+                break
+            counts.update(posting)
+            budget -= len(posting)
+        best = counts.most_common(FUZZY_CANDIDATES)
+
+        scored = []
+        for user_id, shared in best:
+            key = normalize(self._usernames[user_id])
+            if key.startswith(exclude_prefix):
+                continue
+            similarity = shared / (len(query_grams) + len(trigrams(key)) - shared)
+            if similarity >= MIN_SIMILARITY:
+                scored.append((-similarity, key, user_id))
+        scored.sort()
+        return [user_id for _, _, user_id in scored]
+
+    def search(self, query: str, limit: int, offset: int = 0) -> Tuple[List[int], bool]:
+        """Ranked user ids for ``query``: exact name, then prefix matches, then fuzzy ones.
+
+        Returns one page of ids and whether more results follow it.
+        """
+        query = normalize(query)
+        if not query:
+            return [], False
+        with self._lock:
+            lo, hi = self._prefix_range(query)
+            prefix_count = hi - lo
+            # Exact matches sort first within the prefix range already
+            ids = [user_id for _, user_id in self._names[lo + offset:min(hi, lo + offset + limit + 1)]]
+            if len(ids) <= limit and len(query) >= 3:
+                fuzzy = self._fuzzy(query, query)
+                start = max(0, offset - prefix_count)
+                ids += fuzzy[start:start + limit + 1 - len(ids)]
+        return ids[:limit], len(ids) > limit
+
+
+user_directory = UserDirectory()
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from metrics import registry
+from shared_state import EVENTS_CHANNEL, shared_state
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Topic for events every connected client receives
+LEADERBOARD_TOPIC = "leaderboard"
+
+events_published = registry.counter("events_published_total", "Events published by type")
+events_dropped = registry.counter("events_dropped_total", "Events dropped because a subscriber fell behind")
+
+
+def user_topic(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+class Subscription:
+    def __init__(self, topics: Iterable[str]):
+        self.topics = tuple(topics)
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+
+class EventHub:
+    """In-process pub/sub for pushing events to connected clients.
+
+    Subscribers live on the event loop; publish() can be called from any thread,
+    including the threadpool that runs sync endpoints.
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers = defaultdict(set)
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def subscribe(self, topics: Iterable[str]) -> Subscription:
+        subscription = Subscription(topics)
+        for topic in subscription.topics:
+            self._subscribers[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        for topic in subscription.topics:
+            subscribers = self._subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[topic]
+
+    def publish(self, topic: str, event: dict):
+        events_published.inc(type=event.get("type", "unknown"))
+        self.publish_local(topic, event)
+        # Subscribers connected to other workers get it from there
+        shared_state.broadcast(EVENTS_CHANNEL, {"topic": topic, "event": event})
+
+    def publish_local(self, topic: str, event: dict):
+        if self._loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._deliver(topic, event)
+        else:
+            self._loop.call_soon_threadsafe(self._deliver, topic, event)
+
+    def _deliver(self, topic: str, event: dict):
+        for subscription in list(self._subscribers.get(topic, ())):
+            if subscription.queue.full():
+                # A slow client loses its oldest event rather than blocking everyone else
+                subscription.queue.get_nowait()
+                events_dropped.inc()
+            subscription.queue.put_nowait(event)
+
+
+event_hub = EventHub()
+
+shared_state.subscribe(EVENTS_CHANNEL, lambda message: event_hub.publish_local(message["topic"], message["event"]))
+
+
+def publish_to_user(user_id: int, event: dict):
+    event_hub.publish(user_topic(user_id), event)
+
+
+def publish_leaderboard_changes(changed_boards, versions: dict):
+    if changed_boards:
+        event_hub.publish(LEADERBOARD_TOPIC, {
+            "type": "leaderboard",
+            "boards": sorted(changed_boards),
+            "versions": versions,
+        })
+
+
+def publish_friend_request(event_type: str, request_id: int, to_user_id: int, counts: dict, **extra):
+    """Tell a user a friend request involving them changed, with their fresh pending counts."""
+    publish_to_user(to_user_id, {"type": event_type, "request_id": request_id, "pending": counts, **extra})
+
+
+def publish_scores(ranks_before: dict, rank_of, entries):
+    # One event per user in the batch with their latest score and all-time rank movement
+    latest = {}
+    for user_id, score, timestamp in entries:
+        latest[user_id] = (score, timestamp)
+    for user_id, (score, timestamp) in latest.items():
+        publish_to_user(user_id, {
+            "type": "score",
+            "score": score,
+            "timestamp": timestamp.isoformat(),
+            "rank": rank_of(user_id),
+            "previous_rank": ranks_before.get(user_id),
+        })
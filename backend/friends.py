@@ -0,0 +1,232 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import FrozenSet, Iterable
+
+from sqlalchemy import case, delete, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from cache import friends_tag, invalidate_tags
+from database import dialect_insert
+from models import FriendRequest, FriendRequestStatus, Friendship
+from shared_state import FRIENDS_CHANNEL, shared_state
+
+FRIEND_CACHE_SIZE = int(os.getenv("FRIEND_CACHE_SIZE", 10000))
+
+
+class FriendCache:
+    """LRU of friend-id sets per user; entries are dropped whenever a friendship changes."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Bumped on every invalidation so a load that raced a mutation is not cached
+        self.generation = 0
+
+    def get(self, user_id: int):
+        with self._lock:
+            friend_ids = self._entries.get(user_id)
+            if friend_ids is not None:
+                self._entries.move_to_end(user_id)
+            return friend_ids
+
+    def put(self, user_id: int, friend_ids: FrozenSet[int], generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[user_id] = friend_ids
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *user_ids: int):
+        with self._lock:
+            self.generation += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+friend_cache = FriendCache(FRIEND_CACHE_SIZE)
+
+
+def get_friend_ids(db: Session, user_id: int) -> FrozenSet[int]:
+    friend_ids = friend_cache.get(user_id)
+    if friend_ids is None:
+        generation = friend_cache.generation
+        rows = db.query(Friendship.friend_id).filter(Friendship.user_id == user_id).all()
+        friend_ids = frozenset(row[0] for row in rows)
+        friend_cache.put(user_id, friend_ids, generation)
+    return friend_ids
+
+
+async def get_friend_ids_async(db: AsyncSession, user_id: int) -> FrozenSet[int]:
+    friend_ids = friend_cache.get(user_id)
+    if friend_ids is None:
+        generation = friend_cache.generation
+        result = await db.execute(select(Friendship.friend_id).where(Friendship.user_id == user_id))
+        friend_ids = frozenset(result.scalars().all())
+        friend_cache.put(user_id, friend_ids, generation)
+    return friend_ids
+
+
+def is_friend(db: Session, user_id: int, other_id: int) -> bool:
+    return other_id in get_friend_ids(db, user_id)
+
+
+def get_mutual_friend_ids(db: Session, user_id: int, other_id: int) -> FrozenSet[int]:
+    return get_friend_ids(db, user_id) & get_friend_ids(db, other_id)
+
+
+# The helpers below only stage changes; call invalidate_friends after the commit
+# so a concurrent reader can't re-cache the pre-commit state.
+
+def add_friendship_statement(db, user_id: int, friend_id: int):
+    # Requests pending in both directions can both be accepted; the second one finds the rows already there
+    return (
+        dialect_insert(db, Friendship)
+        .values([{"user_id": user_id, "friend_id": friend_id}, {"user_id": friend_id, "friend_id": user_id}])
+        .on_conflict_do_nothing(index_elements=["user_id", "friend_id"])
+    )
+
+
+def add_friendship(db: Session, user_id: int, friend_id: int):
+    db.execute(add_friendship_statement(db, user_id, friend_id))
+
+
+def remove_friendship_statement(user_id: int, friend_id: int):
+    return delete(Friendship).where(
+        ((Friendship.user_id == user_id) & (Friendship.friend_id == friend_id)) |
+        ((Friendship.user_id == friend_id) & (Friendship.friend_id == user_id))
+    )
+
+
+def remove_friendship(db: Session, user_id: int, friend_id: int):
+    db.execute(remove_friendship_statement(user_id, friend_id))
+
+
+def invalidate_friends(user_ids: Iterable[int]):
+    user_ids = list(user_ids)
+    friend_cache.invalidate(*user_ids)
+    shared_state.broadcast(FRIENDS_CHANNEL, user_ids)
+    invalidate_tags(friends_tag(user_id) for user_id in user_ids)
+
+
+shared_state.subscribe(FRIENDS_CHANNEL, lambda user_ids: friend_cache.invalidate(*user_ids))
+
+
+def pending_counts_statement(user_id: int):
+    # Received and sent pending requests in one pass over the user's requests
+    return select(
+        func.count(case((FriendRequest.receiver_id == user_id, 1))),
+        func.count(case((FriendRequest.requester_id == user_id, 1))),
+    ).where(
+        (FriendRequest.receiver_id == user_id) | (FriendRequest.requester_id == user_id),
+        FriendRequest.status == FriendRequestStatus.pending,
+    )
+
+
+def get_pending_counts(db: Session, user_id: int) -> dict:
+    received, sent = db.execute(pending_counts_statement(user_id)).one()
+    return {"received": received, "sent": sent}
+
+
+def get_pending_counts_many(db: Session, user_ids: Iterable[int]) -> dict:
+    user_ids = list(user_ids)
+    counts = {user_id: {"received": 0, "sent": 0} for user_id in user_ids}
+    for key, column in (("received", FriendRequest.receiver_id), ("sent", FriendRequest.requester_id)):
+        rows = db.execute(
+            select(column, func.count())
+            .where(column.in_(user_ids), FriendRequest.status == FriendRequestStatus.pending)
+            .group_by(column)
+        ).all()
+        for user_id, count in rows:
+            counts[user_id][key] = count
+    return counts
+
+
+async def get_pending_counts_async(db: AsyncSession, user_id: int) -> dict:
+    received, sent = (await db.execute(pending_counts_statement(user_id))).one()
+    return {"received": received, "sent": sent}
+
+
+def get_friendship_statuses(db: Session, viewer_id: int, user_ids: Iterable[int]) -> dict:
+    """Relationship of the viewer to each user: self, friend, pending_sent, pending_received or none.
+
+    Friends come from the cache; pending requests in either direction are one query.
+    """
+    user_ids = list(user_ids)
+    friend_ids = get_friend_ids(db, viewer_id)
+    statuses = {user_id: "friend" if user_id in friend_ids else "none" for user_id in user_ids}
+    if viewer_id in statuses:
+        statuses[viewer_id] = "self"
+    others = [user_id for user_id, status in statuses.items() if status == "none"]
+    if others:
+        rows = db.execute(
+            select(FriendRequest.requester_id, FriendRequest.receiver_id).where(
+                FriendRequest.status == FriendRequestStatus.pending,
+                ((FriendRequest.requester_id == viewer_id) & FriendRequest.receiver_id.in_(others)) |
+                ((FriendRequest.receiver_id == viewer_id) & FriendRequest.requester_id.in_(others)),
+            )
+        ).all()
+        for requester_id, receiver_id in rows:
+            if requester_id == viewer_id:
+                statuses[receiver_id] = "pending_sent"
+            else:
+                statuses[requester_id] = "pending_received"
+    return statuses
+
+
+MAX_BULK_REQUESTS = 100
+
+
+def bulk_resolve_requests(db: Session, user_id: int, action: str, request_ids: Iterable[int]):
+    """Accept, deny or cancel many friend requests in the caller's transaction.
+
+    Accept and deny apply to requests the user received, cancel to pending ones
+    they sent. Returns the affected rows as (id, requester_id, receiver_id,
+    was_accepted) and the ids that were skipped; call invalidate_friends after
+    the commit.
+    """
+    request_ids = set(request_ids)
+    if not request_ids:
+        return [], []
+    own_column = FriendRequest.requester_id if action == "cancel" else FriendRequest.receiver_id
+    statement = select(
+        FriendRequest.id, FriendRequest.requester_id, FriendRequest.receiver_id, FriendRequest.status
+    ).where(FriendRequest.id.in_(request_ids), own_column == user_id)
+    if action != "deny":
+        statement = statement.where(FriendRequest.status == FriendRequestStatus.pending)
+    rows = [
+        (request_id, requester_id, receiver_id, status == FriendRequestStatus.accepted)
+        for request_id, requester_id, receiver_id, status in db.execute(statement.with_for_update()).all()
+    ]
+    ids = [row[0] for row in rows]
+
+    if ids and action == "accept":
+        db.execute(
+            update(FriendRequest)
+            .where(FriendRequest.id.in_(ids))
+            .values(status=FriendRequestStatus.accepted)
+            .execution_options(synchronize_session=False)
+        )
+        pairs = [pair for _, requester_id, receiver_id, _ in rows for pair in ((requester_id, receiver_id), (receiver_id, requester_id))]
+        db.execute(
+            dialect_insert(db, Friendship)
+            .values([{"user_id": a, "friend_id": b} for a, b in pairs])
+            .on_conflict_do_nothing(index_elements=["user_id", "friend_id"])
+        )
+    elif ids:
+        # Denying a request that was already accepted also ends the friendship, as the single deny does
+        for _, requester_id, receiver_id, was_accepted in rows:
+            if was_accepted:
+                remove_friendship(db, requester_id, receiver_id)
+        db.execute(delete(FriendRequest).where(FriendRequest.id.in_(ids)).execution_options(synchronize_session=False))
+
+    return rows, sorted(request_ids - set(ids))
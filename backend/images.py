@@ -0,0 +1,146 @@
+import io
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+from blobs import CHUNK_SIZE
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+IMAGE_TIMEOUT_SECONDS = float(os.getenv("IMAGE_TIMEOUT_SECONDS", 30))
+# Room for the multipart boundary and part headers around the file itself
+MULTIPART_OVERHEAD_BYTES = 16 * 1024
+
+# Longest edge of the stored full-size picture
+MAX_DIMENSION = 1024
+# Square variants served to leaderboards, friend lists and profile headers
+THUMBNAIL_SIZES = (64, 256)
+THUMBNAIL_FORMAT = "webp"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def too_large() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Profile picture must be smaller than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB",
+    )
+
+
+class UploadLimitMiddleware:
+    """Turns away oversized upload bodies before the multipart parser has read them.
+
+    Starlette spools the whole form to disk before the endpoint runs, so the cap in
+    spool_upload alone would only apply once the upload was already received. A
+    declared Content-Length over the cap is refused outright; a chunked body is
+    counted as it arrives and cut off as soon as it passes the cap.
+    """
+
+    def __init__(self, app, paths, max_bytes: int = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES):
+        self.app = app
+        self.paths = set(paths)
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope.get("headers", ()):
+            if name == b"content-length" and value.isdigit() and int(value) > self.max_bytes:
+                error = too_large()
+                await JSONResponse({"detail": error.detail}, status_code=error.status_code)(scope, receive, send)
+                return
+
+        received = 0
+
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Raised inside request.form(), which FastAPI passes on as the response
+                    raise too_large()
+            return message
+
+        await self.app(scope, receive_limited, send)
+
+
+def spool_upload(file: UploadFile) -> str:
+    """Copy an upload to a temp file in chunks, rejecting it once it passes the size cap."""
+    fd, path = tempfile.mkstemp(prefix="upload-")
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: file.file.read(CHUNK_SIZE), b""):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise too_large()
+                out.write(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
+
+
+def render_variants(path: str) -> dict:
+    """Decode an image and encode the stored picture plus its thumbnails.
+
+    Runs inside the process pool, so it only takes and returns picklable values.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+
+        full = image.copy()
+        full.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Image.LANCZOS)
+        buffer = io.BytesIO()
+        full.save(buffer, format="JPEG", quality=85, optimize=True, progressive=True)
+        variants = {"full": buffer.getvalue()}
+
+        for size in THUMBNAIL_SIZES:
+            thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            buffer = io.BytesIO()
+            thumbnail.save(buffer, format=THUMBNAIL_FORMAT, quality=80)
+            variants[size] = buffer.getvalue()
+
+    return variants
+
+
+def process_upload(file: UploadFile) -> dict:
+    path = spool_upload(file)
+    try:
+        future = get_pool().submit(render_variants, path)
+        try:
+            return future.result(timeout=IMAGE_TIMEOUT_SECONDS)
+        except TimeoutError:
+            future.cancel()
+            raise HTTPException(status_code=503, detail="Image processing is busy, try again")
+        except Exception:
+            raise HTTPException(status_code=400, detail="Unsupported or corrupt image")
+    finally:
+        os.unlink(path)
@@ -0,0 +1,262 @@
+import asyncio
+import contextvars
+import logging
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as StackCounter
+from typing import Optional
+
+from metrics import env_flag, registry
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger("sql.slow")
+
+# Statements slower than this are logged; 0 disables the log
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 200))
+# Also log the bound parameters, which include password hashes and emails; only for local debugging
+SLOW_QUERY_LOG_PARAMETERS = env_flag("SLOW_QUERY_LOG_PARAMETERS", False)
+# Adds a Server-Timing header with app and database time to every response
+SERVER_TIMING = env_flag("SERVER_TIMING", True)
+# The sampling profiler only runs when enabled; then a request opts in with the
+# X-Profile header, or a PROFILE_SAMPLE_RATE share of requests is profiled at random
+PROFILING_ENABLED = env_flag("PROFILING_ENABLED", False)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(__file__), "profiles"))
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+BYTE_BUCKETS = (0, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+request_duration = registry.histogram("http_request_duration_seconds", "Request latency by route")
+request_queries = registry.histogram("http_request_db_queries", "SQL statements per request by route", COUNT_BUCKETS)
+request_rows = registry.histogram("http_request_db_rows", "Rows fetched per request by route", COUNT_BUCKETS)
+request_bytes = registry.histogram("http_request_db_bytes", "Approximate bytes fetched per request by route", BYTE_BUCKETS)
+query_duration = registry.histogram("db_query_duration_seconds", "SQL statement latency")
+slow_queries = registry.counter("db_slow_queries_total", "Statements slower than SLOW_QUERY_MS by route")
+profiles_captured = registry.counter("profiles_captured_total", "Requests captured by the sampling profiler")
+
+
+class RequestStats:
+    __slots__ = ("scope", "queries", "rows", "bytes", "db_seconds", "threads")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.queries = 0
+        self.rows = 0
+        self.bytes = 0
+        self.db_seconds = 0.0
+        # Threads that did work for this request, for the profiler
+        self.threads = {threading.get_ident()}
+
+    @property
+    def route(self) -> str:
+        # The router stores the matched route in the scope, so this is the path template
+        route = self.scope.get("route")
+        if route is not None:
+            return route.path
+        return self.scope.get("cache_route", "unmatched")
+
+
+current_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+
+
+def _value_size(value) -> int:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value)
+    return 8
+
+
+def record_rows(rows):
+    stats = current_stats.get()
+    if stats is None or not rows:
+        return
+    stats.rows += len(rows)
+    stats.bytes += sum(_value_size(value) for row in rows for value in row)
+
+
+# Drivers don't report fetched rows, so the cursors count them as they are read.
+# Outside a request the only overhead is the context variable lookup.
+
+class CountingCursorMixin:
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            record_rows((row,))
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        record_rows(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        record_rows(rows)
+        return rows
+
+
+class CountingSQLiteCursor(CountingCursorMixin, sqlite3.Cursor):
+    pass
+
+
+class CountingSQLiteConnection(sqlite3.Connection):
+    def cursor(self, factory=CountingSQLiteCursor):
+        return super().cursor(factory)
+
+
+def counting_connect_args(url: str) -> dict:
+    """connect_args that make the DBAPI driver count fetched rows and bytes."""
+    if url.startswith("sqlite"):
+        return {"factory": CountingSQLiteConnection}
+    if url.startswith("postgresql://") or url.startswith("postgresql+psycopg2://"):
+        import psycopg2.extensions
+
+        class CountingPostgresCursor(CountingCursorMixin, psycopg2.extensions.cursor):
+            pass
+
+        return {"cursor_factory": CountingPostgresCursor}
+    return {}
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    query_duration.observe(elapsed)
+    stats = current_stats.get()
+    route = "background"
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+        stats.threads.add(threading.get_ident())
+        route = stats.route
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_queries.inc(route=route)
+        if SLOW_QUERY_LOG_PARAMETERS:
+            slow_query_logger.warning(
+                "Slow query (%.1f ms) in %s: %s; parameters: %r", elapsed * 1000, route, statement, parameters
+            )
+        else:
+            slow_query_logger.warning("Slow query (%.1f ms) in %s: %s", elapsed * 1000, route, statement)
+
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class SamplingProfiler:
+    """Samples the stacks of a request's threads on an interval and writes them as folded stacks.
+
+    The output is one ``frame;frame;frame count`` line per distinct stack, the input
+    format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, stats: RequestStats, interval: float):
+        self.stats = stats
+        self.interval = interval
+        self.samples = StackCounter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.stats.route.strip('/').replace('/', '_') or 'root'}-{os.getpid()}.folded"
+        path = os.path.join(PROFILE_DIR, name)
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        profiles_captured.inc()
+        return path
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in list(self.stats.threads):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = ";".join(
+                    f"{summary.name} ({os.path.basename(summary.filename)}:{summary.lineno})"
+                    for summary in traceback.extract_stack(frame)
+                )
+                self.samples[stack] += 1
+
+
+def _server_timing(stats: RequestStats, elapsed: float) -> bytes:
+    return (
+        f'app;dur={elapsed * 1000:.1f}, '
+        f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries", '
+        f'rows;desc="{stats.rows} rows, {stats.bytes} bytes"'
+    ).encode("latin-1")
+
+
+class InstrumentationMiddleware:
+    """Per-request latency, SQL counts and optional profiling, reported to /metrics and Server-Timing."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def _should_profile(self, scope) -> bool:
+        if not PROFILING_ENABLED:
+            return False
+        for name, value in scope.get("headers", ()):
+            if name == b"x-profile" and value not in (b"", b"0"):
+                return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = current_stats.set(stats)
+        profiler = None
+        if self._should_profile(scope):
+            profiler = SamplingProfiler(stats, PROFILE_INTERVAL_MS / 1000)
+            profiler.start()
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING:
+                    message = dict(message)
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", _server_timing(stats, time.perf_counter() - start))
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_stats.reset(token)
+            labels = {"method": scope["method"], "route": stats.route}
+            request_duration.observe(elapsed, status=str(status), **labels)
+            request_queries.observe(stats.queries, **labels)
+            request_rows.observe(stats.rows, **labels)
+            request_bytes.observe(stats.bytes, **labels)
+            if profiler is not None:
+                # Joining the sampler and writing the file block, so keep them off the event loop
+                path = await asyncio.to_thread(profiler.stop)
+                logger.info("Profiled %s %s in %.1f ms: %s", scope["method"], stats.route, elapsed * 1000, path)
@@ -0,0 +1,367 @@
+import random
+import threading
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from typing import List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from models import ScoreRollup, User
+from shared_state import PICTURES_CHANNEL, shared_state
+from stats import PERIOD_DAY, PERIOD_WEEK, utc_day, week_start
+
+
+@dataclass
+class LeaderboardEntry:
+    id: int
+    username: str
+    best_score: int
+    picture_id: Optional[str] = None
+
+    @property
+    def key(self):
+        # Highest score first, ties broken by the lowest user id
+        return (-self.best_score, self.id)
+
+
+class _Node:
+    __slots__ = ("key", "value", "next", "width")
+
+    def __init__(self, key, value, level):
+        self.key = key
+        self.value = value
+        self.next = [None] * level
+        self.width = [1] * level
+
+
+class RankedIndex:
+    """Indexable skiplist: insert, remove, rank and positional lookup in O(log n)."""
+
+    MAX_LEVEL = 32
+
+    def __init__(self):
+        self._head = _Node(None, None, self.MAX_LEVEL)
+        self._level = 1
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _random_level(self):
+        level = 1
+        while level < self.MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        return level
+
+    def insert(self, key, value):
+        update = [self._head] * self.MAX_LEVEL
+        steps = [0] * self.MAX_LEVEL
+        node = self._head
+        for i in reversed(range(self._level)):
+            steps[i] = steps[i + 1] if i + 1 < self._level else 0
+            while node.next[i] is not None and node.next[i].key < key:
+                steps[i] += node.width[i]
+                node = node.next[i]
+            update[i] = node
+
+        level = self._random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                update[i] = self._head
+                steps[i] = 0
+                self._head.width[i] = self._size + 1
+            self._level = level
+
+        new = _Node(key, value, level)
+        position = steps[0]
+        for i in range(level):
+            prev = update[i]
+            new.next[i] = prev.next[i]
+            prev.next[i] = new
+            new.width[i] = prev.width[i] - (position - steps[i])
+            prev.width[i] = position - steps[i] + 1
+        for i in range(level, self._level):
+            update[i].width[i] += 1
+        self._size += 1
+
+    def remove(self, key):
+        update = [None] * self.MAX_LEVEL
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key < key:
+                node = node.next[i]
+            update[i] = node
+
+        target = node.next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+
+        for i in range(self._level):
+            prev = update[i]
+            if prev.next[i] is target:
+                prev.width[i] += target.width[i] - 1
+                prev.next[i] = target.next[i]
+            else:
+                prev.width[i] -= 1
+        while self._level > 1 and self._head.next[self._level - 1] is None:
+            self._level -= 1
+        self._size -= 1
+
+    def rank(self, key) -> int:
+        """Zero-based position of ``key``."""
+        position = 0
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key <= key:
+                position += node.width[i]
+                node = node.next[i]
+        if node is self._head or node.key != key:
+            raise KeyError(key)
+        return position - 1
+
+    def count_through(self, key) -> int:
+        """Number of keys less than or equal to ``key``, whether or not it is present."""
+        position = 0
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key <= key:
+                position += node.width[i]
+                node = node.next[i]
+        return position
+
+    def _node_at(self, index):
+        position = index + 1
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.width[i] <= position:
+                position -= node.width[i]
+                node = node.next[i]
+        return node
+
+    def slice(self, start: int, stop: int) -> list:
+        """Values at positions [start, stop), walking the bottom level after one O(log n) seek."""
+        start = max(start, 0)
+        stop = min(stop, self._size)
+        if start >= stop:
+            return []
+        node = self._node_at(start)
+        values = []
+        while node is not None and len(values) < stop - start:
+            values.append(node.value)
+            node = node.next[0]
+        return values
+
+
+class Leaderboard:
+    """Process-local ranking of users by best score, kept in sync by submit-score."""
+
+    def __init__(self, name: str = "all-time"):
+        self.name = name
+        self._lock = threading.RLock()
+        self._index = RankedIndex()
+        self._entries = {}
+        # Bumped on every change; readers use it as an ETag
+        self.version = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _reset(self, entries):
+        with self._lock:
+            self._index = RankedIndex()
+            self._entries = {}
+            for entry in entries:
+                self._put(entry)
+            self.version += 1
+
+    def load(self, db: Session):
+        # Only the ranking columns, never the picture bytes
+        rows = db.query(User.id, User.username, User.best_score, User.profile_picture_id).all()
+        self._reset(
+            LeaderboardEntry(user_id, username, best_score or 0, picture_id)
+            for user_id, username, best_score, picture_id in rows
+        )
+
+    def _put(self, entry: LeaderboardEntry):
+        self._entries[entry.id] = entry
+        self._index.insert(entry.key, entry)
+
+    def upsert(self, user_id: int, username: str, best_score: int, picture_id: Optional[str] = None):
+        with self._lock:
+            current = self._entries.get(user_id)
+            if current is not None:
+                self._index.remove(current.key)
+            self._put(LeaderboardEntry(user_id, username, best_score or 0, picture_id))
+            self.version += 1
+
+    def record_score(self, user_id: int, score: int) -> bool:
+        """Raise the user's best score if ``score`` beats it. Returns True if the ranking changed."""
+        with self._lock:
+            current = self._entries.get(user_id)
+            if current is None or score <= current.best_score:
+                return False
+            self._index.remove(current.key)
+            self._put(LeaderboardEntry(user_id, current.username, score, current.picture_id))
+            self.version += 1
+            return True
+
+    def set_picture(self, user_id: int, picture_id: Optional[str]):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry.picture_id = picture_id
+                self.version += 1
+
+    def remove(self, user_id: int):
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self._index.remove(entry.key)
+                self.version += 1
+
+    def get(self, user_id: int) -> Optional[LeaderboardEntry]:
+        return self._entries.get(user_id)
+
+    def top(self, limit: int, offset: int = 0) -> List[LeaderboardEntry]:
+        with self._lock:
+            return self._index.slice(offset, offset + limit)
+
+    def page_after(self, key: Optional[tuple], limit: int) -> Tuple[int, List[LeaderboardEntry]]:
+        """Entries ranked after ``key`` (or from the top), with the zero-based position of the first one.
+
+        Keyset paging stays stable while scores change, unlike offsets.
+        """
+        with self._lock:
+            start = self._index.count_through(key) if key is not None else 0
+            return start, self._index.slice(start, start + limit)
+
+    def rank_of(self, user_id: int) -> Optional[int]:
+        """One-based rank of the user, or None if unknown."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            return self._index.rank(entry.key) + 1
+
+    def around(self, user_id: int, radius: int = 5) -> List[LeaderboardEntry]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return []
+            position = self._index.rank(entry.key)
+            return self._index.slice(position - radius, position + radius + 1)
+
+
+class PeriodLeaderboard(Leaderboard):
+    """Best score per user within the current day or week; starts empty when the period rolls over."""
+
+    def __init__(self, name: str, period: str):
+        super().__init__(name)
+        self.period = period
+        self.period_start = self._current_start()
+
+    def _current_start(self, timestamp: Optional[datetime] = None) -> date:
+        day = utc_day(timestamp or datetime.now(timezone.utc))
+        return week_start(day) if self.period == PERIOD_WEEK else day
+
+    def _roll(self):
+        current = self._current_start()
+        if current != self.period_start:
+            with self._lock:
+                if current != self.period_start:
+                    self.period_start = current
+                    self._reset([])
+
+    def load(self, db: Session):
+        start = self._current_start()
+        rows = (
+            db.query(User.id, User.username, ScoreRollup.best_score, User.profile_picture_id)
+            .join(ScoreRollup, ScoreRollup.user_id == User.id)
+            .filter(ScoreRollup.period == self.period, ScoreRollup.period_start == start)
+            .all()
+        )
+        with self._lock:
+            self.period_start = start
+            self._reset(
+                LeaderboardEntry(user_id, username, best_score, picture_id)
+                for user_id, username, best_score, picture_id in rows
+            )
+
+    def record_period_score(self, entry: LeaderboardEntry, score: int, timestamp: datetime) -> bool:
+        self._roll()
+        if self._current_start(timestamp) != self.period_start:
+            # Late score from an earlier period
+            return False
+        with self._lock:
+            if entry.id not in self._entries:
+                self._put(LeaderboardEntry(entry.id, entry.username, score, entry.picture_id))
+                self.version += 1
+                return True
+            return self.record_score(entry.id, score)
+
+    def page_after(self, key, limit):
+        self._roll()
+        return super().page_after(key, limit)
+
+    def top(self, limit, offset=0):
+        self._roll()
+        return super().top(limit, offset)
+
+    def get(self, user_id):
+        self._roll()
+        return super().get(user_id)
+
+
+leaderboard = Leaderboard()
+daily_leaderboard = PeriodLeaderboard("daily", PERIOD_DAY)
+weekly_leaderboard = PeriodLeaderboard("weekly", PERIOD_WEEK)
+boards = {board.name: board for board in (leaderboard, weekly_leaderboard, daily_leaderboard)}
+
+
+def load_leaderboards(db: Session):
+    for board in boards.values():
+        board.load(db)
+
+
+def record_leaderboard_scores(entries):
+    """Apply (user_id, score, timestamp) entries to the all-time and period boards."""
+    changed = set()
+    for user_id, score, timestamp in entries:
+        if leaderboard.record_score(user_id, score):
+            changed.add(leaderboard.name)
+        entry = leaderboard.get(user_id)
+        if entry is None:
+            continue
+        for board in (weekly_leaderboard, daily_leaderboard):
+            if board.record_period_score(entry, score, timestamp):
+                changed.add(board.name)
+    return changed
+
+
+def _set_picture(user_id: int, picture_id: Optional[str]):
+    for board in boards.values():
+        board.set_picture(user_id, picture_id)
+
+
+def set_leaderboard_picture(user_id: int, picture_id: Optional[str]):
+    _set_picture(user_id, picture_id)
+    shared_state.broadcast(PICTURES_CHANNEL, [user_id, picture_id])
+
+
+shared_state.subscribe(PICTURES_CHANNEL, lambda message: _set_picture(*message))
+
+
+def friends_page(board: Leaderboard, member_ids, key: Optional[tuple], limit: int) -> Tuple[int, List[LeaderboardEntry]]:
+    """Rank only ``member_ids`` (a user and their friends) on ``board``.
+
+    Friend lists are small, so the members are looked up and sorted directly
+    instead of walking the global ranking.
+    """
+    entries = sorted(
+        (entry for entry in (board.get(user_id) for user_id in member_ids) if entry is not None),
+        key=lambda entry: entry.key,
+    )
+    start = 0
+    if key is not None:
+        start = next((i for i, entry in enumerate(entries) if entry.key > key), len(entries))
+    return start, entries[start:start + limit]
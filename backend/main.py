@@ -1,29 +1,104 @@
+import hashlib
+import logging
+import os
 from datetime import timedelta
 import uvicorn
 
-from typing import List
-from fastapi.responses import JSONResponse
-from passlib.hash import bcrypt
-from fastapi import Body, Depends, FastAPI, File, HTTPException, Request, Response, UploadFile
+from typing import List, Optional
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import Body, Depends, FastAPI, File, HTTPException, Request, Response, UploadFile, WebSocket, WebSocketDisconnect
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from fastapi.security import OAuth2PasswordRequestForm 
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+from starlette.concurrency import run_in_threadpool
+
+
+from schemas import BaseResponse, Data, FriendRequestBulk, FriendRequestBulkResult, FriendRequestCreate, FriendRequestPage, FriendRequestPayload, FriendRequests, LeaderboardPage, LeaderboardRank, LeaderboardUser, ScoreBatch, ScoreData, ScorePage, SoundSettingsResponse, SoundSettingsUpdate, UserSearchPage, UserStatsResponse, UserCreate, UserValues
+from database import DB_MODE, SessionLocal, async_engine, engine, get_db
+from auth import CurrentPrincipal, create_access_token, get_current_principal, invalidate_principal, optional_oauth2_scheme, require_admin, validate_token
+from models import FriendRequestStatus, User, FriendRequest
+from services import AVATAR_SIZE, FRIEND_REQUESTS_PAGE_SIZE, RECEIVED, SENT, friend_requests_statement, get_friend_request_page, to_friend_request_response, board_etag, conditional_json, etag_matches, decode_leaderboard_cursor, leaderboard_page, PROFILE_SCORES_LIMIT, build_user_profile, to_leaderboard_user, get_profile_picture_binary, load_profile_user, get_username_by_id, profile_picture_response, profile_picture_url, thumbnail_variant
+from blobs import blob_store
+from images import THUMBNAIL_SIZES, UploadLimitMiddleware, process_upload, shutdown_pool
+from leaderboard import boards as leaderboards, friends_page, leaderboard, load_leaderboards, set_leaderboard_picture
+from devices import device_dispatcher, send_login_to_device, send_settings_version_to_device, send_volume_to_device
+from instrumentation import InstrumentationMiddleware
+from metrics import registry
+from passwords import login_throttle, password_hasher
+from stats import SCORES_PAGE_SIZE, get_score_page, get_user_stats
+from scoring import MAX_SCORES_PER_REQUEST, SCORE_WRITE_BEHIND, apply_to_leaderboard, invalidate_score_views, make_entries, record_scores, score_buffer, split_known_users
+from directory import user_directory
+from read_models import FastJSONResponse, FriendContactView, dumps
+from telemetry import game_event_buffer, parse_game_events, read_event_batch
+from transfer import FORMATS as EXPORT_FORMATS, TABLES as EXPORT_TABLES, stream_export, stream_user_export
+from sounds import get_sound_profile, invalidate_sound_profile, master_sound_id, to_sound_settings_response, upsert_sound_settings
+from friends import MAX_BULK_REQUESTS, add_friendship, bulk_resolve_requests, get_friend_ids, get_friendship_statuses, get_mutual_friend_ids, get_pending_counts, get_pending_counts_many, invalidate_friends, is_friend, remove_friendship
+from cache import LEADERBOARD_TAG, CacheRule, ResponseCacheMiddleware, friends_tag, invalidate_tags, user_tag
+from events import LEADERBOARD_TOPIC, event_hub, publish_friend_request, user_topic
+from shared_state import USERS_CHANNEL, shared_state
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+def warm_caches():
+    # Load the rankings and the username index once so reads never touch the database
+    db = SessionLocal()
+    try:
+        load_leaderboards(db)
+        user_directory.load(db)
+    finally:
+        db.close()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The worker only starts taking requests once this has run up to the yield. The
+    # schema is not touched here; `python manage.py migrate` applies it before a deploy.
+    event_hub.bind(asyncio.get_running_loop())
+    shared_state.start()
+    await run_in_threadpool(warm_caches)
+    if SCORE_WRITE_BEHIND:
+        score_buffer.start()
+    game_event_buffer.start()
+    await device_dispatcher.start()
+    try:
+        yield
+    finally:
+        # Reverse order: flush buffered scores while the pools and engine are still up
+        if SCORE_WRITE_BEHIND:
+            await run_in_threadpool(score_buffer.stop)
+        await run_in_threadpool(game_event_buffer.stop)
+        await device_dispatcher.stop()
+        shutdown_pool()
+        password_hasher.shutdown()
+        shared_state.stop()
+        if async_engine is not None:
+            await async_engine.dispose()
+        engine.dispose()
+
 
+app = FastAPI(lifespan=lifespan)
 
-from schemas import BaseResponse, Data, FriendRequestCreate, FriendRequestPayload, FriendRequestResponse, FriendRequests, LeaderboardUser, ScoreData, UserCreate, UserValues
-from database import Base, SessionLocal, engine, get_db
-from auth import create_access_token, get_current_user
-from models import FriendRequestStatus, User, FriendRequest, Score, Sound, SoundSetting
-from database import Base, engine
-from services import get_profile_picture_binary, get_username_by_id
+MAX_LEADERBOARD_PAGE = 100
+MAX_SEARCH_LIMIT = 50
+# Deep pages of a typeahead are never useful and would make the fuzzy pass scan further
+MAX_SEARCH_OFFSET = 500
 
-Base.metadata.create_all(bind=engine)
+if DB_MODE == "async":
+    # Registered first so these handlers take precedence over the sync ones below
+    from async_routes import router as async_router
+    app.include_router(async_router)
 
 
-app = FastAPI()
+def add_user_locally(user_id: int, username: str, best_score: int):
+    leaderboard.upsert(user_id, username, best_score)
+    user_directory.add(user_id, username)
 
-ESP32_IP = "http://172.20.10.13:8000/esp-login"
+
+shared_state.subscribe(USERS_CHANNEL, lambda message: add_user_locally(*message))
 
 
 
@@ -51,7 +126,7 @@ def register_user(user: UserCreate, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Username already taken.")
 
     # Hash the password and create a new user
-    hashed_password = bcrypt.hash(user.password)
+    hashed_password = password_hasher.hash(user.password)
     new_user = User(
         username=user.username,
         email=user.email,
@@ -60,17 +135,31 @@ def register_user(user: UserCreate, db: Session = Depends(get_db)):
     db.add(new_user)  # Add the new user to the session
     db.commit()  # Commit the transaction to persist the changes
     db.refresh(new_user)  # Refresh to get the newly assigned ID
+    add_user_locally(new_user.id, new_user.username, new_user.best_score or 0)
+    shared_state.broadcast(USERS_CHANNEL, [new_user.id, new_user.username, new_user.best_score or 0])
 
     return {"message": "User created successfully", "user_id": new_user.id}
 
 
 # User login endpoint
 @app.post("/login")
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    # Throttle before spending any bcrypt time on the attempt
+    login_throttle.check_login(request.client.host if request.client else None, form_data.username)
+
     # Validate the user's credentials
     user = db.query(User).filter(User.email == form_data.username).first()
-    if not user or not bcrypt.verify(form_data.password, user.hashed_password):
+    if not user:
         raise HTTPException(status_code=400, detail="Invalid credentials")
+    valid, new_hash = password_hasher.verify(form_data.password, user.hashed_password)
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid credentials")
+    login_throttle.login_succeeded(form_data.username)
+
+    # Upgrade hashes made with an outdated cost
+    if new_hash:
+        user.hashed_password = new_hash
+        db.commit()
 
     # Create the JWT token
     token = create_access_token(
@@ -80,124 +169,103 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
     )
 
     # ✅ Send login data to ESP32
-    data = {"user_id": user.id, "username": user.username}
-    try:
-        response = requests.post(ESP32_IP, json=data, timeout=10)  
-        print(f"Sent login data to ESP: {response.text}")  
-    except requests.exceptions.RequestException as e:
-        print(f"⚠️ Failed to send login data to ESP: {e}")
+    send_login_to_device(user.id, user.username, get_sound_profile(db, user.id).version)
 
 
     return {"access_token": token, "token_type": "bearer"}
 
 
+def invalidate_picture_views(db: Session, user_id: int):
+    # Avatar URLs appear in the user's profile, in friends' lists and on the leaderboards
+    invalidate_tags([user_tag(user_id), LEADERBOARD_TAG] + [friends_tag(friend_id) for friend_id in get_friend_ids(db, user_id)])
+
 @app.post("/users/upload-profile-picture/")
 def upload_profile_picture_binary(
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentPrincipal = Depends(get_current_principal)
 ):
     user = db.query(User).filter(User.id == current_user.id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Read binary content of the file
-    file_content = file.file.read()
-    user.profile_picture = file_content
+    # Spool the upload to disk, then resize and thumbnail it in the image process pool
+    variants = process_upload(file)
+    picture_id = blob_store.put(variants.pop("full"))
+    for size, data in variants.items():
+        blob_store.put_variant(picture_id, thumbnail_variant(size), data)
+
+    # Keep only the content hash on the row
+    user.profile_picture_id = picture_id
     db.commit()
-    return {"message": "Profile picture saved in the database"}
+    set_leaderboard_picture(user.id, user.profile_picture_id)
+    invalidate_principal(user.id)
+    invalidate_picture_views(db, user.id)
+    return {"message": "Profile picture saved", "profile_picture": profile_picture_url(user.id, user.profile_picture_id)}
 
 
 @app.delete("/users/delete-profile-picture/")
-def delete_profile_picture(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def delete_profile_picture(db: Session = Depends(get_db), current_user: CurrentPrincipal = Depends(get_current_principal)):
     user = db.query(User).filter(User.id == current_user.id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    user.profile_picture = None
+    user.profile_picture_id = None
     db.commit()
+    set_leaderboard_picture(user.id, None)
+    invalidate_principal(user.id)
+    invalidate_picture_views(db, user.id)
     return {"message": "Profile picture deleted successfully"}
 
 @app.get("/users/{user_id}/profile-picture/")
-def get_profile_picture(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user or not user.profile_picture:
+def get_profile_picture(
+    user_id: int,
+    request: Request,
+    v: Optional[str] = None,
+    size: Optional[int] = None,
+    db: Session = Depends(get_db),
+):
+    if size is not None and size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=422, detail=f"size must be one of {list(THUMBNAIL_SIZES)}")
+    # Every user is on the in-memory leaderboard, so the lookup rarely needs the database
+    entry = leaderboard.get(user_id)
+    if entry is not None:
+        picture_id = entry.picture_id
+    else:
+        picture_id = db.query(User.profile_picture_id).filter(User.id == user_id).scalar()
+    if not blob_store.exists(picture_id):
         raise HTTPException(status_code=404, detail="Profile picture not found")
-    return Response(content=user.profile_picture, media_type="image/jpeg")
+    return profile_picture_response(request, picture_id, size=size, version=v)
 
 
 @app.get("/me", response_model=UserValues)
 def get_user_info(
+    scores_limit: int = PROFILE_SCORES_LIMIT,
+    scores_offset: int = 0,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: CurrentPrincipal = Depends(get_current_principal),
 ):
-    if not current_user:
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-    
-    # Query the current user
-    user = db.query(User).filter(User.id == current_user.id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    # Generate the profile picture URL or return None if not available
-    profile_picture_url = None
-    if user.profile_picture:
-        profile_picture_url = f"/users/{user.id}/profile-picture/"
-
-    # Fetch friends using the get_all_friends logic
-    friends = db.query(FriendRequest).filter(
-        ((FriendRequest.requester_id == current_user.id) & (FriendRequest.status == FriendRequestStatus.accepted)) |
-        ((FriendRequest.receiver_id == current_user.id) & (FriendRequest.status == FriendRequestStatus.accepted))
-    ).all()
-
-    # Collect friend IDs and fetch their details
-    friend_ids = [
-        friend.receiver_id if friend.requester_id == current_user.id else friend.requester_id
-        for friend in friends
-    ]
-    if not friend_ids:
-        friend_users = []
-    else:
-        friend_users = db.query(User).filter(User.id.in_(friend_ids)).all()
-
-    # Construct the friends data, including the best_score for each friend
-    friends_data = [
-        {
-            "id": friend.id,
-            "username": friend.username,
-            "profile_picture": f"/users/{friend.id}/profile-picture/" if friend.profile_picture else None,
-            "best_score": friend.best_score,  # Include best_score here
-        }
-        for friend in friend_users
-    ]
-
-    # Return the user data
-    return {
-        "id": user.id,
-        "username": user.username,
-        "email": user.email,
-        "best_score": user.best_score,
-        "profile_picture": profile_picture_url,
-        "friends": friends_data,  # Include friends with best_score
-        "sound_settings": user.sound_settings,
-        "scores": [
-            {"score": score.score, "timestamp": score.timestamp}
-            for score in user.scores
-        ],
-    }
+    # The principal is usually cached, so the only user lookup is the projected profile row
+    user = load_profile_user(db, current_user.id)
+    return FastJSONResponse(build_user_profile(
+        db, user, include_private=True, scores_limit=scores_limit, scores_offset=scores_offset
+    ))
 
 
 @app.post("/friend-request/")
 def send_friend_request(
     payload: FriendRequestPayload,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentPrincipal = Depends(get_current_principal)
 ):
     receiver_id = payload.receiver_id
     receiver = db.query(User).filter(User.id == receiver_id).first()
     if not receiver:
         raise HTTPException(status_code=404, detail="User not found")
 
+    if is_friend(db, current_user.id, receiver_id):
+        raise HTTPException(status_code=400, detail="Already friends")
+
     existing_request = db.query(FriendRequest).filter(
         FriendRequest.requester_id == current_user.id,
         FriendRequest.receiver_id == receiver_id
@@ -211,15 +279,47 @@ def send_friend_request(
         status=FriendRequestStatus.pending
     )
     db.add(friend_request)
+    db.flush()
+    request_id = friend_request.id
     db.commit()
+    publish_friend_request(
+        "friend_request_received", request_id, receiver_id, get_pending_counts(db, receiver_id),
+        requester_id=current_user.id, requester_username=current_user.username,
+    )
     return {"message": "Friend request sent successfully"}
 
 
+# Typeahead search for people to add: prefix matches first, then near misses
+@app.get("/users/search", response_model=UserSearchPage)
+def search_users(
+    q: str,
+    limit: int = 20,
+    offset: int = 0,
+    db: Session = Depends(get_db),
+    current_user: CurrentPrincipal = Depends(get_current_principal),
+):
+    limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+    if offset < 0 or offset > MAX_SEARCH_OFFSET:
+        raise HTTPException(status_code=400, detail=f"offset must be between 0 and {MAX_SEARCH_OFFSET}")
+
+    user_ids, has_more = user_directory.search(q, limit, offset)
+    statuses = get_friendship_statuses(db, current_user.id, user_ids)
+    results = []
+    for user_id in user_ids:
+        entry = leaderboard.get(user_id)
+        results.append({
+            "id": user_id,
+            "username": user_directory.username(user_id),
+            "profile_picture": profile_picture_url(user_id, entry.picture_id if entry else None, AVATAR_SIZE),
+            "status": statuses[user_id],
+        })
+    return {"results": results, "next_offset": offset + limit if has_more else None}
+
 # Add friend by username
 
 @app.post("/friend-request-by-username/")
 def send_friend_request_by_username(
-    username: str, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+    username: str, db: Session = Depends(get_db), current_user: CurrentPrincipal = Depends(get_current_principal)
 ):
     # Query the receiver by username
     receiver = db.query(User).filter(User.username == username).first()
@@ -229,12 +329,12 @@ def send_friend_request_by_username(
         return JSONResponse(status_code=200, content={"message": f"User with username '{username}' not found."})
 
     # If user is found, proceed with sending the friend request
-    return send_friend_request(receiver.id, db=db, current_user=current_user)
+    return send_friend_request(FriendRequestPayload(receiver_id=receiver.id), db=db, current_user=current_user)
 
 # Approve friend request
 @app.post("/friend-requests/{request_id}/accept")
 def accept_friend_request(
-    request_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+    request_id: int, db: Session = Depends(get_db), current_user: CurrentPrincipal = Depends(get_current_principal)
 ):
     # Retrieve the friend request
     friend_request = db.query(FriendRequest).filter(FriendRequest.id == request_id).first()
@@ -246,243 +346,405 @@ def accept_friend_request(
     if friend_request.receiver_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized to accept this request")
 
-    # Update the status to 'accepted'
-    friend_request.status = "accepted"
+    if friend_request.status == FriendRequestStatus.accepted:
+        return {"message": "Friend request accepted"}
+
+    # Update the status to 'accepted' and record both directions of the friendship
+    friend_request.status = FriendRequestStatus.accepted
+    add_friendship(db, friend_request.requester_id, friend_request.receiver_id)
     db.commit()
-    db.refresh(friend_request)
+    invalidate_friends([friend_request.requester_id, friend_request.receiver_id])
+    publish_friend_request(
+        "friend_request_accepted", request_id, friend_request.requester_id,
+        get_pending_counts(db, friend_request.requester_id), friend_id=current_user.id,
+    )
+    publish_friend_request("friend_request_resolved", request_id, current_user.id, get_pending_counts(db, current_user.id))
 
     return {"message": "Friend request accepted"}
 
 # Deny friend request
 @app.delete("/friend-request/{request_id}/deny/")
-def deny_friend_request(request_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def deny_friend_request(request_id: int, db: Session = Depends(get_db), current_user: CurrentPrincipal = Depends(get_current_principal)):
     friend_request = db.query(FriendRequest).filter(
         FriendRequest.id == request_id,
         FriendRequest.receiver_id == current_user.id
     ).first()
     if not friend_request:
         raise HTTPException(status_code=404, detail="Friend request not found")
+    was_accepted = friend_request.status == FriendRequestStatus.accepted
+    if was_accepted:
+        remove_friendship(db, friend_request.requester_id, friend_request.receiver_id)
+    requester_id = friend_request.requester_id
     db.delete(friend_request)
     db.commit()
+    if was_accepted:
+        invalidate_friends([requester_id, current_user.id])
+    publish_friend_request("friend_request_denied", request_id, requester_id, get_pending_counts(db, requester_id))
+    publish_friend_request("friend_request_resolved", request_id, current_user.id, get_pending_counts(db, current_user.id))
     return {"message": "Friend request denied"}
 
+# Pending counts for the notification bell, without loading the requests themselves
+@app.get("/friend-requests/count")
+def get_friend_request_count(db: Session = Depends(get_db), current_user: CurrentPrincipal = Depends(get_current_principal)):
+    return get_pending_counts(db, current_user.id)
+
 # View all friend requests
 @app.get("/friend-requests/", response_model=FriendRequests)
 def get_friend_requests(
-    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+    db: Session = Depends(get_db), current_user: CurrentPrincipal = Depends(get_current_principal)
 ):
-    # Get sent requests with 'pending' status
-    sent_requests = (
-        db.query(FriendRequest)
-        .join(User, FriendRequest.receiver_id == User.id)  # Join with receiver's user table
-        .filter(FriendRequest.requester_id == current_user.id)
-        .filter(FriendRequest.status == FriendRequestStatus.pending)  # Only pending requests
-        .all()
-    )
-
-    # Get received requests with 'pending' status
-    received_requests = (
-        db.query(FriendRequest)
-        .join(User, FriendRequest.requester_id == User.id)  # Join with requester's user table
-        .filter(FriendRequest.receiver_id == current_user.id)
-        .filter(FriendRequest.status == FriendRequestStatus.pending)  # Only pending requests
-        .all()
-    )
+    # Both lists come from the joined projection, so no User rows are loaded per request
+    sent_requests = db.execute(friend_requests_statement(current_user.id, SENT)).all()
+    received_requests = db.execute(friend_requests_statement(current_user.id, RECEIVED)).all()
+    return FastJSONResponse({
+        "sent_requests": [to_friend_request_response(row) for row in sent_requests],
+        "received_requests": [to_friend_request_response(row) for row in received_requests],
+    })
+
+# One page of pending requests, newest first; pass next_cursor back to continue
+@app.get("/friend-requests/inbox", response_model=FriendRequestPage)
+def get_friend_request_inbox(
+    direction: str = RECEIVED,
+    cursor: Optional[str] = None,
+    limit: int = FRIEND_REQUESTS_PAGE_SIZE,
+    db: Session = Depends(get_db),
+    current_user: CurrentPrincipal = Depends(get_current_principal),
+):
+    if direction not in (RECEIVED, SENT):
+        raise HTTPException(status_code=422, detail=f"direction must be '{RECEIVED}' or '{SENT}'")
+    return FastJSONResponse(get_friend_request_page(db, current_user.id, direction, cursor, limit))
+
+# Accept, deny or cancel many requests in one transaction
+@app.post("/friend-requests/bulk", response_model=FriendRequestBulkResult)
+def bulk_friend_requests(
+    payload: FriendRequestBulk,
+    db: Session = Depends(get_db),
+    current_user: CurrentPrincipal = Depends(get_current_principal),
+):
+    if len(payload.ids) > MAX_BULK_REQUESTS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_REQUESTS} requests per call")
 
-    # Map sent_requests and received_requests to include usernames and profile pictures
-    def map_requests(requests, include_requester_username):
-        return [
-            FriendRequestResponse(
-                id=req.id,
-                requester_id=req.requester_id,
-                requester_username=req.requester.username if include_requester_username else current_user.username,
-                requester_profile_picture=f"/users/{req.requester_id}/profile-picture/" if req.requester.profile_picture else None,
-                receiver_id=req.receiver_id,
-                receiver_profile_picture=f"/users/{req.receiver_id}/profile-picture/" if req.receiver.profile_picture else None,
-                status=req.status.name,
-                timestamp=req.timestamp,
-            )
-            for req in requests
-        ]
+    action = payload.action.value
+    rows, skipped = bulk_resolve_requests(db, current_user.id, action, payload.ids)
+    db.commit()
 
-    return {
-        "sent_requests": map_requests(sent_requests, include_requester_username=False),
-        "received_requests": map_requests(received_requests, include_requester_username=True),
-    }
+    changed_friends = {current_user.id}
+    other_ids = set()
+    for request_id, requester_id, receiver_id, was_accepted in rows:
+        other_id = receiver_id if action == "cancel" else requester_id
+        other_ids.add(other_id)
+        if action == "accept" or was_accepted:
+            changed_friends.add(other_id)
+    if len(changed_friends) > 1:
+        invalidate_friends(changed_friends)
+
+    # Each affected user gets their events with one fresh count, however many requests were touched
+    counts = get_pending_counts_many(db, other_ids | {current_user.id})
+    event_type = {"accept": "friend_request_accepted", "deny": "friend_request_denied", "cancel": "friend_request_cancelled"}[action]
+    for request_id, requester_id, receiver_id, _ in rows:
+        other_id = receiver_id if action == "cancel" else requester_id
+        publish_friend_request(event_type, request_id, other_id, counts[other_id], friend_id=current_user.id)
+    if rows:
+        publish_friend_request("friend_request_resolved", rows[-1][0], current_user.id, counts[current_user.id])
+
+    return {"processed": [row[0] for row in rows], "skipped": skipped}
 
 @app.get("/user/{user_id}", response_model=UserValues)
-def get_user_profile(user_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    # Debugging: Print the user_id and current_user_id
-    print(f"Requesting profile for user ID: {user_id}, current user ID: {current_user.id}")
-    
-    # Query the specified user
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        print(f"User not found with ID: {user_id}")  # Log if user is not found
-        raise HTTPException(status_code=404, detail="User not found")
-
-    # Generate profile picture URL or return None if not available
-    profile_picture_url = f"/users/{user.id}/profile-picture/" if user.profile_picture else None
-
-    # Fetch friends
-    friends = db.query(FriendRequest).filter(
-        ((FriendRequest.requester_id == user.id) & (FriendRequest.status == FriendRequestStatus.accepted)) |
-        ((FriendRequest.receiver_id == user.id) & (FriendRequest.status == FriendRequestStatus.accepted))
-    ).all()
+def get_user_profile(
+    user_id: int,
+    scores_limit: int = PROFILE_SCORES_LIMIT,
+    scores_offset: int = 0,
+    db: Session = Depends(get_db),
+    current_user: CurrentPrincipal = Depends(get_current_principal),
+):
+    user = load_profile_user(db, user_id)
+    return FastJSONResponse(build_user_profile(
+        db, user, viewer_id=current_user.id, scores_limit=scores_limit, scores_offset=scores_offset
+    ))
 
-    friend_ids = [
-        friend.receiver_id if friend.requester_id == user.id else friend.requester_id
-        for friend in friends
-    ]
-    
-    friend_users = db.query(User).filter(User.id.in_(friend_ids)).all()
-
-    # Construct the friends data
-    friends_data = [
-        {
-            "id": friend.id,
-            "username": friend.username,
-            "profile_picture": f"/users/{friend.id}/profile-picture/" if friend.profile_picture else None,
-            "best_score": friend.best_score,  # Include best_score here
-        }
-        for friend in friend_users
-    ]
-
-    # Check if the logged-in user is already friends with the user
-    is_friend = any(friend.id == current_user.id for friend in friend_users)
-
-    # Fetch scores for the user
-    scores = db.query(Score).filter(Score.user_id == user.id).all()
-
-    # Return user data
+@app.get("/friends/")
+def get_all_friends(db: Session = Depends(get_db), current_user: CurrentPrincipal = Depends(get_current_principal)):
+    friend_ids = get_friend_ids(db, current_user.id)
+    rows = []
+    if friend_ids:
+        rows = db.execute(
+            select(User.id, User.username, User.email, User.profile_picture_id).where(User.id.in_(friend_ids))
+        ).all()
+    return FastJSONResponse({"friends": [
+        FriendContactView(friend_id, username, email, profile_picture_url(friend_id, picture_id, AVATAR_SIZE))
+        for friend_id, username, email, picture_id in rows
+    ]})
+
+@app.get("/users/{user_id}/mutual-friends")
+def get_mutual_friends(user_id: int, db: Session = Depends(get_db), current_user: CurrentPrincipal = Depends(get_current_principal)):
+    mutual_ids = get_mutual_friend_ids(db, current_user.id, user_id)
+    mutual_users = []
+    if mutual_ids:
+        mutual_users = (
+            db.query(User.id, User.username, User.profile_picture_id)
+            .filter(User.id.in_(mutual_ids))
+            .all()
+        )
     return {
-        "id": user.id,
-        "username": user.username,
-        "email": user.email,
-        "best_score": user.best_score,
-        "profile_picture": profile_picture_url,
-        "friends": friends_data,
-        "is_friend": is_friend,
-        "scores": [
-            {"score": score.score, "timestamp": score.timestamp}
-            for score in scores
-        ],
+        "mutual_friends": [
+            {
+                "id": friend.id,
+                "username": friend.username,
+                "profile_picture": profile_picture_url(friend.id, friend.profile_picture_id, AVATAR_SIZE),
+            }
+            for friend in mutual_users
+        ]
     }
 
-@app.get("/friends/")
-def get_all_friends(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    friends = db.query(FriendRequest).filter(
-        ((FriendRequest.requester_id == current_user.id) & (FriendRequest.status == FriendRequestStatus.accepted)) |
-        ((FriendRequest.receiver_id == current_user.id) & (FriendRequest.status == FriendRequestStatus.accepted))
-    ).all()
-
-    friend_ids = []
-    for friend in friends:
-        if friend.requester_id == current_user.id:
-            friend_ids.append(friend.receiver_id)
-        elif friend.receiver_id == current_user.id:
-            friend_ids.append(friend.requester_id)
-
-    friend_users = db.query(User).filter(User.id.in_(friend_ids)).all()
-
-    friends_data = [
-        {
-            "id": friend.id,
-            "username": friend.username,
-            "email": friend.email,
-            "profile_picture": None if not friend.profile_picture else friend.profile_picture.decode('utf-8'),
-        }
-        for friend in friend_users
-    ]
-
-    return JSONResponse(content={"friends": friends_data})
-
 @app.delete("/unfriend/{friend_id}/")
-def unfriend_user(friend_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-
-    # Find the accepted friendship in FriendRequest table
-    friendship = db.query(FriendRequest).filter(
-        ((FriendRequest.requester_id == current_user.id) & (FriendRequest.receiver_id == friend_id) & (FriendRequest.status == FriendRequestStatus.accepted)) |
-        ((FriendRequest.requester_id == friend_id) & (FriendRequest.receiver_id == current_user.id) & (FriendRequest.status == FriendRequestStatus.accepted))
-    ).first()
-
-    if not friendship:
+def unfriend_user(friend_id: int, db: Session = Depends(get_db), current_user: CurrentPrincipal = Depends(get_current_principal)):
+    if not is_friend(db, current_user.id, friend_id):
         raise HTTPException(status_code=404, detail="Friendship not found")
 
-    # Delete the accepted friendship request
-    db.delete(friendship)
+    # Delete the accepted friendship request along with both adjacency rows
+    db.query(FriendRequest).filter(
+        ((FriendRequest.requester_id == current_user.id) & (FriendRequest.receiver_id == friend_id)) |
+        ((FriendRequest.requester_id == friend_id) & (FriendRequest.receiver_id == current_user.id)),
+        FriendRequest.status == FriendRequestStatus.accepted,
+    ).delete(synchronize_session=False)
+    remove_friendship(db, current_user.id, friend_id)
     db.commit()
+    invalidate_friends([current_user.id, friend_id])
 
     return {"detail": f"Successfully unfriended user with ID {friend_id}"}
 
 @app.get("/leaderboard/top-scores", response_model=List[LeaderboardUser])
-def get_top_scores(db: Session = Depends(get_db)):
-    users = db.query(User).order_by(User.best_score.desc()).limit(10).all()
-    return [
-        LeaderboardUser(
-            id=user.id,
-            username=user.username,
-            best_score=user.best_score,
-            profile_picture=f"/users/{user.id}/profile-picture/" if user.profile_picture else None
-        )
-        for user in users
-    ]
+def get_top_scores(request: Request):
+    return conditional_json(request, board_etag(leaderboard, 10), lambda: [
+        to_leaderboard_user(entry, rank) for rank, entry in enumerate(leaderboard.top(10), start=1)
+    ])
 
 @app.get("/leaderboard/top-players", response_model=List[LeaderboardUser])
-def get_top_players(db: Session = Depends(get_db)):
-    users = db.query(User).order_by(User.best_score.desc()).limit(5).all()
-    return [
-        LeaderboardUser(
-            id=user.id,
-            username=user.username,
-            best_score=user.best_score,
-            profile_picture=f"/users/{user.id}/profile-picture/" if user.profile_picture else None
-        )
-        for user in users
-    ]
+def get_top_players(request: Request):
+    return conditional_json(request, board_etag(leaderboard, 5), lambda: [
+        to_leaderboard_user(entry, rank) for rank, entry in enumerate(leaderboard.top(5), start=1)
+    ])
+
+def get_board(period: str):
+    board = leaderboards.get(period)
+    if board is None:
+        raise HTTPException(status_code=404, detail=f"Unknown leaderboard, expected one of {sorted(leaderboards)}")
+    return board
+
+@app.get("/leaderboards/{period}", response_model=LeaderboardPage)
+def get_leaderboard_page(request: Request, period: str, cursor: Optional[str] = None, limit: int = 20):
+    board = get_board(period)
+    limit = max(1, min(limit, MAX_LEADERBOARD_PAGE))
+    key = decode_leaderboard_cursor(cursor)
+    return conditional_json(
+        request,
+        board_etag(board, cursor or "top", limit),
+        lambda: leaderboard_page(*board.page_after(key, limit), limit),
+    )
+
+@app.get("/leaderboards/{period}/friends", response_model=LeaderboardPage)
+def get_friends_leaderboard(
+    request: Request,
+    period: str,
+    cursor: Optional[str] = None,
+    limit: int = 20,
+    db: Session = Depends(get_db),
+    current_user: CurrentPrincipal = Depends(get_current_principal),
+):
+    board = get_board(period)
+    limit = max(1, min(limit, MAX_LEADERBOARD_PAGE))
+    members = get_friend_ids(db, current_user.id) | {current_user.id}
+    start, entries = friends_page(board, members, decode_leaderboard_cursor(cursor), limit)
+    page = leaderboard_page(start, entries, limit)
+    # Small enough to hash, and covers both ranking and friend list changes
+    etag = '"' + hashlib.sha1(dumps(page)).hexdigest() + '"'
+    return conditional_json(request, etag, lambda: page)
+
+@app.get("/leaderboard/rank/{user_id}", response_model=LeaderboardRank)
+def get_leaderboard_rank(user_id: int):
+    rank = leaderboard.rank_of(user_id)
+    if rank is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"user_id": user_id, "rank": rank, "total_players": len(leaderboard)}
+
+@app.get("/leaderboard/around/{user_id}", response_model=List[LeaderboardUser])
+def get_players_around(user_id: int, radius: int = 5):
+    rank = leaderboard.rank_of(user_id)
+    if rank is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    radius = max(0, min(radius, 50))
+    entries = leaderboard.around(user_id, radius)
+    first_rank = max(rank - radius, 1)
+    return FastJSONResponse([to_leaderboard_user(entry, first_rank + i) for i, entry in enumerate(entries)])
+
+@app.get("/users/{user_id}/scores", response_model=ScorePage)
+def get_user_scores(user_id: int, cursor: Optional[str] = None, limit: int = SCORES_PAGE_SIZE, db: Session = Depends(get_db)):
+    return get_score_page(db, user_id, cursor, limit)
+
+@app.get("/users/{user_id}/stats", response_model=UserStatsResponse)
+def get_user_stats_endpoint(user_id: int, db: Session = Depends(get_db)):
+    return get_user_stats(db, user_id)
+
+def store_scores(db: Session, entries):
+    if SCORE_WRITE_BEHIND:
+        score_buffer.add(entries)
+    else:
+        record_scores(db, entries)
+        db.commit()
+        invalidate_score_views(db, entries)
+    # best_score only ever rises, so the ranking can move before the rows are flushed
+    apply_to_leaderboard(entries)
 
 @app.post("/submit-score")
 def submit_score(data: ScoreData, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == data.user_id).first()
-    if not user:
+    entries, unknown = split_known_users(db, make_entries([data]))
+    if unknown:
         raise HTTPException(status_code=404, detail="User not found")
 
-    new_score = Score(user_id=data.user_id, score=data.score)
-    db.add(new_score)
+    store_scores(db, entries)
+    return {"status": "score recorded"}
 
-    if data.score > user.best_score:
-        user.best_score = data.score
+@app.post("/submit-scores")
+def submit_scores(batch: ScoreBatch, db: Session = Depends(get_db)):
+    if len(batch.scores) > MAX_SCORES_PER_REQUEST:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_SCORES_PER_REQUEST} scores per request")
 
-    db.commit()
-    return {"status": "score recorded"}
+    entries, unknown = split_known_users(db, make_entries(batch.scores))
+    store_scores(db, entries)
+    return {"status": "scores recorded", "recorded": len(entries), "unknown_user_ids": unknown}
 
-@app.post("/esp-data")
+# Game telemetry from the device: a batch of events as NDJSON, a JSON array or msgpack.
+# Events are queued and written in bulk; a full queue answers 429 with Retry-After.
+@app.post("/esp-data", status_code=202)
 async def receive_data(request: Request):
-    raw_data = await request.body()
-    print(f"Raw request body: {raw_data.decode('utf-8')}")
-    return {"status": "success"}
+    game_event_buffer.check_capacity()
+    body = await read_event_batch(request)
+    events = parse_game_events(request.headers.get("content-type"), body)
+    game_event_buffer.add(events)
+    return {"status": "accepted", "accepted": len(events)}
 
 @app.post("/send-login")
-async def send_login_data(user_id: int, username: str):
-    data = {"user_id": user_id, "username": username}
-    
-    try:
-        response = requests.post(ESP32_IP, json=data, timeout=5)
-        return {"status": "success", "esp_response": response.text}
-    except requests.exceptions.RequestException as e:
-        return {"status": "failed", "error": str(e)}
-    
-@app.post("/set-volume/")
-def set_volume(volume: int = Body(..., embed=True)):
-    import requests
+def send_login_data(user_id: int, username: str, db: Session = Depends(get_db)):
+    send_login_to_device(user_id, username, get_sound_profile(db, user_id).version)
+    return {"status": "queued"}
 
-    esp32_ip = "http://172.20.10.13:8000/set-volume"
+@app.post("/set-volume/")
+def set_volume(
+    volume: int = Body(..., embed=True, ge=0, le=100),
+    token: Optional[str] = Depends(optional_oauth2_scheme),
+    db: Session = Depends(get_db),
+):
+    # A bad token is rejected before the device is touched
+    user_id = validate_token(token)["user_id"] if token else None
+    if device_dispatcher.breaker.is_open:
+        raise HTTPException(status_code=503, detail="Simon device is unreachable")
+    send_volume_to_device(volume)
+    # Signed-in users keep the volume as their master sound setting for the next session
+    if user_id is not None:
+        sound_id = master_sound_id(db, user_id)
+        if sound_id is not None:
+            upsert_sound_settings(db, user_id, {sound_id: volume})
+            db.commit()
+            invalidate_sound_profile(user_id)
+    return {"message": f"Volume set to {volume}"}
+
+@app.get("/sound-settings", response_model=SoundSettingsResponse)
+def get_sound_settings(request: Request, db: Session = Depends(get_db), current_user: CurrentPrincipal = Depends(get_current_principal)):
+    profile = get_sound_profile(db, current_user.id)
+    return conditional_json(request, profile.etag, lambda: to_sound_settings_response(profile))
+
+@app.put("/sound-settings", response_model=SoundSettingsResponse)
+def update_sound_settings(
+    update: SoundSettingsUpdate,
+    db: Session = Depends(get_db),
+    current_user: CurrentPrincipal = Depends(get_current_principal),
+):
+    # Later entries for the same sound win
+    upsert_sound_settings(db, current_user.id, {setting.sound_id: setting.volume for setting in update.settings})
+    db.commit()
+    invalidate_sound_profile(current_user.id)
+    profile = get_sound_profile(db, current_user.id)
+    send_settings_version_to_device(current_user.id, profile.version)
+    return to_sound_settings_response(profile)
+
+# Compact settings for the Simon device, fetched at most once per session: the login
+# message carries the current version, and a matching If-None-Match gets a bodyless 304.
+@app.get("/device/sound-settings/{user_id}")
+def get_device_sound_settings(user_id: int, request: Request, db: Session = Depends(get_db)):
+    if leaderboard.get(user_id) is None and db.query(User.id).filter(User.id == user_id).scalar() is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    profile = get_sound_profile(db, user_id)
+    headers = {"ETag": profile.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, profile.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=profile.device_body, media_type="application/json", headers=headers)
+
+# Push channel: friend-request events for the user and leaderboard changes for everyone.
+# Browsers can't set headers on a WebSocket, so the token comes in the query string.
+@app.websocket("/ws")
+async def events_socket(websocket: WebSocket, token: str):
     try:
-        response = requests.post(esp32_ip, json={"volume": volume})
-        response.raise_for_status()
-        return {"message": f"Volume set to {volume}"}
-    except requests.exceptions.RequestException as e:
-        raise HTTPException(status_code=500, detail=f"Failed to send volume to ESP32: {e}")
+        payload = validate_token(token)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    subscription = event_hub.subscribe([user_topic(payload["user_id"]), LEADERBOARD_TOPIC])
+
+    async def forward():
+        while True:
+            await websocket.send_json(await subscription.queue.get())
+
+    sender = asyncio.create_task(forward())
+    try:
+        # Clients don't send anything; receiving only detects the disconnect
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        event_hub.unsubscribe(subscription)
+
+@app.get("/me/export")
+def export_my_data(principal: CurrentPrincipal = Depends(get_current_principal)):
+    # Profile, stats, settings, friends and full score history as one NDJSON stream
+    return StreamingResponse(
+        stream_user_export(principal.id),
+        media_type=EXPORT_FORMATS["ndjson"],
+        headers={"Content-Disposition": f'attachment; filename="user-{principal.id}.ndjson"'},
+    )
+
+@app.get("/admin/export/{table}", dependencies=[Depends(require_admin)])
+def export_table(table: str, format: str = "ndjson"):
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail=f"Unknown table, expected one of {sorted(EXPORT_TABLES)}")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format, expected one of {sorted(EXPORT_FORMATS)}")
+    return StreamingResponse(
+        stream_export(table, format),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
+
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+app.add_middleware(UploadLimitMiddleware, paths=["/users/upload-profile-picture/"])
+
+# Read endpoints served from the response cache; mutations invalidate them by tag
+app.add_middleware(ResponseCacheMiddleware, rules=[
+    CacheRule(r"/user/(?P<user_id>\d+)", ["user:{user_id}", "scores:{user_id}", "friends:{user_id}", "friends:{viewer}"], ttl=30, per_user=True),
+    CacheRule(r"/users/(?P<user_id>\d+)/stats", ["scores:{user_id}"], ttl=60),
+    CacheRule(r"/users/(?P<user_id>\d+)/scores", ["scores:{user_id}"], ttl=60),
+    CacheRule(r"/users/(?P<user_id>\d+)/mutual-friends", ["friends:{user_id}", "friends:{viewer}"], ttl=60, per_user=True),
+    CacheRule(r"/friends/", ["friends:{viewer}"], ttl=60, per_user=True),
+    CacheRule(r"/leaderboard/(?P<view>rank|around)/(?P<user_id>\d+)", [LEADERBOARD_TAG], ttl=5),
+])
+
+# Outside the cache, so cache hits are timed as well
+app.add_middleware(InstrumentationMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -493,4 +755,5 @@ app.add_middleware(
 )
 
 if __name__ == "__main__":
+    # Single process for development; serve.py runs the production workers
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,215 @@
+import argparse
+import sys
+
+from sqlalchemy import inspect, text
+
+from blobs import blob_store
+from database import Base, SessionLocal, dialect_insert, engine
+from images import render_variants
+from archive import SCORE_ARCHIVE_DIR, SCORE_HOT_MONTHS, archive_cold_months
+from models import Friendship, Score, ScoreArchiveChunk, ScoreRollup, Sound, User, UserStats
+from services import thumbnail_variant
+from sounds import MASTER_SOUND
+from stats import rebuild_stats
+from transfer import FORMATS, IMPORT_BATCH_SIZE, TABLES, import_records, read_records, stream_export
+
+
+def migrate_blobs(batch_size: int):
+    # Add the reference column on databases created before the blob store existed;
+    # checked first because SQLite has no ADD COLUMN IF NOT EXISTS
+    if "profile_picture_id" not in {column["name"] for column in inspect(engine).get_columns("users")}:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE users ADD COLUMN profile_picture_id VARCHAR(64)"))
+
+    moved = 0
+    last_id = 0
+    db = SessionLocal()
+    try:
+        while True:
+            # Keyset batches keep each round trip bounded regardless of table size
+            rows = (
+                db.query(User.id, User.profile_picture)
+                .filter(User.id > last_id, User.profile_picture.isnot(None), User.profile_picture_id.is_(None))
+                .order_by(User.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+
+            for user_id, picture in rows:
+                picture_id = blob_store.put(picture)
+                try:
+                    for size, data in render_variants(blob_store.path_for(picture_id)).items():
+                        if size != "full":
+                            blob_store.put_variant(picture_id, thumbnail_variant(size), data)
+                except Exception as e:
+                    # Keep the original; the endpoint falls back to it without thumbnails
+                    print(f"Could not build thumbnails for user {user_id}: {e}")
+                db.query(User).filter(User.id == user_id).update(
+                    {User.profile_picture_id: picture_id, User.profile_picture: None},
+                    synchronize_session=False,
+                )
+            db.commit()
+            moved += len(rows)
+            last_id = rows[-1][0]
+            print(f"Moved {moved} profile pictures to {blob_store.root}")
+    finally:
+        db.close()
+    print(f"Done, {moved} profile pictures migrated")
+
+
+def backfill_friendships():
+    Friendship.__table__.create(bind=engine, checkfirst=True)
+    # Both directions of every accepted request; reruns are no-ops
+    with engine.begin() as conn:
+        result = conn.execute(text("""
+            INSERT INTO friendships (user_id, friend_id)
+            SELECT requester_id, receiver_id FROM friend_requests WHERE status = 'accepted'
+            UNION
+            SELECT receiver_id, requester_id FROM friend_requests WHERE status = 'accepted'
+            ON CONFLICT DO NOTHING
+        """))
+    print(f"Inserted {result.rowcount} friendship rows")
+
+
+def rebuild_user_stats(batch_size: int):
+    # Tables and the history index may predate this command on existing databases
+    for table in (UserStats.__table__, ScoreRollup.__table__, ScoreArchiveChunk.__table__):
+        table.create(bind=engine, checkfirst=True)
+    for index in Score.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+    db = SessionLocal()
+    try:
+        processed = rebuild_stats(db, batch_size)
+    finally:
+        db.close()
+    print(f"Rebuilt stats and rollups from {processed} scores")
+
+
+def archive_scores(keep_months: int, batch_size: int):
+    ScoreArchiveChunk.__table__.create(bind=engine, checkfirst=True)
+    db = SessionLocal()
+    try:
+        archived = 0
+        for month, moved in archive_cold_months(db, keep_months, batch_size):
+            archived += moved
+            print(f"Archived {moved} scores from {month:%Y-%m}")
+    finally:
+        db.close()
+    print(f"Done, {archived} scores moved to {SCORE_ARCHIVE_DIR}")
+
+
+def export_table(table: str, fmt: str, output: str):
+    out = sys.stdout.buffer if output == "-" else open(output, "wb")
+    try:
+        for chunk in stream_export(table, fmt):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+
+def import_table(table: str, path: str, fmt: str, batch_size: int):
+    fmt = fmt or ("csv" if path.endswith(".csv") else "ndjson")
+    db = SessionLocal()
+    try:
+        with open(path, newline="" if fmt == "csv" else None) as f:
+            read, inserted = import_records(db, table, read_records(f, fmt), batch_size)
+        print(f"Read {read} {table} rows, inserted {inserted}")
+        if table == "scores" and inserted:
+            # Aggregates are rebuilt in time order rather than folded in file order
+            print(f"Rebuilt stats and rollups from {rebuild_stats(db)} scores")
+    finally:
+        db.close()
+    # The API workers load users and leaderboards at startup
+    print("Restart the API workers to serve the imported data")
+
+
+def migrate():
+    # The API workers never create tables, so run this before starting them on a new or upgraded database
+    Base.metadata.create_all(bind=engine)
+    print("Tables are up to date")
+    dedupe_sound_settings()
+    create_indexes()
+    db = SessionLocal()
+    try:
+        # /set-volume/ stores the device volume as the setting of this sound
+        db.execute(dialect_insert(db, Sound).values(name=MASTER_SOUND).on_conflict_do_nothing(index_elements=[Sound.name]))
+        db.commit()
+    finally:
+        db.close()
+
+
+def dedupe_sound_settings():
+    # The unique (user_id, sound_id) index can't be built while duplicates exist; keep the newest row
+    with engine.begin() as conn:
+        result = conn.execute(text("""
+            DELETE FROM sound_settings
+            WHERE id NOT IN (SELECT MAX(id) FROM sound_settings GROUP BY user_id, sound_id)
+        """))
+    if result.rowcount:
+        print(f"Removed {result.rowcount} duplicate sound settings")
+
+
+def create_indexes():
+    # create_all skips tables that already exist, so indexes added later need this on old databases
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    print("Indexes are up to date")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SimonWebby maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("migrate", help="Create missing tables and indexes")
+
+    blobs = commands.add_parser("migrate-blobs", help="Move profile pictures out of the users table into the blob store")
+    blobs.add_argument("--batch-size", type=int, default=100)
+
+    commands.add_parser("backfill-friendships", help="Populate the friendships table from accepted friend requests")
+
+    stats = commands.add_parser("rebuild-stats", help="Recompute per-user aggregates and rollups from the scores table")
+    stats.add_argument("--batch-size", type=int, default=5000)
+
+    commands.add_parser("create-indexes", help="Create indexes missing from existing tables")
+
+    export = commands.add_parser("export", help="Stream a table to NDJSON or CSV")
+    export.add_argument("table", choices=sorted(TABLES))
+    export.add_argument("--format", choices=sorted(FORMATS), default="ndjson")
+    export.add_argument("--output", default="-", help="File to write, or - for stdout")
+
+    load = commands.add_parser("import", help="Bulk insert a table from an NDJSON or CSV export; passwords must already be hashed")
+    load.add_argument("table", choices=sorted(TABLES))
+    load.add_argument("path")
+    load.add_argument("--format", choices=sorted(FORMATS), help="Defaults to csv for .csv files, ndjson otherwise")
+    load.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+
+    archive = commands.add_parser("archive-scores", help="Move scores older than the hot months into compressed monthly archive files")
+    archive.add_argument("--keep-months", type=int, default=SCORE_HOT_MONTHS)
+    archive.add_argument("--batch-size", type=int, default=5000)
+
+    args = parser.parse_args()
+    if args.command == "migrate":
+        migrate()
+    elif args.command == "migrate-blobs":
+        migrate_blobs(args.batch_size)
+    elif args.command == "backfill-friendships":
+        backfill_friendships()
+    elif args.command == "rebuild-stats":
+        rebuild_user_stats(args.batch_size)
+    elif args.command == "create-indexes":
+        create_indexes()
+    elif args.command == "export":
+        export_table(args.table, args.format, args.output)
+    elif args.command == "import":
+        import_table(args.table, args.path, args.format, args.batch_size)
+    elif args.command == "archive-scores":
+        archive_scores(args.keep_months, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 import enum
-from sqlalchemy import Boolean, Column, Enum, Integer, LargeBinary, String, ForeignKey, Float, DateTime
-from sqlalchemy.orm import relationship
+from sqlalchemy import BigInteger, Boolean, Column, Date, Enum, Index, Integer, JSON, LargeBinary, String, ForeignKey, Float, DateTime
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.sql import func
 from database import Base
 
@@ -15,7 +15,10 @@ class User(Base):
     email = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String, nullable=False)
     best_score = Column(Integer, default=0)
-    profile_picture = Column(LargeBinary, nullable=True)
+    # Legacy inline bytes, only read by the blob migration
+    profile_picture = deferred(Column(LargeBinary, nullable=True))
+    # SHA-256 of the picture in the blob store
+    profile_picture_id = Column(String(64), nullable=True)
     sound_settings = relationship("SoundSetting", back_populates="user")
     scores = relationship("Score", back_populates="user")
     sent_friend_requests = relationship(
@@ -36,6 +39,26 @@ class Score(Base):
     score = Column(Integer, nullable=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     user = relationship("User", back_populates="scores")
+    __table_args__ = (
+        # Per-user history in time order, used by paging and stats rebuilds
+        Index('ix_scores_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+class ScoreArchiveChunk(Base):
+    # One user's scores for one month, moved out of the scores table into a gzip file
+    __tablename__ = 'score_archive_chunks'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    month = Column(Date, nullable=False)
+    # File name under SCORE_ARCHIVE_DIR and the gzip member holding this user's rows
+    path = Column(String, nullable=False)
+    byte_offset = Column(BigInteger, nullable=False)
+    byte_length = Column(Integer, nullable=False)
+    games = Column(Integer, nullable=False)
+    best_score = Column(Integer, nullable=False)
+    __table_args__ = (
+        Index('ix_score_archive_chunks_user_id_month', 'user_id', 'month'),
+    )
 
 class Sound(Base):
     __tablename__ = 'sounds'
@@ -51,6 +74,10 @@ class SoundSetting(Base):
     volume = Column(Float, nullable=False, default=75)  
     user = relationship("User", back_populates="sound_settings")
     sound = relationship("Sound", back_populates="sound_settings")
+    # One row per user and sound; also the conflict target of the settings upsert
+    __table_args__ = (
+        Index('uq_sound_settings_user_id_sound_id', 'user_id', 'sound_id', unique=True),
+    )
 
 class FriendRequest(Base):
     __tablename__ = 'friend_requests'
@@ -60,4 +87,64 @@ class FriendRequest(Base):
     status = Column(Enum(FriendRequestStatus), default=FriendRequestStatus.pending, nullable=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     requester = relationship("User", back_populates="sent_friend_requests", foreign_keys=[requester_id])
-    receiver = relationship("User", back_populates="received_friend_requests", foreign_keys=[receiver_id])
\ No newline at end of file
+    receiver = relationship("User", back_populates="received_friend_requests", foreign_keys=[receiver_id])
+    # Inbox lookups filter on one side and the status, then page newest-first by id
+    __table_args__ = (
+        Index('ix_friend_requests_receiver_id_status', 'receiver_id', 'status', 'id'),
+        Index('ix_friend_requests_requester_id_status', 'requester_id', 'status', 'id'),
+    )
+
+class Friendship(Base):
+    # Symmetric adjacency list: one row per direction, so "friends of X" is a primary-key range scan
+    __tablename__ = 'friendships'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    friend_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    __table_args__ = (
+        Index('ix_friendships_friend_id_user_id', 'friend_id', 'user_id'),
+    )
+
+class UserStats(Base):
+    # Running per-user aggregates, updated as scores are recorded
+    __tablename__ = 'user_stats'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    games_played = Column(Integer, nullable=False, default=0)
+    total_score = Column(BigInteger, nullable=False, default=0)
+    best_score = Column(Integer, nullable=False, default=0)
+    # Consecutive UTC days with at least one game
+    current_streak = Column(Integer, nullable=False, default=0)
+    longest_streak = Column(Integer, nullable=False, default=0)
+    last_played_on = Column(Date, nullable=True)
+    # Sparse {score: count} histogram, used for percentiles
+    histogram = Column(JSON, nullable=False, default=dict)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class ScoreRollup(Base):
+    # Per-user totals for each day and week (weeks start on Monday)
+    __tablename__ = 'score_rollups'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    period = Column(String(8), primary_key=True)
+    period_start = Column(Date, primary_key=True)
+    games = Column(Integer, nullable=False, default=0)
+    total_score = Column(BigInteger, nullable=False, default=0)
+    best_score = Column(Integer, nullable=False, default=0)
+
+class GameEvent(Base):
+    # Append-only device telemetry: rounds, button presses and game ends
+    __tablename__ = 'game_events'
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    # Not a foreign key: events are stored even for users the device got wrong
+    user_id = Column(Integer, nullable=True)
+    game_id = Column(String(64), nullable=True)
+    type = Column(String(16), nullable=False)
+    round = Column(Integer, nullable=True)
+    sequence_length = Column(Integer, nullable=True)
+    reaction_ms = Column(Integer, nullable=True)
+    correct = Column(Boolean, nullable=True)
+    errors = Column(Integer, nullable=True)
+    # Device clock in milliseconds, only meaningful within one game
+    device_ms = Column(BigInteger, nullable=True)
+    received_at = Column(DateTime(timezone=True), nullable=False)
+    __table_args__ = (
+        Index('ix_game_events_user_id_received_at', 'user_id', 'received_at'),
+    )
@@ -0,0 +1,140 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+from passlib.hash import bcrypt
+
+from metrics import registry
+from shared_state import shared_state
+
+# bcrypt cost; hashes made with a different cost are upgraded on the next successful login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", os.cpu_count() or 2))
+# Hash/verify jobs allowed in flight (running plus queued) before new ones are turned away
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", PASSWORD_WORKERS * 4))
+
+LOGIN_WINDOW_SECONDS = int(os.getenv("LOGIN_WINDOW_SECONDS", 60))
+LOGIN_ATTEMPTS_PER_IP = int(os.getenv("LOGIN_ATTEMPTS_PER_IP", 30))
+LOGIN_ATTEMPTS_PER_ACCOUNT = int(os.getenv("LOGIN_ATTEMPTS_PER_ACCOUNT", 10))
+
+password_jobs = registry.counter("password_jobs_total", "Password hash/verify jobs by operation and outcome")
+
+
+# Worker functions run in the process pool, so they stay at module level to be picklable
+
+def _hash_password(password: str, rounds: int) -> str:
+    return bcrypt.using(rounds=rounds).hash(password)
+
+
+def _verify_password(password: str, hashed: str, rounds: int) -> Tuple[bool, Optional[str]]:
+    hasher = bcrypt.using(rounds=rounds)
+    if not hasher.verify(password, hashed):
+        return False, None
+    # Rehash while the plaintext is at hand if the stored cost is outdated
+    return True, hasher.hash(password) if hasher.needs_update(hashed) else None
+
+
+class PasswordHasher:
+    """Runs bcrypt in a dedicated process pool behind a bounded admission gate."""
+
+    def __init__(self, workers: int, limit: int, rounds: int):
+        self.workers = workers
+        self.rounds = rounds
+        self._slots = threading.BoundedSemaphore(limit)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def _submit(self, operation: str, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            password_jobs.inc(operation=operation, outcome="rejected")
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy, please try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        try:
+            future = self._executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        password_jobs.inc(operation=operation, outcome="admitted")
+        return future
+
+    def hash(self, password: str) -> str:
+        return self._submit("hash", _hash_password, password, self.rounds).result()
+
+    def verify(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """Return (matches, new_hash); new_hash is set when the stored hash should be replaced."""
+        return self._submit("verify", _verify_password, password, hashed, self.rounds).result()
+
+    async def hash_async(self, password: str) -> str:
+        return await asyncio.wrap_future(self._submit("hash", _hash_password, password, self.rounds))
+
+    async def verify_async(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        return await asyncio.wrap_future(self._submit("verify", _verify_password, password, hashed, self.rounds))
+
+
+class LoginThrottle:
+    """Fixed-window attempt counters per client IP and per account, shared by all workers."""
+
+    def __init__(self, window: int):
+        self.window = window
+
+    def _window_key(self, key: str) -> Tuple[str, int]:
+        now = int(time.time())
+        window_start = now - now % self.window
+        return f"login:{key}:{window_start}", window_start + self.window - now
+
+    def _hit(self, key: str) -> Tuple[int, int]:
+        counter, retry_after = self._window_key(key)
+        return shared_state.incr(counter, self.window), retry_after
+
+    def check(self, key: str, limit: int):
+        count, retry_after = self._hit(key)
+        if count > limit:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many login attempts, please try again later",
+                headers={"Retry-After": str(max(retry_after, 1))},
+            )
+
+    def reset(self, key: str):
+        shared_state.delete(self._window_key(key)[0])
+
+    def check_login(self, client_ip: Optional[str], account: str):
+        if client_ip:
+            self.check(f"ip:{client_ip}", LOGIN_ATTEMPTS_PER_IP)
+        self.check(f"account:{account.lower()}", LOGIN_ATTEMPTS_PER_ACCOUNT)
+
+    def login_succeeded(self, account: str):
+        self.reset(f"account:{account.lower()}")
+
+    # With the Redis backend every counter is a network round trip, so async handlers
+    # run them on a thread rather than blocking the event loop
+
+    async def check_login_async(self, client_ip: Optional[str], account: str):
+        await asyncio.to_thread(self.check_login, client_ip, account)
+
+    async def login_succeeded_async(self, account: str):
+        await asyncio.to_thread(self.login_succeeded, account)
+
+
+password_hasher = PasswordHasher(PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT, BCRYPT_ROUNDS)
+login_throttle = LoginThrottle(LOGIN_WINDOW_SECONDS)
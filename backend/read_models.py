@@ -0,0 +1,98 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, List, Optional
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    # Optional; responses fall back to the standard JSON encoder
+    orjson = None
+
+# Response shapes for the hot read endpoints. Rows from column-only selects map
+# straight onto these slotted dataclasses, which orjson serializes natively, so
+# these paths skip ORM hydration, response_model validation and jsonable_encoder.
+# The Pydantic schemas with the same fields still document the endpoints.
+
+
+@dataclass(slots=True)
+class LeaderboardView:
+    id: int
+    username: str
+    best_score: int
+    profile_picture: Optional[str]
+    rank: Optional[int]
+
+
+@dataclass(slots=True)
+class FriendView:
+    id: int
+    username: str
+    profile_picture: Optional[str]
+    best_score: int
+
+
+@dataclass(slots=True)
+class FriendContactView:
+    id: int
+    username: str
+    email: str
+    profile_picture: Optional[str]
+
+
+@dataclass(slots=True)
+class ScoreView:
+    score: int
+    timestamp: datetime
+
+
+@dataclass(slots=True)
+class SoundSettingView:
+    sound_id: int
+    sound: str
+    volume: float
+
+
+@dataclass(slots=True)
+class ProfileView:
+    id: int
+    username: str
+    email: str
+    best_score: int
+    profile_picture: Optional[str]
+    sent_friend_requests: List[dict]
+    received_friend_requests: List[dict]
+    friends: List[FriendView]
+    sound_settings: List[SoundSettingView]
+    scores: List[ScoreView]
+    games_played: int
+    average_score: Optional[float]
+    is_friend: Optional[bool]
+
+
+@dataclass(slots=True)
+class FriendRequestView:
+    id: int
+    requester_id: int
+    requester_username: str
+    requester_profile_picture: Optional[str]
+    receiver_id: int
+    receiver_username: str
+    receiver_profile_picture: Optional[str]
+    status: str
+    timestamp: datetime
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return JSONResponse(content=jsonable_encoder(content)).body
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response for read models, dicts and lists of them, encoded with orjson when installed."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
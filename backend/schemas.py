@@ -1,7 +1,7 @@
 from enum import Enum
 from typing import Optional, List, Dict, Any
-from pydantic import BaseModel, EmailStr
-from datetime import datetime
+from pydantic import BaseModel, EmailStr, Field
+from datetime import date, datetime
 
 # Schema for user registration input
 class UserCreate(BaseModel):
@@ -49,7 +49,10 @@ class FriendRequestResponse(BaseModel):
     id: int
     requester_id: int
     requester_username: str
+    requester_profile_picture: Optional[str] = None
     receiver_id: int
+    receiver_username: Optional[str] = None
+    receiver_profile_picture: Optional[str] = None
     status: str
     timestamp: datetime
 
@@ -89,6 +92,8 @@ class UserValues(BaseModel):
     friends: List[FriendResponse]
     sound_settings: List[dict] = []
     scores: List[ScoreResponse] = []
+    games_played: int = 0
+    average_score: Optional[float] = None
     is_friend: Optional[bool] = None
 
     class Config:
@@ -100,16 +105,115 @@ class Data(BaseModel):
 class FriendRequestPayload(BaseModel):
     receiver_id: int
 
+class FriendRequestPage(BaseModel):
+    requests: List[FriendRequestResponse]
+    next_cursor: Optional[str] = None
+
+class FriendRequestBulkAction(str, Enum):
+    accept = "accept"
+    deny = "deny"
+    cancel = "cancel"
+
+class FriendRequestBulk(BaseModel):
+    action: FriendRequestBulkAction
+    ids: List[int]
+
+class FriendRequestBulkResult(BaseModel):
+    processed: List[int]
+    skipped: List[int]
+
 class ScoreData(BaseModel):
     user_id: int
     score: int
 
+class ScoreBatch(BaseModel):
+    scores: List[ScoreData]
+
+class GameEventType(str, Enum):
+    press = "press"
+    round = "round"
+    game_over = "game_over"
+
+# Largest value of the Integer columns the events are stored in
+INT32_MAX = 2**31 - 1
+
+class GameEventData(BaseModel):
+    # One line of an /esp-data batch; unknown keys are ignored so older servers accept newer firmware
+    type: GameEventType
+    user_id: Optional[int] = Field(default=None, ge=-INT32_MAX - 1, le=INT32_MAX)
+    game_id: Optional[str] = Field(default=None, max_length=64)
+    round: Optional[int] = Field(default=None, ge=0, le=INT32_MAX)
+    sequence_length: Optional[int] = Field(default=None, ge=0, le=INT32_MAX)
+    reaction_ms: Optional[int] = Field(default=None, ge=0, le=INT32_MAX)
+    correct: Optional[bool] = None
+    errors: Optional[int] = Field(default=None, ge=0, le=INT32_MAX)
+    device_ms: Optional[int] = Field(default=None, ge=0, le=2**63 - 1)
+
+class ScorePage(BaseModel):
+    scores: List[ScoreResponse]
+    next_cursor: Optional[str] = None
+
+class ScoreRollupResponse(BaseModel):
+    period_start: date
+    games: int
+    total_score: int
+    best_score: int
+    average_score: Optional[float] = None
+
+class UserStatsResponse(BaseModel):
+    user_id: int
+    games_played: int
+    best_score: int
+    average_score: Optional[float] = None
+    current_streak: int
+    longest_streak: int
+    last_played_on: Optional[date] = None
+    percentiles: Dict[str, Optional[int]]
+    daily: List[ScoreRollupResponse] = []
+    weekly: List[ScoreRollupResponse] = []
+
 class LeaderboardUser(BaseModel):
     id: int
     username: str
     best_score: int
     profile_picture: Optional[str] = None
+    rank: Optional[int] = None
 
     class Config:
         from_attributes = True
 
+class LeaderboardPage(BaseModel):
+    entries: List[LeaderboardUser]
+    next_cursor: Optional[str] = None
+
+class LeaderboardRank(BaseModel):
+    user_id: int
+    rank: int
+    total_players: int
+
+class UserSearchResult(BaseModel):
+    id: int
+    username: str
+    profile_picture: Optional[str] = None
+    # self, friend, pending_sent, pending_received or none
+    status: str
+
+class UserSearchPage(BaseModel):
+    results: List[UserSearchResult]
+    next_offset: Optional[int] = None
+
+class SoundSettingValue(BaseModel):
+    sound_id: int
+    volume: float = Field(ge=0, le=100)
+
+class SoundSettingsUpdate(BaseModel):
+    settings: List[SoundSettingValue]
+
+class SoundSettingResponse(BaseModel):
+    sound_id: int
+    sound: str
+    volume: float
+
+class SoundSettingsResponse(BaseModel):
+    version: str
+    settings: List[SoundSettingResponse]
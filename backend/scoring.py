@@ -0,0 +1,289 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Iterable, List, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import Integer, bindparam, column, func, insert, update, values
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import Session
+
+from cache import LEADERBOARD_TAG, friends_tag, invalidate_tags, response_cache, scores_tag
+from database import SessionLocal, env_flag
+from events import publish_leaderboard_changes, publish_scores
+from friends import get_friend_ids
+from leaderboard import boards, leaderboard, record_leaderboard_scores
+from metrics import registry
+from models import Score, User
+from shared_state import SCORES_CHANNEL, shared_state
+from stats import apply_scores
+
+logger = logging.getLogger(__name__)
+
+# Buffer scores in memory and write them in batches instead of committing per request
+SCORE_WRITE_BEHIND = env_flag("SCORE_WRITE_BEHIND", False)
+SCORE_FLUSH_INTERVAL_MS = int(os.getenv("SCORE_FLUSH_INTERVAL_MS", 200))
+SCORE_FLUSH_BATCH = int(os.getenv("SCORE_FLUSH_BATCH", 1000))
+SCORE_BUFFER_LIMIT = int(os.getenv("SCORE_BUFFER_LIMIT", 50000))
+MAX_SCORES_PER_REQUEST = int(os.getenv("MAX_SCORES_PER_REQUEST", 1000))
+# Failed flushes of the same batch before it is written entry by entry to find the bad ones
+SCORE_FLUSH_MAX_ATTEMPTS = int(os.getenv("SCORE_FLUSH_MAX_ATTEMPTS", 5))
+
+scores_flushed = registry.counter("scores_flushed_total", "Scores written to the database")
+score_flushes = registry.histogram("score_flush_seconds", "Time spent writing one batch of scores")
+scores_dead_lettered = registry.counter("scores_dead_lettered_total", "Buffered scores dropped because they can't be written")
+
+# (user_id, score, timestamp)
+ScoreEntry = Tuple[int, int, datetime]
+
+
+def make_entries(scores: Iterable) -> List[ScoreEntry]:
+    now = datetime.now(timezone.utc)
+    return [(data.user_id, data.score, now) for data in scores]
+
+
+def split_known_users(db: Session, entries: List[ScoreEntry]):
+    """Separate entries for existing users from ones for unknown ids.
+
+    Users are validated against the in-memory leaderboard; only ids it hasn't seen
+    (e.g. registered through another worker) are looked up, and then cached there.
+    """
+    unknown = {entry[0] for entry in entries if leaderboard.get(entry[0]) is None}
+    if unknown:
+        rows = (
+            db.query(User.id, User.username, User.best_score, User.profile_picture_id)
+            .filter(User.id.in_(unknown))
+            .all()
+        )
+        for user_id, username, best_score, picture_id in rows:
+            leaderboard.upsert(user_id, username, best_score, picture_id)
+            unknown.discard(user_id)
+    known = [entry for entry in entries if entry[0] not in unknown]
+    return known, sorted(unknown)
+
+
+def score_insert_statement(entries: List[ScoreEntry]):
+    # One multi-row INSERT ... VALUES for the whole batch
+    return insert(Score).values(
+        [{"user_id": user_id, "score": score, "timestamp": timestamp} for user_id, score, timestamp in entries]
+    )
+
+
+def best_score_statement(entries: List[ScoreEntry]):
+    """Raise best_score for every user in the batch in one UPDATE, never lowering it.
+
+    GREATEST() runs in the database, so concurrent batches can't overwrite a higher score.
+    """
+    best = {}
+    for user_id, score, _ in entries:
+        best[user_id] = max(score, best.get(user_id, score))
+    batch = values(column("user_id", Integer), column("best", Integer), name="batch_best").data(list(best.items()))
+    return (
+        update(User)
+        .where(User.id == batch.c.user_id)
+        .values(best_score=func.greatest(func.coalesce(User.best_score, 0), batch.c.best))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def update_best_scores(db: Session, entries: List[ScoreEntry]):
+    if db.get_bind().dialect.name != "sqlite":
+        db.execute(best_score_statement(entries))
+        return
+    # SQLite can't name the columns of a VALUES list, so run the same GREATEST update as an executemany
+    best = {}
+    for user_id, score, _ in entries:
+        best[user_id] = max(score, best.get(user_id, score))
+    users = User.__table__
+    db.execute(
+        users.update()
+        .where(users.c.id == bindparam("batch_user_id"))
+        .values(best_score=func.greatest(func.coalesce(users.c.best_score, 0), bindparam("batch_best"))),
+        [{"batch_user_id": user_id, "batch_best": score} for user_id, score in best.items()],
+    )
+
+
+def record_scores(db: Session, entries: List[ScoreEntry]):
+    """Stage a batch of scores; the caller commits."""
+    if not entries:
+        return
+    db.execute(score_insert_statement(entries))
+    update_best_scores(db, entries)
+    apply_scores(db, entries)
+
+
+def raised_best_scores(entries: List[ScoreEntry]) -> List[int]:
+    # The board takes the scores just before (write-behind) or just after the rows commit,
+    # so a score at least as high as the board's best may have raised the stored one
+    best = {}
+    for user_id, score, _ in entries:
+        best[user_id] = max(score, best.get(user_id, score))
+    raised = []
+    for user_id, score in best.items():
+        entry = leaderboard.get(user_id)
+        if entry is None or score >= entry.best_score:
+            raised.append(user_id)
+    return raised
+
+
+def invalidate_score_views(db: Session, entries: List[ScoreEntry]):
+    # Call once the rows are committed, or cached pages could be refilled from the old state
+    tags = {scores_tag(user_id) for user_id, _, _ in entries}
+    for user_id in raised_best_scores(entries):
+        # Friends' profiles and friend lists show this user's best score
+        tags.update(friends_tag(friend_id) for friend_id in get_friend_ids(db, user_id))
+    invalidate_tags(tags)
+
+
+def apply_to_leaderboard(entries: List[ScoreEntry]):
+    """Update the in-memory boards and push the resulting events to subscribers."""
+    ranks_before = {user_id: leaderboard.rank_of(user_id) for user_id, _, _ in entries}
+    changed = record_leaderboard_scores(entries)
+    shared_state.broadcast(SCORES_CHANNEL, [[user_id, score, timestamp.isoformat()] for user_id, score, timestamp in entries])
+    if changed:
+        invalidate_tags([LEADERBOARD_TAG])
+    publish_scores(ranks_before, leaderboard.rank_of, entries)
+    publish_leaderboard_changes(changed, {name: boards[name].version for name in changed})
+    return changed
+
+
+def apply_broadcast_scores(message):
+    # Another worker accepted these scores; it already published the events
+    entries = [(user_id, score, datetime.fromisoformat(timestamp)) for user_id, score, timestamp in message]
+    if record_leaderboard_scores(entries):
+        response_cache.invalidate_tags([LEADERBOARD_TAG])
+
+
+shared_state.subscribe(SCORES_CHANNEL, apply_broadcast_scores)
+
+
+def is_transient(error: Exception) -> bool:
+    # Lost connections, timeouts and lock waits; other errors fail the same way on every retry
+    return isinstance(error, OperationalError) or (isinstance(error, DBAPIError) and error.connection_invalidated)
+
+
+class ScoreBuffer:
+    """Write-behind buffer flushed by a background thread every interval or full batch."""
+
+    def __init__(self, interval_ms: int, batch_size: int, limit: int):
+        self.interval = interval_ms / 1000
+        self.batch_size = batch_size
+        self.limit = limit
+        self._entries = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        # Consecutive failed flushes of the batch at the front of the queue
+        self._attempts = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="score-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def add(self, entries: List[ScoreEntry]):
+        with self._cond:
+            if len(self._entries) + len(entries) > self.limit:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Score buffer is full, please retry",
+                    headers={"Retry-After": "1"},
+                )
+            self._entries.extend(entries)
+            if len(self._entries) >= self.batch_size:
+                self._cond.notify()
+
+    def _take(self) -> List[ScoreEntry]:
+        batch = []
+        while self._entries and len(batch) < self.batch_size:
+            batch.append(self._entries.popleft())
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._entries) < self.batch_size:
+                    self._cond.wait(self.interval)
+                batch = self._take()
+                stopping = self._stopping
+            if batch:
+                self.flush(batch)
+            elif stopping:
+                return
+
+    def _requeue(self, entries: List[ScoreEntry]):
+        with self._cond:
+            # Back at the front so ordering is kept
+            self._entries.extendleft(reversed(entries))
+
+    def _write(self, entries: List[ScoreEntry]):
+        db = SessionLocal()
+        try:
+            record_scores(db, entries)
+            db.commit()
+        except Exception:
+            db.rollback()
+            db.close()
+            raise
+        try:
+            invalidate_score_views(db, entries)
+        except Exception:
+            # The rows are committed; failing the write now would store them twice
+            logger.exception("Failed to invalidate cached views for %d scores", len(entries))
+        finally:
+            db.close()
+        scores_flushed.inc(len(entries))
+
+    def _write_each(self, batch: List[ScoreEntry]):
+        """Write entries one at a time, dropping the ones the database rejects."""
+        for i, entry in enumerate(batch):
+            try:
+                self._write([entry])
+            except Exception as error:
+                if is_transient(error):
+                    # The database is failing, not this entry; the rest waits for the next flush
+                    logger.warning("Database unavailable, requeueing %d scores", len(batch) - i)
+                    self._requeue(batch[i:])
+                    time.sleep(self.interval)
+                    return
+                scores_dead_lettered.inc()
+                logger.error("Dropping score %r that can't be written: %s", entry, error)
+
+    def flush(self, batch: List[ScoreEntry]):
+        start = time.perf_counter()
+        try:
+            self._write(batch)
+            self._attempts = 0
+        except Exception as error:
+            if self._stopping:
+                logger.exception("Failed to flush %d scores during shutdown, dropping them", len(batch))
+                return
+            self._attempts += 1
+            if is_transient(error) and self._attempts < SCORE_FLUSH_MAX_ATTEMPTS:
+                logger.exception("Failed to flush %d scores, will retry", len(batch))
+                self._requeue(batch)
+                time.sleep(self.interval)
+                return
+            # A bad entry would fail the batch forever and fill the buffer; isolate it instead
+            logger.exception("Failed to flush %d scores, writing them one by one", len(batch))
+            self._attempts = 0
+            self._write_each(batch)
+        finally:
+            score_flushes.observe(time.perf_counter() - start)
+
+
+score_buffer = ScoreBuffer(SCORE_FLUSH_INTERVAL_MS, SCORE_FLUSH_BATCH, SCORE_BUFFER_LIMIT)
@@ -0,0 +1,101 @@
+"""Production entry point: runs the API in several worker processes.
+
+Apply the schema first, then start the workers:
+
+    python manage.py migrate
+    WEB_WORKERS=4 SHARED_STATE_BACKEND=redis REDIS_URL=redis://... python serve.py
+
+Gunicorn supervises uvicorn workers where it is available; elsewhere (e.g. on
+Windows) uvicorn's own process manager runs them. Every worker keeps its own
+leaderboards, caches and pools, and stays consistent with the others through
+the shared-state backend. The local backend only suits a single worker, so
+several workers are refused without the redis one.
+"""
+import logging
+import os
+
+from shared_state import SHARED_STATE_BACKEND
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", 8000))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 1))
+# Seconds a worker may go silent before gunicorn restarts it
+WORKER_TIMEOUT = int(os.getenv("WORKER_TIMEOUT", 60))
+# Seconds in-flight requests get to finish on shutdown or reload
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+KEEPALIVE_SECONDS = int(os.getenv("KEEPALIVE_SECONDS", 5))
+# Recycle workers after this many requests, 0 never does
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", 0))
+MAX_REQUESTS_JITTER = int(os.getenv("MAX_REQUESTS_JITTER", 0))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+
+def size_worker_pools(workers: int):
+    # Each worker starts its own bcrypt pool; split the cores instead of giving every worker all of them
+    cpus = os.cpu_count() or 2
+    os.environ.setdefault("PASSWORD_WORKERS", str(max(1, cpus // workers)))
+
+
+def run_gunicorn():
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{HOST}:{PORT}",
+                "workers": WEB_WORKERS,
+                "worker_class": "uvicorn.workers.UvicornWorker",
+                "timeout": WORKER_TIMEOUT,
+                "graceful_timeout": GRACEFUL_TIMEOUT,
+                "keepalive": KEEPALIVE_SECONDS,
+                "max_requests": MAX_REQUESTS,
+                "max_requests_jitter": MAX_REQUESTS_JITTER,
+                "loglevel": LOG_LEVEL.lower(),
+                "accesslog": "-",
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Imported in each worker after the fork, so no pools or connections are shared
+            from main import app
+            return app
+
+    Server().run()
+
+
+def run_uvicorn():
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        host=HOST,
+        port=PORT,
+        workers=WEB_WORKERS,
+        timeout_keep_alive=KEEPALIVE_SECONDS,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+        limit_max_requests=MAX_REQUESTS or None,
+        log_level=LOG_LEVEL.lower(),
+    )
+
+
+def main():
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if WEB_WORKERS > 1 and SHARED_STATE_BACKEND == "local":
+        # Caches, leaderboards, login throttling and events would silently diverge between workers
+        raise SystemExit(
+            f"WEB_WORKERS={WEB_WORKERS} needs a shared-state backend that spans processes; "
+            "set SHARED_STATE_BACKEND=redis or run a single worker"
+        )
+    size_worker_pools(WEB_WORKERS)
+    try:
+        import gunicorn.app.base  # noqa: F401
+    except ImportError:
+        # Not installed, or on Windows where gunicorn can't run
+        run_uvicorn()
+    else:
+        run_gunicorn()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,77 @@
-from fastapi import HTTPException, Depends, Response
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from auth import get_current_user
-from models import User
+import os
+import secrets
+from typing import Optional
+from fastapi import HTTPException, Depends, Request, Response
+from fastapi.responses import FileResponse, JSONResponse
+from sqlalchemy import Row, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased
+from starlette.concurrency import run_in_threadpool
+from archive import archived_scores_slice, chunks_statement
+from blobs import blob_store
+from images import THUMBNAIL_FORMAT, THUMBNAIL_SIZES
+from friends import get_friend_ids, get_friend_ids_async
+from models import FriendRequest, FriendRequestStatus, Score, User, UserStats
+from sounds import get_sound_profile, get_sound_profile_async
+from read_models import FastJSONResponse, FriendRequestView, FriendView, LeaderboardView, ProfileView, ScoreView, SoundSettingView
 from database import get_db
 
+# Picture URLs carry a content version, so the bytes behind them never change
+PICTURE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PICTURE_REVALIDATE = "public, no-cache"
+
+# Thumbnail used wherever many avatars are shown at once
+AVATAR_SIZE = THUMBNAIL_SIZES[0]
+
+def profile_picture_url(user_id: int, picture_id: Optional[str], size: Optional[int] = None) -> Optional[str]:
+    if not picture_id:
+        return None
+    url = f"/users/{user_id}/profile-picture/?v={picture_id[:16]}"
+    if size:
+        url += f"&size={size}"
+    return url
+
+def thumbnail_variant(size: int) -> str:
+    return f"{size}.{THUMBNAIL_FORMAT}"
+
+def to_leaderboard_user(entry, rank=None) -> LeaderboardView:
+    return LeaderboardView(entry.id, entry.username, entry.best_score, profile_picture_url(entry.id, entry.picture_id, AVATAR_SIZE), rank)
+
+# Distinguishes ETags from before a restart, when in-memory versions start over
+BOOT_ID = secrets.token_hex(4)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match", "")
+    return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+def conditional_json(request: Request, etag: str, build) -> Response:
+    """Answer 304 when the client already has ``etag``; otherwise call ``build`` and send it as JSON."""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse(content=build(), headers=headers)
+
+def board_etag(board, *parts) -> str:
+    return '"' + "-".join(str(part) for part in (BOOT_ID, board.name, board.version) + parts) + '"'
+
+def encode_leaderboard_cursor(entry) -> str:
+    return f"{entry.best_score}:{entry.id}"
+
+def decode_leaderboard_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    try:
+        best_score, user_id = cursor.split(":")
+        return (-int(best_score), int(user_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def leaderboard_page(start: int, entries, limit: int) -> dict:
+    return {
+        "entries": [to_leaderboard_user(entry, start + i + 1) for i, entry in enumerate(entries)],
+        "next_cursor": encode_leaderboard_cursor(entries[-1]) if len(entries) == limit else None,
+    }
+
 def get_username_by_id(user_id: int, db: Session = Depends(get_db)) -> str:
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
@@ -12,13 +79,230 @@ def get_username_by_id(user_id: int, db: Session = Depends(get_db)) -> str:
     return user.username
 
 def get_profile_picture_binary(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    if not user.profile_picture:
+    picture_id = db.query(User.profile_picture_id).filter(User.id == user_id).scalar()
+    if not blob_store.exists(picture_id):
         # Return null if no profile picture exists
         return JSONResponse(content=None, status_code=200)
-    
-    # Return the binary content of the profile picture if it exists
-    return Response(content=user.profile_picture, media_type="image/jpeg")
\ No newline at end of file
+
+    # Stream the stored picture from disk
+    return FileResponse(blob_store.path_for(picture_id), media_type="image/jpeg")
+
+def profile_picture_response(request: Request, picture_id: str, size: Optional[int] = None, version: Optional[str] = None):
+    path = blob_store.path_for(picture_id)
+    media_type = "image/jpeg"
+    etag = f'"{picture_id}"'
+    if size:
+        variant_path = blob_store.variant_path(picture_id, thumbnail_variant(size))
+        # Pictures uploaded before thumbnails existed fall back to the full image
+        if os.path.exists(variant_path):
+            path = variant_path
+            media_type = f"image/{THUMBNAIL_FORMAT}"
+            etag = f'"{picture_id}-{size}"'
+    # Versioned URLs are immutable; bare ones must revalidate against the ETag
+    cache_control = PICTURE_CACHE_CONTROL if version and picture_id.startswith(version) else PICTURE_REVALIDATE
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+# Most recent games returned with a profile; older history is paged
+PROFILE_SCORES_LIMIT = 50
+MAX_PROFILE_SCORES_LIMIT = 200
+
+# Profile queries are built once as statements so the sync and async paths share them
+
+def profile_user_statement(user_id: int):
+    # A plain row rather than a User, so there is no identity map entry or relationship state to build
+    return select(User.id, User.username, User.email, User.best_score, User.profile_picture_id).where(User.id == user_id)
+
+def friends_statement(friend_ids):
+    return select(User.id, User.username, User.profile_picture_id, User.best_score).where(User.id.in_(friend_ids))
+
+def clamp_scores_page(limit: int, offset: int):
+    return max(0, min(limit, MAX_PROFILE_SCORES_LIMIT)), max(offset, 0)
+
+def score_page_statement(user_id: int, limit: int, offset: int):
+    limit, offset = clamp_scores_page(limit, offset)
+    return (
+        select(Score.score, Score.timestamp)
+        .where(Score.user_id == user_id)
+        .order_by(Score.timestamp.desc(), Score.id.desc())
+        .offset(offset)
+        .limit(limit)
+    )
+
+def hot_score_count_statement(user_id: int):
+    return select(func.count()).select_from(Score).where(Score.user_id == user_id)
+
+def archive_page(scores, limit: int, offset: int):
+    """Where a profile page continues in the archive: (archive offset, rows wanted), or None when the hot rows filled it.
+
+    The archive offset is None when it depends on how many hot scores the user has.
+    """
+    limit, offset = clamp_scores_page(limit, offset)
+    if len(scores) >= limit:
+        return None
+    if scores or offset == 0:
+        # Every hot score up to the end of this page has been seen
+        return 0, limit - len(scores)
+    return None, limit
+
+def archived_page_scores(chunks, archive_offset: int, count: int):
+    return [(row.score, row.timestamp) for row in archived_scores_slice(chunks, archive_offset, count)]
+
+def score_aggregate_statement(user_id: int):
+    # Maintained incrementally in user_stats, so this is a primary-key lookup
+    return select(
+        UserStats.games_played,
+        UserStats.total_score * 1.0 / func.nullif(UserStats.games_played, 0),
+    ).where(UserStats.user_id == user_id)
+
+FRIEND_REQUESTS_PAGE_SIZE = 20
+MAX_FRIEND_REQUESTS_PAGE_SIZE = 100
+RECEIVED = "received"
+SENT = "sent"
+
+def friend_requests_statement(user_id: int, direction: str, before_id: Optional[int] = None, limit: Optional[int] = None):
+    """Pending requests for one side of the inbox, newest first, with both users' names and picture ids.
+
+    One joined projection, so rendering the inbox never loads User rows or their relationships.
+    """
+    requester = aliased(User)
+    receiver = aliased(User)
+    own_column = FriendRequest.receiver_id if direction == RECEIVED else FriendRequest.requester_id
+    statement = (
+        select(
+            FriendRequest.id,
+            FriendRequest.requester_id,
+            requester.username.label("requester_username"),
+            requester.profile_picture_id.label("requester_picture_id"),
+            FriendRequest.receiver_id,
+            receiver.username.label("receiver_username"),
+            receiver.profile_picture_id.label("receiver_picture_id"),
+            FriendRequest.status,
+            FriendRequest.timestamp,
+        )
+        .join(requester, requester.id == FriendRequest.requester_id)
+        .join(receiver, receiver.id == FriendRequest.receiver_id)
+        .where(own_column == user_id, FriendRequest.status == FriendRequestStatus.pending)
+        .order_by(FriendRequest.id.desc())
+    )
+    if before_id is not None:
+        statement = statement.where(FriendRequest.id < before_id)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+def to_friend_request_response(row) -> FriendRequestView:
+    return FriendRequestView(
+        row.id,
+        row.requester_id,
+        row.requester_username,
+        profile_picture_url(row.requester_id, row.requester_picture_id, AVATAR_SIZE),
+        row.receiver_id,
+        row.receiver_username,
+        profile_picture_url(row.receiver_id, row.receiver_picture_id, AVATAR_SIZE),
+        row.status.name,
+        row.timestamp,
+    )
+
+def get_friend_request_page(db: Session, user_id: int, direction: str, cursor: Optional[str] = None, limit: int = FRIEND_REQUESTS_PAGE_SIZE) -> dict:
+    limit = max(1, min(limit, MAX_FRIEND_REQUESTS_PAGE_SIZE))
+    before_id = None
+    if cursor:
+        try:
+            before_id = int(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    rows = db.execute(friend_requests_statement(user_id, direction, before_id, limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = str(rows[-1].id)
+    return {"requests": [to_friend_request_response(row) for row in rows], "next_cursor": next_cursor}
+
+def load_profile_user(db: Session, user_id: int) -> Row:
+    user = db.execute(profile_user_statement(user_id)).one_or_none()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+async def load_profile_user_async(db: AsyncSession, user_id: int) -> Row:
+    user = (await db.execute(profile_user_statement(user_id))).one_or_none()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+def assemble_profile(user: Row, friend_ids, friends, scores, aggregates, sound_settings=None, viewer_id=None) -> ProfileView:
+    games_played, average_score = aggregates or (0, None)
+    return ProfileView(
+        id=user.id,
+        username=user.username,
+        email=user.email,
+        best_score=user.best_score or 0,
+        profile_picture=profile_picture_url(user.id, user.profile_picture_id, THUMBNAIL_SIZES[-1]),
+        sent_friend_requests=[],
+        received_friend_requests=[],
+        friends=[
+            FriendView(friend_id, username, profile_picture_url(friend_id, picture_id, AVATAR_SIZE), best_score or 0)
+            for friend_id, username, picture_id, best_score in friends
+        ],
+        sound_settings=[SoundSettingView(*setting) for setting in sound_settings or ()],
+        scores=[ScoreView(score, timestamp) for score, timestamp in scores],
+        games_played=games_played,
+        average_score=float(average_score) if average_score is not None else None,
+        is_friend=viewer_id in friend_ids if viewer_id is not None else None,
+    )
+
+def build_user_profile(
+    db: Session,
+    user: Row,
+    viewer_id: Optional[int] = None,
+    include_private: bool = False,
+    scores_limit: int = PROFILE_SCORES_LIMIT,
+    scores_offset: int = 0,
+) -> ProfileView:
+    """Assemble a profile with a fixed number of column-only queries.
+
+    ``user`` is the row from load_profile_user, or anything else with the same attributes.
+    """
+    friend_ids = get_friend_ids(db, user.id)
+    friends = db.execute(friends_statement(friend_ids)).all() if friend_ids else []
+    scores = db.execute(score_page_statement(user.id, scores_limit, scores_offset)).all()
+    page = archive_page(scores, scores_limit, scores_offset)
+    if page is not None:
+        archive_offset, count = page
+        if archive_offset is None:
+            archive_offset = max(scores_offset, 0) - db.execute(hot_score_count_statement(user.id)).scalar()
+        chunks = db.execute(chunks_statement(user.id)).all()
+        if chunks:
+            scores = scores + archived_page_scores(chunks, archive_offset, count)
+    aggregates = db.execute(score_aggregate_statement(user.id)).one_or_none()
+    sound_settings = get_sound_profile(db, user.id).settings if include_private else None
+    return assemble_profile(user, friend_ids, friends, scores, aggregates, sound_settings, viewer_id)
+
+async def build_user_profile_async(
+    db: AsyncSession,
+    user: Row,
+    viewer_id: Optional[int] = None,
+    include_private: bool = False,
+    scores_limit: int = PROFILE_SCORES_LIMIT,
+    scores_offset: int = 0,
+) -> ProfileView:
+    friend_ids = await get_friend_ids_async(db, user.id)
+    friends = (await db.execute(friends_statement(friend_ids))).all() if friend_ids else []
+    scores = (await db.execute(score_page_statement(user.id, scores_limit, scores_offset))).all()
+    page = archive_page(scores, scores_limit, scores_offset)
+    if page is not None:
+        archive_offset, count = page
+        if archive_offset is None:
+            archive_offset = max(scores_offset, 0) - (await db.execute(hot_score_count_statement(user.id))).scalar()
+        chunks = (await db.execute(chunks_statement(user.id))).all()
+        if chunks:
+            # Archive files are read off the event loop
+            scores = scores + await run_in_threadpool(archived_page_scores, chunks, archive_offset, count)
+    aggregates = (await db.execute(score_aggregate_statement(user.id))).one_or_none()
+    sound_settings = (await get_sound_profile_async(db, user.id)).settings if include_private else None
+    return assemble_profile(user, friend_ids, friends, scores, aggregates, sound_settings, viewer_id)
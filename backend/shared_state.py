@@ -0,0 +1,204 @@
+import json
+import logging
+import math
+import os
+import queue
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Any, Callable, Dict, List
+
+try:
+    import redis
+except ImportError:
+    # Optional; only needed for SHARED_STATE_BACKEND=redis
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# "local" keeps everything inside this process, which is only correct with a single worker;
+# "redis" shares counters and broadcasts between every worker on every host
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "local")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Namespaces keys and channels, so several deployments can share one Redis
+SHARED_STATE_PREFIX = os.getenv("SHARED_STATE_PREFIX", "simonwebby:")
+# Broadcasts waiting for the publisher thread before new ones are dropped
+SHARED_STATE_PUBLISH_QUEUE = int(os.getenv("SHARED_STATE_PUBLISH_QUEUE", 10000))
+
+# Channels for changes every worker has to apply to its in-memory state
+CACHE_CHANNEL = "cache"
+EVENTS_CHANNEL = "events"
+FRIENDS_CHANNEL = "friends"
+PRINCIPALS_CHANNEL = "principals"
+SCORES_CHANNEL = "scores"
+SOUNDS_CHANNEL = "sounds"
+PICTURES_CHANNEL = "pictures"
+USERS_CHANNEL = "users"
+
+
+class SharedState(ABC):
+    """State the workers serving the API have to agree on.
+
+    Counters are shared and expire ``ttl`` seconds after they were created.
+    ``broadcast`` hands a JSON-serialisable message to the handlers subscribed to
+    the channel in every *other* worker, so callers apply a change to their own
+    process first and then broadcast it.
+    """
+
+    def __init__(self):
+        self._handlers: Dict[str, List[Callable[[Any], None]]] = defaultdict(list)
+
+    def subscribe(self, channel: str, handler: Callable[[Any], None]):
+        self._handlers[channel].append(handler)
+
+    def dispatch(self, channel: str, message):
+        # Called by a backend for each message another worker broadcast
+        for handler in self._handlers.get(channel, ()):
+            try:
+                handler(message)
+            except Exception:
+                logger.exception("Handler for %s failed", channel)
+
+    @abstractmethod
+    def incr(self, key: str, ttl: float) -> int:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def broadcast(self, channel: str, message):
+        ...
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class LocalSharedState(SharedState):
+    """Stand-in backend for a single process: counters live in a dict and broadcasts reach no one."""
+
+    MAX_KEYS = 100000
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def incr(self, key: str, ttl: float) -> int:
+        now = time.monotonic()
+        with self._lock:
+            expires_at, count = self._counters.get(key, (now + ttl, 0))
+            if expires_at <= now:
+                expires_at, count = now + ttl, 0
+            count += 1
+            self._counters[key] = (expires_at, count)
+            if len(self._counters) > self.MAX_KEYS:
+                self._counters = {k: v for k, v in self._counters.items() if v[0] > now}
+        return count
+
+    def delete(self, key: str):
+        with self._lock:
+            self._counters.pop(key, None)
+
+    def broadcast(self, channel: str, message):
+        # There are no other workers to tell
+        pass
+
+
+class RedisSharedState(SharedState):
+    """Counters are Redis keys with an expiry, broadcasts go through Redis pub/sub.
+
+    Messages are tagged with this worker's id, so a worker skips its own broadcasts.
+    Handlers run on the pub/sub listener thread. Broadcasts are queued and published
+    by a thread of their own, since they are made from async handlers too and must
+    not wait on Redis; ``incr`` and ``delete`` block, so async callers run them on a
+    thread. Works with any Redis version from 2.6.12 on.
+    """
+
+    def __init__(self, url: str, prefix: str):
+        super().__init__()
+        if redis is None:
+            raise RuntimeError("SHARED_STATE_BACKEND=redis needs the redis package")
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._origin = uuid.uuid4().hex
+        self._pubsub = None
+        self._listener = None
+        self._outbox = queue.Queue(maxsize=SHARED_STATE_PUBLISH_QUEUE)
+        self._publisher = threading.Thread(target=self._publish, name="shared-state-publisher", daemon=True)
+        self._publisher.start()
+
+    def incr(self, key: str, ttl: float) -> int:
+        key = self.prefix + key
+        pipe = self._client.pipeline()
+        # Only the first increment creates the key with an expiry, so the window is fixed
+        # from creation (EXPIRE ... NX would do the same but needs Redis 7)
+        pipe.set(key, 0, ex=max(1, math.ceil(ttl)), nx=True)
+        pipe.incr(key)
+        _, count = pipe.execute()
+        return count
+
+    def delete(self, key: str):
+        self._client.delete(self.prefix + key)
+
+    def broadcast(self, channel: str, message):
+        payload = json.dumps({"origin": self._origin, "message": message}, separators=(",", ":"))
+        try:
+            self._outbox.put_nowait((self.prefix + channel, payload))
+        except queue.Full:
+            logger.error("Broadcast queue is full, dropping a message for %s", channel)
+
+    def _publish(self):
+        while True:
+            item = self._outbox.get()
+            if item is None:
+                return
+            try:
+                self._client.publish(*item)
+            except Exception:
+                logger.exception("Failed to publish to %s", item[0])
+
+    def _on_message(self, item):
+        payload = json.loads(item["data"])
+        if payload["origin"] == self._origin:
+            return
+        channel = item["channel"].decode()[len(self.prefix):]
+        self.dispatch(channel, payload["message"])
+
+    def start(self):
+        # Every module has subscribed its handlers by the time the app starts
+        self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{self.prefix + channel: self._on_message for channel in self._handlers})
+        self._listener = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def stop(self):
+        if self._publisher is not None:
+            # Queued broadcasts go out before the connection closes
+            self._outbox.put(None)
+            self._publisher.join()
+            self._publisher = None
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener.join()
+            self._listener = None
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
+        self._client.close()
+
+
+def make_shared_state(backend: str) -> SharedState:
+    if backend == "local":
+        return LocalSharedState()
+    if backend == "redis":
+        return RedisSharedState(REDIS_URL, SHARED_STATE_PREFIX)
+    raise ValueError(f"Unknown SHARED_STATE_BACKEND {backend!r}")
+
+
+shared_state = make_shared_state(SHARED_STATE_BACKEND)
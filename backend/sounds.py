@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import and_, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from database import dialect_insert
+from models import Sound, SoundSetting
+from shared_state import SOUNDS_CHANNEL, shared_state
+
+SOUND_CACHE_SIZE = int(os.getenv("SOUND_CACHE_SIZE", 10000))
+# Volume of every sound the user hasn't set, the column default of SoundSetting.volume
+DEFAULT_VOLUME = 75
+# Sound whose setting /set-volume/ persists as the device's master volume
+MASTER_SOUND = os.getenv("MASTER_SOUND", "master")
+
+
+@dataclass(frozen=True)
+class SoundProfile:
+    """A user's settings resolved against the sound catalog, with defaults filled in."""
+
+    # (sound_id, name, volume) for every sound, ordered by id
+    settings: Tuple[Tuple[int, str, float], ...]
+    version: str
+    # What the device fetches: {"v": version, "s": [[sound_id, volume], ...]}
+    device_body: bytes
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.version}"'
+
+    @property
+    def sound_ids(self):
+        return {sound_id for sound_id, _, _ in self.settings}
+
+
+def build_sound_profile(rows) -> SoundProfile:
+    settings = tuple((sound_id, name, float(volume)) for sound_id, name, volume in rows)
+    # Content-addressed, so every worker derives the same version for the same settings
+    version = hashlib.sha1(repr(settings).encode()).hexdigest()[:12]
+    pairs = [[sound_id, round(volume)] for sound_id, _, volume in settings]
+    device_body = json.dumps({"v": version, "s": pairs}, separators=(",", ":")).encode()
+    return SoundProfile(settings, version, device_body)
+
+
+class SoundProfileCache:
+    """LRU of resolved profiles per user; entries are dropped whenever the user's settings change.
+
+    The sound catalog itself only changes through ``manage.py migrate``, which is followed by a restart.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Bumped on every invalidation so a load that raced a write is not cached
+        self.generation = 0
+
+    def get(self, user_id: int) -> Optional[SoundProfile]:
+        with self._lock:
+            profile = self._entries.get(user_id)
+            if profile is not None:
+                self._entries.move_to_end(user_id)
+            return profile
+
+    def put(self, user_id: int, profile: SoundProfile, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[user_id] = profile
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(user_id, None)
+
+
+sound_profile_cache = SoundProfileCache(SOUND_CACHE_SIZE)
+
+
+def resolved_settings_statement(user_id: int):
+    # Every sound in the catalog, with the user's volume where they set one
+    return (
+        select(Sound.id, Sound.name, func.coalesce(SoundSetting.volume, DEFAULT_VOLUME))
+        .outerjoin(SoundSetting, and_(SoundSetting.sound_id == Sound.id, SoundSetting.user_id == user_id))
+        .order_by(Sound.id)
+    )
+
+
+def get_sound_profile(db: Session, user_id: int) -> SoundProfile:
+    profile = sound_profile_cache.get(user_id)
+    if profile is None:
+        generation = sound_profile_cache.generation
+        profile = build_sound_profile(db.execute(resolved_settings_statement(user_id)).all())
+        sound_profile_cache.put(user_id, profile, generation)
+    return profile
+
+
+async def get_sound_profile_async(db: AsyncSession, user_id: int) -> SoundProfile:
+    profile = sound_profile_cache.get(user_id)
+    if profile is None:
+        generation = sound_profile_cache.generation
+        profile = build_sound_profile((await db.execute(resolved_settings_statement(user_id))).all())
+        sound_profile_cache.put(user_id, profile, generation)
+    return profile
+
+
+def upsert_sound_settings(db: Session, user_id: int, volumes: Dict[int, float]):
+    """Stage the user's volumes as one INSERT ... ON CONFLICT DO UPDATE; the caller commits.
+
+    Sound ids are checked against the (usually cached) profile rather than with another query.
+    """
+    if not volumes:
+        return
+    unknown = sorted(set(volumes) - get_sound_profile(db, user_id).sound_ids)
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown sound ids: {unknown}")
+    insert = dialect_insert(db, SoundSetting).values(
+        [{"user_id": user_id, "sound_id": sound_id, "volume": volume} for sound_id, volume in volumes.items()]
+    )
+    db.execute(insert.on_conflict_do_update(
+        index_elements=[SoundSetting.user_id, SoundSetting.sound_id],
+        set_={"volume": insert.excluded.volume},
+    ))
+
+
+def master_sound_id(db: Session, user_id: int) -> Optional[int]:
+    for sound_id, name, _ in get_sound_profile(db, user_id).settings:
+        if name == MASTER_SOUND:
+            return sound_id
+    return None
+
+
+def to_sound_settings_response(profile: SoundProfile) -> dict:
+    return {
+        "version": profile.version,
+        "settings": [{"sound_id": sound_id, "sound": name, "volume": volume} for sound_id, name, volume in profile.settings],
+    }
+
+
+def invalidate_sound_profile(user_id: int):
+    # Call after the commit, or a concurrent read could cache the old settings again
+    sound_profile_cache.invalidate(user_id)
+    shared_state.broadcast(SOUNDS_CHANNEL, user_id)
+
+
+shared_state.subscribe(SOUNDS_CHANNEL, sound_profile_cache.invalidate)
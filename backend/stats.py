@@ -0,0 +1,223 @@
+import base64
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from itertools import chain
+from typing import List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import Session
+
+from archive import archived_scores_before, as_utc, chunks_statement, history_key, iter_archived_scores, month_start
+from database import dialect_insert
+from models import Score, ScoreRollup, UserStats
+
+PERIOD_DAY = "day"
+PERIOD_WEEK = "week"
+PERCENTILES = (50, 90, 99)
+# Rollup buckets returned alongside the aggregates
+RECENT_DAYS = 7
+RECENT_WEEKS = 8
+
+SCORES_PAGE_SIZE = 50
+MAX_SCORES_PAGE_SIZE = 200
+
+
+def utc_day(timestamp: datetime) -> date:
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc).date()
+
+
+def week_start(day: date) -> date:
+    return day - timedelta(days=day.weekday())
+
+
+def apply_scores(db: Session, entries: List[tuple]):
+    """Fold a batch of (user_id, score, timestamp) into user_stats and score_rollups.
+
+    Runs in the caller's transaction with a fixed number of statements per batch.
+    """
+    if not entries:
+        return
+
+    by_user = defaultdict(list)
+    rollups = {}
+    for user_id, score, timestamp in entries:
+        by_user[user_id].append((timestamp, score))
+        day = utc_day(timestamp)
+        for key in ((user_id, PERIOD_DAY, day), (user_id, PERIOD_WEEK, week_start(day))):
+            games, total, best = rollups.get(key, (0, 0, score))
+            rollups[key] = (games + 1, total + score, max(best, score))
+
+    # Make sure every row exists, then lock them so concurrent batches serialize per user.
+    # Rows are always written and locked in key order, so two batches touching the same
+    # users wait on each other instead of deadlocking
+    db.execute(
+        dialect_insert(db, UserStats)
+        .values([{"user_id": user_id, "histogram": {}} for user_id in sorted(by_user)])
+        .on_conflict_do_nothing(index_elements=["user_id"])
+    )
+    stats_rows = (
+        db.query(UserStats)
+        .filter(UserStats.user_id.in_(list(by_user)))
+        .order_by(UserStats.user_id)
+        .with_for_update()
+        .all()
+    )
+    for stats in stats_rows:
+        histogram = dict(stats.histogram or {})
+        for timestamp, score in sorted(by_user[stats.user_id]):
+            stats.games_played = (stats.games_played or 0) + 1
+            stats.total_score = (stats.total_score or 0) + score
+            stats.best_score = max(stats.best_score or 0, score)
+            histogram[str(score)] = histogram.get(str(score), 0) + 1
+
+            day = utc_day(timestamp)
+            last = stats.last_played_on
+            if last is None or day > last:
+                stats.current_streak = (stats.current_streak or 0) + 1 if last == day - timedelta(days=1) else 1
+                stats.last_played_on = day
+                stats.longest_streak = max(stats.longest_streak or 0, stats.current_streak)
+        # Reassign so the JSON column is flagged dirty
+        stats.histogram = histogram
+
+    insert = dialect_insert(db, ScoreRollup).values([
+        {"user_id": user_id, "period": period, "period_start": start, "games": games, "total_score": total, "best_score": best}
+        for (user_id, period, start), (games, total, best) in sorted(rollups.items())
+    ])
+    db.execute(insert.on_conflict_do_update(
+        index_elements=["user_id", "period", "period_start"],
+        set_={
+            "games": ScoreRollup.games + insert.excluded.games,
+            "total_score": ScoreRollup.total_score + insert.excluded.total_score,
+            "best_score": func.greatest(ScoreRollup.best_score, insert.excluded.best_score),
+        },
+    ))
+
+
+def histogram_percentiles(histogram: dict, games_played: int) -> dict:
+    if not games_played:
+        return {f"p{p}": None for p in PERCENTILES}
+    result = {}
+    counts = sorted((int(score), count) for score, count in histogram.items())
+    for p in PERCENTILES:
+        # Nearest-rank percentile
+        rank = max(1, -(-p * games_played // 100))
+        seen = 0
+        for score, count in counts:
+            seen += count
+            if seen >= rank:
+                result[f"p{p}"] = score
+                break
+    return result
+
+
+def get_user_stats(db: Session, user_id: int, today: Optional[date] = None) -> dict:
+    today = today or datetime.now(timezone.utc).date()
+    stats = db.get(UserStats, user_id)
+    rollups = (
+        db.query(ScoreRollup)
+        .filter(
+            ScoreRollup.user_id == user_id,
+            ((ScoreRollup.period == PERIOD_DAY) & (ScoreRollup.period_start > today - timedelta(days=RECENT_DAYS))) |
+            ((ScoreRollup.period == PERIOD_WEEK) & (ScoreRollup.period_start > week_start(today) - timedelta(weeks=RECENT_WEEKS))),
+        )
+        .order_by(ScoreRollup.period, ScoreRollup.period_start)
+        .all()
+    )
+
+    games_played = stats.games_played if stats else 0
+    current_streak = 0
+    if stats and stats.last_played_on and stats.last_played_on >= today - timedelta(days=1):
+        # A streak stays alive until a full day passes without a game
+        current_streak = stats.current_streak
+
+    def rollup_dict(rollup):
+        return {
+            "period_start": rollup.period_start,
+            "games": rollup.games,
+            "total_score": rollup.total_score,
+            "best_score": rollup.best_score,
+            "average_score": rollup.total_score / rollup.games if rollup.games else None,
+        }
+
+    return {
+        "user_id": user_id,
+        "games_played": games_played,
+        "best_score": stats.best_score if stats else 0,
+        "average_score": stats.total_score / games_played if games_played else None,
+        "current_streak": current_streak,
+        "longest_streak": stats.longest_streak if stats else 0,
+        "last_played_on": stats.last_played_on if stats else None,
+        "percentiles": histogram_percentiles(stats.histogram if stats else {}, games_played),
+        "daily": [rollup_dict(r) for r in rollups if r.period == PERIOD_DAY],
+        "weekly": [rollup_dict(r) for r in rollups if r.period == PERIOD_WEEK],
+    }
+
+
+def encode_cursor(timestamp: datetime, score_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{score_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        timestamp, score_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+        return datetime.fromisoformat(timestamp), int(score_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def get_score_page(db: Session, user_id: int, cursor: Optional[str] = None, limit: int = SCORES_PAGE_SIZE) -> dict:
+    """Newest-first score history using a keyset cursor over (timestamp, id)."""
+    limit = max(1, min(limit, MAX_SCORES_PAGE_SIZE))
+    query = db.query(Score.id, Score.score, Score.timestamp).filter(Score.user_id == user_id)
+    if cursor:
+        query = query.filter(tuple_(Score.timestamp, Score.id) < decode_cursor(cursor))
+    rows = query.order_by(Score.timestamp.desc(), Score.id.desc()).limit(limit + 1).all()
+
+    if len(rows) <= limit:
+        # The hot table ran out; continue into the archived months, which are all older
+        before = history_key(rows[-1]) if rows else decode_cursor(cursor) if cursor else None
+        through_month = month_start(as_utc(before[0]).date()) if before else None
+        chunks = db.execute(chunks_statement(user_id, through_month)).all()
+        if chunks:
+            rows = rows + archived_scores_before(chunks, before, limit + 1 - len(rows))
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].id)
+    return {
+        "scores": [{"score": row.score, "timestamp": row.timestamp} for row in rows],
+        "next_cursor": next_cursor,
+    }
+
+
+def rebuild_stats(db: Session, batch_size: int = 5000):
+    """Recompute every aggregate from the archived and hot scores, streaming them in (user_id, timestamp) order.
+
+    Archived months come first: they are older than anything left in the table.
+    """
+    db.query(ScoreRollup).delete(synchronize_session=False)
+    db.query(UserStats).delete(synchronize_session=False)
+    db.commit()
+
+    rows = (
+        db.query(Score.id, Score.user_id, Score.score, Score.timestamp)
+        .order_by(Score.user_id, Score.timestamp, Score.id)
+        .yield_per(batch_size)
+    )
+    batch = []
+    processed = 0
+    for _, user_id, score, timestamp in chain(iter_archived_scores(db), rows):
+        # Archived timestamps are UTC-aware, SQLite's are naive; a batch can hold both
+        batch.append((user_id, score, as_utc(timestamp)))
+        if len(batch) >= batch_size:
+            apply_scores(db, batch)
+            processed += len(batch)
+            batch = []
+    apply_scores(db, batch)
+    processed += len(batch)
+    db.commit()
+    return processed
@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from fastapi import HTTPException, Request
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import insert
+
+from database import SessionLocal
+from metrics import registry
+from models import GameEvent
+from schemas import GameEventData
+from scoring import is_transient
+
+try:
+    import msgpack
+except ImportError:
+    # Optional; without it /esp-data only takes JSON and NDJSON bodies
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# "db" appends to the game_events table, "file" to NDJSON segments under GAME_EVENT_LOG_DIR
+GAME_EVENT_SINK = os.getenv("GAME_EVENT_SINK", "db")
+GAME_EVENT_LOG_DIR = os.getenv("GAME_EVENT_LOG_DIR", os.path.join(os.path.dirname(__file__), "game_events"))
+GAME_EVENT_SEGMENT_BYTES = int(os.getenv("GAME_EVENT_SEGMENT_BYTES", 64 * 1024 * 1024))
+GAME_EVENT_FLUSH_INTERVAL_MS = int(os.getenv("GAME_EVENT_FLUSH_INTERVAL_MS", 500))
+GAME_EVENT_FLUSH_BATCH = int(os.getenv("GAME_EVENT_FLUSH_BATCH", 5000))
+GAME_EVENT_BUFFER_LIMIT = int(os.getenv("GAME_EVENT_BUFFER_LIMIT", 100000))
+MAX_EVENT_BATCH_BYTES = int(os.getenv("MAX_EVENT_BATCH_BYTES", 1024 * 1024))
+MAX_EVENTS_PER_BATCH = int(os.getenv("MAX_EVENTS_PER_BATCH", 5000))
+# Failed writes of the same batch before it is written event by event to find the bad ones
+GAME_EVENT_FLUSH_MAX_ATTEMPTS = int(os.getenv("GAME_EVENT_FLUSH_MAX_ATTEMPTS", 5))
+
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+game_events_received = registry.counter("game_events_received_total", "Game events accepted by type")
+game_events_rejected = registry.counter("game_events_rejected_total", "Game event batches rejected by reason")
+game_events_flushed = registry.counter("game_events_flushed_total", "Game events written to the sink")
+game_events_dead_lettered = registry.counter("game_events_dead_lettered_total", "Game events dropped because the sink rejects them")
+game_event_flushes = registry.histogram("game_event_flush_seconds", "Time spent writing one batch of game events")
+
+events_adapter = TypeAdapter(List[GameEventData])
+
+
+def reject(status_code: int, reason: str, detail, headers=None):
+    game_events_rejected.inc(reason=reason)
+    raise HTTPException(status_code=status_code, detail=detail, headers=headers)
+
+
+async def read_event_batch(request: Request) -> bytes:
+    # Streamed with a cap, so a chunked upload without Content-Length can't grow unbounded
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_EVENT_BATCH_BYTES:
+        reject(413, "too_large", f"Event batches are limited to {MAX_EVENT_BATCH_BYTES} bytes")
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_EVENT_BATCH_BYTES:
+            reject(413, "too_large", f"Event batches are limited to {MAX_EVENT_BATCH_BYTES} bytes")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def decode_batch(content_type: Optional[str], body: bytes) -> list:
+    """Raw event dicts from an NDJSON, JSON (object or array) or msgpack body."""
+    media_type = (content_type or "application/json").split(";")[0].strip().lower()
+    try:
+        if media_type in NDJSON_TYPES:
+            return [json.loads(line) for line in body.splitlines() if line.strip()]
+        if media_type in MSGPACK_TYPES:
+            if msgpack is None:
+                reject(415, "unsupported", "msgpack bodies are not supported by this server")
+            unpacker = msgpack.Unpacker(raw=False, max_buffer_size=MAX_EVENT_BATCH_BYTES)
+            unpacker.feed(body)
+            items = []
+            # Either one array of events or a stream of event maps
+            for item in unpacker:
+                items.extend(item if isinstance(item, list) else [item])
+            return items
+        if media_type in ("application/json", "text/plain"):
+            decoded = json.loads(body)
+            return decoded if isinstance(decoded, list) else [decoded]
+    except HTTPException:
+        raise
+    except ValueError as e:
+        reject(400, "malformed", f"Could not decode the event batch: {e}")
+    reject(415, "unsupported", f"Unsupported content type {media_type}")
+
+
+def parse_game_events(content_type: Optional[str], body: bytes) -> List[GameEventData]:
+    items = decode_batch(content_type, body)
+    if len(items) > MAX_EVENTS_PER_BATCH:
+        reject(413, "too_large", f"At most {MAX_EVENTS_PER_BATCH} events per batch")
+    try:
+        return events_adapter.validate_python(items)
+    except ValidationError as e:
+        reject(422, "invalid", e.errors(include_url=False, include_context=False))
+
+
+class DatabaseSink:
+    def write(self, rows: List[dict]):
+        db = SessionLocal()
+        try:
+            # One executemany; SQLAlchemy batches it into multi-row INSERTs
+            db.execute(insert(GameEvent), rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def close(self):
+        pass
+
+
+class SegmentedLogSink:
+    """Appends events as NDJSON to size-capped segment files, one series per process."""
+
+    def __init__(self, directory: str, segment_bytes: int):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._file = None
+        self._sequence = 0
+
+    def _open_segment(self):
+        if self._file is not None:
+            self._file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self._sequence += 1
+        name = f"events-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._sequence:04d}.ndjson"
+        self._file = open(os.path.join(self.directory, name), "ab")
+
+    def write(self, rows: List[dict]):
+        if self._file is None or self._file.tell() >= self.segment_bytes:
+            self._open_segment()
+        data = "".join(json.dumps(row, default=str, separators=(",", ":")) + "\n" for row in rows)
+        self._file.write(data.encode())
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def make_sink(name: str):
+    if name == "db":
+        return DatabaseSink()
+    if name == "file":
+        return SegmentedLogSink(GAME_EVENT_LOG_DIR, GAME_EVENT_SEGMENT_BYTES)
+    raise ValueError(f"Unknown GAME_EVENT_SINK {name!r}")
+
+
+class GameEventBuffer:
+    """Bounded in-memory queue of events, written to the sink by a background thread.
+
+    Requests only append; when the queue is full they get a 429 with Retry-After
+    so the device backs off instead of the server buffering without limit.
+    """
+
+    def __init__(self, sink, interval_ms: int, batch_size: int, limit: int):
+        self.sink = sink
+        self.interval = interval_ms / 1000
+        self.batch_size = batch_size
+        self.limit = limit
+        self._rows = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        # Consecutive failed writes of the batch at the front of the queue
+        self._attempts = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="game-event-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.sink.close()
+
+    def _retry_after(self) -> str:
+        # Roughly how long the flusher needs to drain what is queued
+        batches = len(self._rows) / self.batch_size
+        return str(max(1, round(batches * self.interval)))
+
+    def check_capacity(self):
+        # Cheap pre-check so a full buffer turns the device away before the body is read
+        if len(self._rows) >= self.limit:
+            reject(429, "buffer_full", "Event buffer is full, please retry", {"Retry-After": self._retry_after()})
+
+    def add(self, events: List[GameEventData]):
+        received_at = datetime.now(timezone.utc)
+        rows = [{**event.model_dump(), "type": event.type.value, "received_at": received_at} for event in events]
+        with self._cond:
+            if len(self._rows) + len(rows) > self.limit:
+                reject(429, "buffer_full", "Event buffer is full, please retry", {"Retry-After": self._retry_after()})
+            self._rows.extend(rows)
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify()
+        for event in events:
+            game_events_received.inc(type=event.type.value)
+
+    def _take(self) -> List[dict]:
+        batch = []
+        while self._rows and len(batch) < self.batch_size:
+            batch.append(self._rows.popleft())
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._rows) < self.batch_size:
+                    self._cond.wait(self.interval)
+                batch = self._take()
+                stopping = self._stopping
+            if batch:
+                self.flush(batch)
+            elif stopping:
+                return
+
+    def _requeue(self, rows: List[dict]):
+        with self._cond:
+            self._rows.extendleft(reversed(rows))
+
+    def _write(self, rows: List[dict]):
+        self.sink.write(rows)
+        game_events_flushed.inc(len(rows))
+
+    def _write_each(self, batch: List[dict]):
+        """Write events one at a time, dropping the ones the sink rejects."""
+        for i, row in enumerate(batch):
+            try:
+                self._write([row])
+            except Exception as error:
+                if is_transient(error) or isinstance(error, OSError):
+                    # The sink is failing, not this event; the rest waits for the next flush
+                    logger.warning("Game event sink unavailable, requeueing %d events", len(batch) - i)
+                    self._requeue(batch[i:])
+                    time.sleep(self.interval)
+                    return
+                game_events_dead_lettered.inc()
+                logger.error("Dropping game event %r that can't be written: %s", row, error)
+
+    def flush(self, batch: List[dict]):
+        start = time.perf_counter()
+        try:
+            self._write(batch)
+            self._attempts = 0
+        except Exception as error:
+            if self._stopping:
+                logger.exception("Failed to write %d game events during shutdown, dropping them", len(batch))
+                return
+            self._attempts += 1
+            transient = is_transient(error) or isinstance(error, OSError)
+            if transient and self._attempts < GAME_EVENT_FLUSH_MAX_ATTEMPTS:
+                logger.exception("Failed to write %d game events, will retry", len(batch))
+                self._requeue(batch)
+                time.sleep(self.interval)
+                return
+            # A bad event would fail the batch forever and turn every device away with 429s
+            logger.exception("Failed to write %d game events, writing them one by one", len(batch))
+            self._attempts = 0
+            self._write_each(batch)
+        finally:
+            game_event_flushes.observe(time.perf_counter() - start)
+
+
+game_event_buffer = GameEventBuffer(
+    make_sink(GAME_EVENT_SINK), GAME_EVENT_FLUSH_INTERVAL_MS, GAME_EVENT_FLUSH_BATCH, GAME_EVENT_BUFFER_LIMIT
+)
+
+registry.gauge("game_event_buffer_size", "Game events waiting to be written", lambda: len(game_event_buffer))
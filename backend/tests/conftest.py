@@ -0,0 +1,4 @@
+import os
+
+# Must be set before database.py builds its engine; tests use their own in-memory engines
+os.environ.setdefault("DATABASE_URL", "sqlite://")
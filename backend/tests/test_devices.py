@@ -0,0 +1,108 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import devices
+from devices import CircuitBreaker, DeviceDispatcher
+
+BACKOFF = 0.05
+COOLDOWN = 0.5
+
+
+class FakeDevice(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((time.monotonic(), self.path, body))
+        status = self.server.statuses.popleft() if self.server.statuses else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def device():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDevice)
+    server.requests = []
+    server.statuses = deque()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def dispatcher(device, monkeypatch):
+    monkeypatch.setattr(devices, "DEVICE_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(devices, "DEVICE_BACKOFF_SECONDS", BACKOFF)
+    dispatcher = DeviceDispatcher(f"http://127.0.0.1:{device.server_address[1]}")
+    dispatcher.breaker = CircuitBreaker(threshold=3, cooldown=COOLDOWN)
+    return dispatcher
+
+
+def deliver(dispatcher, times=1):
+    async def run():
+        await dispatcher.start()
+        try:
+            for _ in range(times):
+                await dispatcher._deliver("volume", "/set-volume", {"volume": 40})
+        finally:
+            await dispatcher.stop()
+
+    asyncio.run(run())
+
+
+def test_retries_with_backoff_until_the_device_answers(device, dispatcher):
+    device.statuses.extend([500, 503])
+    deliver(dispatcher)
+
+    times = [at for at, _, _ in device.requests]
+    assert [(path, body) for _, path, body in device.requests] == [("/set-volume", {"volume": 40})] * 3
+    # Exponential backoff between attempts
+    assert times[1] - times[0] >= BACKOFF
+    assert times[2] - times[1] >= BACKOFF * 2
+    assert dispatcher.breaker.failures == 0
+    assert dispatcher.breaker.opened_at is None
+
+
+def test_breaker_opens_probes_once_and_closes(device, dispatcher):
+    breaker = dispatcher.breaker
+    device.statuses.extend([500] * 4)
+
+    # Three failed attempts reach the threshold; the 4 * BACKOFF wait after the last is skipped
+    deliver(dispatcher)
+    assert len(device.requests) == 3
+    assert time.monotonic() - device.requests[-1][0] < BACKOFF * 4
+    assert breaker.is_open
+
+    # Open: messages are turned away without reaching the device
+    deliver(dispatcher)
+    assert len(device.requests) == 3
+
+    # Half-open after the cooldown: one probe goes through, the rest wait for its outcome
+    time.sleep(COOLDOWN)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open
+
+    # A failed probe reopens the breaker for another cooldown
+    time.sleep(COOLDOWN)
+    deliver(dispatcher)
+    assert len(device.requests) == 4
+    assert breaker.is_open
+
+    # A successful probe closes it again
+    time.sleep(COOLDOWN)
+    deliver(dispatcher, times=2)
+    assert len(device.requests) == 6
+    assert breaker.opened_at is None
+    assert breaker.failures == 0
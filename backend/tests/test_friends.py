@@ -0,0 +1,32 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from database import Base
+from friends import add_friendship
+from models import Friendship, User
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all([
+            User(id=1, username="a", email="a@example.com", hashed_password="x"),
+            User(id=2, username="b", email="b@example.com", hashed_password="x"),
+        ])
+        session.commit()
+        yield session
+    engine.dispose()
+
+
+def test_accepting_both_directions_keeps_one_friendship(db):
+    # A->B and B->A were both pending; accepting each one records the same pair
+    add_friendship(db, 1, 2)
+    db.commit()
+    add_friendship(db, 2, 1)
+    db.commit()
+
+    assert sorted(db.query(Friendship.user_id, Friendship.friend_id).all()) == [(1, 2), (2, 1)]
@@ -0,0 +1,35 @@
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import telemetry
+from database import Base
+from models import GameEvent
+from telemetry import DatabaseSink, GameEventBuffer
+
+
+@pytest.fixture
+def session_factory(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(telemetry, "SessionLocal", factory)
+    yield factory
+    engine.dispose()
+
+
+def event(event_type, round_number):
+    return {"type": event_type, "user_id": 1, "round": round_number, "received_at": datetime.now(timezone.utc)}
+
+
+def test_bad_event_is_dropped_instead_of_blocking_the_buffer(session_factory):
+    buffer = GameEventBuffer(DatabaseSink(), interval_ms=0, batch_size=10, limit=100)
+    # type is NOT NULL, so the database rejects the whole batch
+    buffer.flush([event("round", 1), event(None, 2), event("game_over", 3)])
+
+    assert len(buffer) == 0
+    with session_factory() as db:
+        assert sorted(round_number for (round_number,) in db.query(GameEvent.round)) == [1, 3]
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from database import Base
+from friends import friend_cache
+from models import Friendship, Score, Sound, User
+from services import PROFILE_SCORES_LIMIT, build_user_profile, load_profile_user
+from sounds import sound_profile_cache
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(User(id=1, username="player", email="player@example.com", hashed_password="x"))
+        session.add(Sound(name="master"))
+        session.commit()
+        yield session
+    engine.dispose()
+
+
+def add_friends(db, count):
+    first_id = db.query(User).count() + 1
+    for friend_id in range(first_id, first_id + count):
+        db.add(User(id=friend_id, username=f"friend{friend_id}", email=f"friend{friend_id}@example.com", hashed_password="x"))
+        db.flush()
+        db.add_all([Friendship(user_id=1, friend_id=friend_id), Friendship(user_id=friend_id, friend_id=1)])
+    db.commit()
+
+
+def add_scores(db, count):
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    db.add_all(Score(user_id=1, score=i, timestamp=start + timedelta(minutes=i)) for i in range(count))
+    db.commit()
+
+
+def profile_queries(db, **kwargs):
+    # Cold caches, so every lookup the profile needs reaches the database
+    friend_cache.invalidate(1)
+    sound_profile_cache.invalidate(1)
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = db.get_bind()
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        profile = build_user_profile(db, load_profile_user(db, 1), **kwargs)
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    return len(statements), profile
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"include_private": True}, {"viewer_id": 2}])
+def test_full_profile_queries_do_not_grow_with_history(db, kwargs):
+    add_friends(db, 1)
+    add_scores(db, PROFILE_SCORES_LIMIT)
+    baseline, _ = profile_queries(db, **kwargs)
+
+    add_friends(db, 40)
+    add_scores(db, 500)
+    queries, profile = profile_queries(db, **kwargs)
+
+    assert queries == baseline
+    assert len(profile.friends) == 41
+    assert len(profile.scores) == PROFILE_SCORES_LIMIT
+
+
+def test_short_profile_queries_do_not_grow_with_history(db):
+    # Pages shorter than the limit also look for archived scores, at a fixed cost
+    add_friends(db, 1)
+    add_scores(db, 1)
+    baseline, _ = profile_queries(db, include_private=True)
+
+    add_friends(db, 20)
+    add_scores(db, PROFILE_SCORES_LIMIT - 2)
+    queries, profile = profile_queries(db, include_private=True)
+
+    assert queries == baseline
+    assert len(profile.scores) == PROFILE_SCORES_LIMIT - 1
@@ -0,0 +1,59 @@
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import scoring
+from database import Base
+from cache import friends_tag
+from friends import friend_cache
+from models import Friendship, Score, User
+from scoring import ScoreBuffer
+
+
+@pytest.fixture
+def session_factory(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+
+    @event.listens_for(engine, "connect")
+    def enable_foreign_keys(connection, _):
+        connection.execute("PRAGMA foreign_keys=ON")
+
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    with factory() as db:
+        db.add(User(id=1, username="player", email="player@example.com", hashed_password="x"))
+        db.commit()
+    monkeypatch.setattr(scoring, "SessionLocal", factory)
+    yield factory
+    engine.dispose()
+
+
+def test_bad_entry_is_dropped_instead_of_blocking_the_buffer(session_factory):
+    now = datetime.now(timezone.utc)
+    buffer = ScoreBuffer(interval_ms=0, batch_size=10, limit=100)
+    # User 999 doesn't exist, so the foreign key rejects the whole batch
+    buffer.flush([(1, 10, now), (999, 20, now), (1, 30, now)])
+
+    assert len(buffer) == 0
+    with session_factory() as db:
+        assert sorted(score for (score,) in db.query(Score.score)) == [10, 30]
+        assert db.get(User, 1).best_score == 30
+
+
+def test_new_best_score_invalidates_friends_views(session_factory, monkeypatch):
+    with session_factory() as db:
+        db.add(User(id=2, username="friend", email="friend@example.com", hashed_password="x"))
+        db.commit()
+        db.add_all([Friendship(user_id=1, friend_id=2), Friendship(user_id=2, friend_id=1)])
+        db.commit()
+    friend_cache.invalidate(1, 2)
+    invalidated = []
+    monkeypatch.setattr(scoring, "invalidate_tags", lambda tags: invalidated.extend(tags))
+
+    ScoreBuffer(interval_ms=0, batch_size=10, limit=100).flush([(1, 40, datetime.now(timezone.utc))])
+
+    # The friend's profile and friend list show user 1's best score
+    assert friends_tag(2) in invalidated
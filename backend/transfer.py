@@ -0,0 +1,217 @@
+import csv
+import io
+import json
+import os
+from collections import defaultdict
+from datetime import date, datetime
+from itertools import groupby, islice
+from typing import IO, Iterable, Iterator, NamedTuple, Tuple
+
+from sqlalchemy import Date, DateTime, Float, Integer, String, select, text
+from sqlalchemy.orm import Session
+
+from archive import archived_months, as_utc, chunks_statement, iter_archived_scores, month_start, read_month
+from database import SessionLocal, dialect_insert
+from models import Friendship, Score, User
+from read_models import dumps
+from scoring import update_best_scores
+from sounds import get_sound_profile
+from stats import get_user_stats
+
+# Rows per server-side cursor fetch, and per chunk of the streamed response
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 5000))
+# Rows per multi-row INSERT
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 1000))
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+class TransferTable(NamedTuple):
+    model: type
+    columns: Tuple[str, ...]
+    # Columns every imported row must have; users come with their password hash
+    required: Tuple[str, ...]
+
+
+TABLES = {
+    "users": TransferTable(
+        User,
+        ("id", "username", "email", "hashed_password", "best_score", "profile_picture_id"),
+        ("username", "email", "hashed_password"),
+    ),
+    "friendships": TransferTable(Friendship, ("user_id", "friend_id", "created_at"), ("user_id", "friend_id")),
+    "scores": TransferTable(Score, ("id", "user_id", "score", "timestamp"), ("user_id", "score", "timestamp")),
+}
+
+
+def batched(rows: Iterable, size: int) -> Iterator[list]:
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def export_batches(db: Session, table: str) -> Iterator[list]:
+    model, columns, _ = TABLES[table]
+    if model is Score:
+        # Archived months too, so the export holds every score ever recorded
+        yield from batched(iter_archived_scores(db), EXPORT_BATCH_SIZE)
+    statement = select(*(getattr(model, name) for name in columns)).order_by(*model.__table__.primary_key.columns)
+    # yield_per streams from a server-side cursor instead of loading the table
+    yield from db.execute(statement.execution_options(yield_per=EXPORT_BATCH_SIZE)).partitions()
+
+
+def encode_csv(rows) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        [value.isoformat() if isinstance(value, (date, datetime)) else value for value in row] for row in rows
+    )
+    return buffer.getvalue().encode()
+
+
+def encode_ndjson(columns, rows) -> bytes:
+    return b"".join(dumps(dict(zip(columns, row))) + b"\n" for row in rows)
+
+
+def stream_export(table: str, fmt: str) -> Iterator[bytes]:
+    """A whole table as NDJSON or CSV, one chunk per batch.
+
+    Opens its own session, since the response outlives the request's dependencies.
+    """
+    _, columns, _ = TABLES[table]
+    db = SessionLocal()
+    try:
+        if fmt == "csv":
+            yield encode_csv([columns])
+        for rows in export_batches(db, table):
+            yield encode_csv(rows) if fmt == "csv" else encode_ndjson(columns, rows)
+    finally:
+        db.close()
+
+
+def record(kind: str, **fields) -> bytes:
+    return dumps({"type": kind, **fields}) + b"\n"
+
+
+def stream_user_export(user_id: int) -> Iterator[bytes]:
+    """Everything stored about one user as NDJSON records tagged with a "type".
+
+    The profile, stats and sound settings come first, then friends, then every
+    score newest first, including archived months.
+    """
+    db = SessionLocal()
+    try:
+        user = db.execute(
+            select(User.id, User.username, User.email, User.best_score, User.profile_picture_id).where(User.id == user_id)
+        ).one_or_none()
+        if user is None:
+            return
+        yield record("profile", **user._asdict())
+        yield record("stats", **get_user_stats(db, user_id))
+        yield b"".join(
+            record("sound_setting", sound_id=sound_id, sound=name, volume=volume)
+            for sound_id, name, volume in get_sound_profile(db, user_id).settings
+        )
+
+        friends = db.execute(
+            select(User.id, User.username, Friendship.created_at)
+            .join(Friendship, Friendship.friend_id == User.id)
+            .where(Friendship.user_id == user_id)
+            .order_by(User.id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        for rows in friends.partitions():
+            yield b"".join(record("friend", id=row.id, username=row.username, since=row.created_at) for row in rows)
+
+        scores = db.execute(
+            select(Score.score, Score.timestamp)
+            .where(Score.user_id == user_id)
+            .order_by(Score.timestamp.desc(), Score.id.desc())
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        for rows in scores.partitions():
+            yield b"".join(record("score", score=row.score, timestamp=row.timestamp) for row in rows)
+        chunks = db.execute(chunks_statement(user_id)).all()
+        for _, month_chunks in groupby(chunks, key=lambda chunk: chunk.month):
+            yield b"".join(record("score", score=row.score, timestamp=row.timestamp) for row in read_month(month_chunks))
+    finally:
+        db.close()
+
+
+def parse_value(column, value):
+    # CSV gives strings for everything and NDJSON for timestamps; empty CSV cells are NULL
+    if not isinstance(value, str):
+        return value
+    if value == "" and column.nullable:
+        return None
+    if isinstance(column.type, String):
+        return value
+    if isinstance(column.type, DateTime):
+        return datetime.fromisoformat(value)
+    if isinstance(column.type, Date):
+        return date.fromisoformat(value)
+    if isinstance(column.type, Integer):
+        return int(value)
+    if isinstance(column.type, Float):
+        return float(value)
+    return value
+
+
+def parse_record(table: TransferTable, record: dict, line: int) -> dict:
+    columns = table.model.__table__.c
+    values = {}
+    for name in table.columns:
+        if record.get(name) is None:
+            continue
+        try:
+            values[name] = parse_value(columns[name], record[name])
+        except ValueError as e:
+            raise ValueError(f"Line {line}: invalid {name}: {e}")
+    missing = [name for name in table.required if values.get(name) is None]
+    if missing:
+        raise ValueError(f"Line {line}: missing {', '.join(missing)}")
+    return values
+
+
+def read_records(stream: IO[str], fmt: str) -> Iterator[dict]:
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def import_records(db: Session, table: str, records: Iterable[dict], batch_size: int = IMPORT_BATCH_SIZE) -> Tuple[int, int]:
+    """Insert rows with multi-row INSERT ... ON CONFLICT DO NOTHING, one commit per batch.
+
+    Rows that clash with existing keys or unique values are skipped, so a failed
+    import can be rerun. Scores are exported with the archived months included,
+    and those rows are no longer in the scores table to clash with, so scores in
+    a month the user already has in the archive are skipped as well. Returns
+    (rows read, rows inserted).
+    """
+    transfer = TABLES[table]
+    read = inserted = 0
+    for batch in batched(records, batch_size):
+        rows = [parse_record(transfer, item, read + i + 1) for i, item in enumerate(batch)]
+        if transfer.model is Score:
+            archived = archived_months(db, {row["user_id"] for row in rows})
+            rows = [row for row in rows if (row["user_id"], month_start(as_utc(row["timestamp"]).date())) not in archived]
+        # A multi-row VALUES needs the same keys in every row, so rows missing a column go
+        # in their own INSERT and get the column's default rather than an explicit NULL
+        by_keys = defaultdict(list)
+        for row in rows:
+            by_keys[tuple(row)].append(row)
+        for group in by_keys.values():
+            result = db.execute(dialect_insert(db, transfer.model).values(group).on_conflict_do_nothing())
+            inserted += result.rowcount
+        if transfer.model is Score and rows:
+            update_best_scores(db, [(row["user_id"], row["score"], row["timestamp"]) for row in rows])
+        db.commit()
+        read += len(batch)
+
+    if "id" in transfer.columns and db.get_bind().dialect.name == "postgresql":
+        # The rows brought their own ids; move the sequence past them
+        db.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), MAX(id)) FROM {table}"))
+        db.commit()
+    return read, inserted
@@ -13,6 +13,7 @@ export default function Friends() {
     const [userData, setUserData] = useState({ friends: [] });
     const [newFriendUsername, setNewFriendUsername] = useState('');
     const [requestStatus, setRequestStatus] = useState('');
+    const [suggestions, setSuggestions] = useState([]);
   
     const toggleTab = (tab) => {
       if (tab !== activeTab) setActiveTab(tab);
@@ -62,6 +63,36 @@ export default function Friends() {
     useEffect(() => {
       fetchUserData();
     }, []);
+
+    // Typeahead: search once the user pauses typing
+    useEffect(() => {
+      if (newFriendUsername.trim().length < 2) {
+        setSuggestions([]);
+        return;
+      }
+      const timer = setTimeout(async () => {
+        try {
+          const token = localStorage.getItem("token");
+          const response = await axios.get(`${process.env.REACT_APP_API_URL}/users/search`, {
+            params: { q: newFriendUsername, limit: 8 },
+            headers: {
+              Authorization: `Bearer ${token}`,
+            },
+          });
+          setSuggestions(response.data.results);
+        } catch (error) {
+          console.error('Failed to search users:', error);
+        }
+      }, 150);
+      return () => clearTimeout(timer);
+    }, [newFriendUsername]);
+
+    const statusLabels = {
+      self: 'You',
+      friend: 'Friends',
+      pending_sent: 'Request sent',
+      pending_received: 'Wants to be friends',
+    };
   
     return (
       <>
@@ -117,6 +148,32 @@ export default function Friends() {
                   onChange={(e) => setNewFriendUsername(e.target.value)}
                   className="mb-3"
                 />
+                {suggestions.length > 0 && (
+                  <ul className="list-group mb-3">
+                    {suggestions.map((suggestion) => (
+                      <li
+                        key={suggestion.id}
+                        className="list-group-item d-flex align-items-center"
+                        style={{ cursor: 'pointer' }}
+                        onClick={() => {
+                          setNewFriendUsername(suggestion.username);
+                          setSuggestions([]);
+                        }}
+                      >
+                        <img
+                          src={suggestion.profile_picture ? `${process.env.REACT_APP_API_URL}${suggestion.profile_picture}` : DEFAULT_PROFILE}
+                          className="rounded-circle me-2"
+                          style={{ width: '32px', height: '32px', objectFit: 'cover' }}
+                          alt="avatar"
+                        />
+                        <span className="flex-grow-1">{suggestion.username}</span>
+                        {statusLabels[suggestion.status] && (
+                          <small className="text-muted">{statusLabels[suggestion.status]}</small>
+                        )}
+                      </li>
+                    ))}
+                  </ul>
+                )}
                 <MDBBtn color="primary" onClick={handleAddFriend}>
                   <MDBIcon fas icon="user-plus" className="me-2" />
                   Send Request
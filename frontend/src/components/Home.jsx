@@ -10,6 +10,7 @@ import {
   MDBSpinner,
 } from "mdb-react-ui-kit";
 import { Link } from "react-router-dom";
+import { subscribeToEvents } from "../services/events";
 
 const DEFAULT_PROFILE = "https://cdn-icons-png.flaticon.com/512/149/149071.png";
 
@@ -42,6 +43,12 @@ export default function Home() {
       }
     };
     fetchLeaderboards();
+    // Only refetch when the all-time board actually changed
+    return subscribeToEvents((event) => {
+      if (event.type === "leaderboard" && event.boards.includes("all-time")) {
+        fetchLeaderboards();
+      }
+    });
   }, []);
 
   const crown = ["👑", "🥈", "🥉"];
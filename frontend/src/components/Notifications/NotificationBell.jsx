@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from "react";
 import { MDBBadge, MDBIcon } from "mdb-react-ui-kit";
+import { subscribeToEvents } from "../../services/events";
 
 const NotificationBell = () => {
   const [requestCount, setRequestCount] = useState(0);
@@ -7,7 +8,7 @@ const NotificationBell = () => {
   const fetchRequestCount = async () => {
     try {
       const token = localStorage.getItem("token");
-      const response = await fetch("http://localhost:8000/friend-requests/", {
+      const response = await fetch("http://localhost:8000/friend-requests/count", {
         method: "GET",
         headers: {
           "Content-Type": "application/json",
@@ -15,14 +16,20 @@ const NotificationBell = () => {
         },
       });
       const data = await response.json();
-      setRequestCount(data.received_requests.length);
+      setRequestCount(data.received);
     } catch (error) {
       console.error("Error fetching request count:", error);
     }
   };
 
   useEffect(() => {
+    // Load the count once, then let the server push changes instead of polling
     fetchRequestCount();
+    return subscribeToEvents((event) => {
+      if (event.pending) {
+        setRequestCount(event.pending.received);
+      }
+    });
   }, []);
 
   return (
@@ -5,78 +5,77 @@ import {
   MDBListGroupItem,
   MDBBtn,
 } from "mdb-react-ui-kit";
+import { subscribeToEvents } from "../../services/events";
 
 const Notifications = () => {
   const [friendRequests, setFriendRequests] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const token = localStorage.getItem("token");
 
-  useEffect(() => {
-    const fetchFriendRequests = async () => {
-      try {
-        const response = await fetch("http://localhost:8000/friend-requests/", {
-          headers: {
-            Authorization: `Bearer ${token}`,
-          },
-        });
-        if (!response.ok) {
-          throw new Error("Failed to fetch friend requests");
-        }
-        const data = await response.json();
-        setFriendRequests(data.received_requests);
-      } catch (error) {
-        console.error("Error fetching friend requests:", error);
-      }
-    };
-
-    fetchFriendRequests();
-  }, [token]);
-
-  const handleAccept = async (requestId) => {
+  // Loads the first page, or the page after `cursor` when one is given
+  const fetchFriendRequests = async (cursor = null) => {
     try {
-      const response = await fetch(
-        `http://localhost:8000/friend-requests/${requestId}/accept`,
-        {
-          method: "POST",
-          headers: {
-            Authorization: `Bearer ${token}`,
-          },
-        }
-      );
-      if (response.ok) {
-        setFriendRequests((prev) =>
-          prev.filter((request) => request.id !== requestId)
-        );
+      const params = new URLSearchParams({ direction: "received" });
+      if (cursor) params.set("cursor", cursor);
+      const response = await fetch(`http://localhost:8000/friend-requests/inbox?${params}`, {
+        headers: {
+          Authorization: `Bearer ${token}`,
+        },
+      });
+      if (!response.ok) {
+        throw new Error("Failed to fetch friend requests");
       }
+      const data = await response.json();
+      setFriendRequests((prev) => (cursor ? [...prev, ...data.requests] : data.requests));
+      setNextCursor(data.next_cursor);
     } catch (error) {
-      console.error("Error accepting friend request:", error);
+      console.error("Error fetching friend requests:", error);
     }
   };
 
-  const handleDelete = async (requestId) => {
+  useEffect(() => {
+    fetchFriendRequests();
+    return subscribeToEvents((event) => {
+      if (event.type === "friend_request_received") {
+        fetchFriendRequests();
+      }
+    });
+  }, [token]);
+
+  const resolveRequests = async (action, requestIds) => {
     try {
-      const response = await fetch(
-        `http://localhost:8000/friend-requests/${requestId}/delete`,
-        {
-          method: "DELETE",
-          headers: {
-            Authorization: `Bearer ${token}`,
-          },
-        }
-      );
+      const response = await fetch("http://localhost:8000/friend-requests/bulk", {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+          Authorization: `Bearer ${token}`,
+        },
+        body: JSON.stringify({ action, ids: requestIds }),
+      });
       if (response.ok) {
-        setFriendRequests((prev) =>
-          prev.filter((request) => request.id !== requestId)
-        );
+        const { processed, skipped } = await response.json();
+        const done = new Set([...processed, ...skipped]);
+        setFriendRequests((prev) => prev.filter((request) => !done.has(request.id)));
       }
-      window.location.reload();
     } catch (error) {
-      console.error("Error deleting friend request:", error);
+      console.error(`Error trying to ${action} friend requests:`, error);
     }
   };
 
+  const handleAccept = (requestId) => resolveRequests("accept", [requestId]);
+  const handleDelete = (requestId) => resolveRequests("deny", [requestId]);
+  const handleAcceptAll = () => resolveRequests("accept", friendRequests.map((request) => request.id));
+
   return (
     <MDBContainer className="py-5">
-      <h2>Friend Requsts</h2>
+      <div className="d-flex justify-content-between align-items-center">
+        <h2>Friend Requsts</h2>
+        {friendRequests.length > 1 && (
+          <MDBBtn color="success" size="sm" onClick={handleAcceptAll}>
+            Accept all
+          </MDBBtn>
+        )}
+      </div>
 
       <MDBListGroup>
         {friendRequests.length > 0 ? (
@@ -125,6 +124,11 @@ const Notifications = () => {
           <p>No friend requests at the moment.</p>
         )}
       </MDBListGroup>
+      {nextCursor && (
+        <MDBBtn color="light" className="mt-3" onClick={() => fetchFriendRequests(nextCursor)}>
+          Load more
+        </MDBBtn>
+      )}
     </MDBContainer>
   );
 };
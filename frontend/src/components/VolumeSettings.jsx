@@ -9,8 +9,12 @@ export default function VolumeSettings() {
 
   const handleSubmit = async () => {
     try {
+      // Signed-in users get the volume saved to their sound settings as well
+      const token = localStorage.getItem("token");
       const response = await axios.post('http://localhost:8000/set-volume/', {
         volume: volume,
+      }, {
+        headers: token ? { Authorization: `Bearer ${token}` } : {},
       });
   
       if (response.status === 200) {
@@ -0,0 +1,43 @@
+// One shared WebSocket to the backend push channel, reconnecting with backoff.
+// Components subscribe with a handler and get every event the server sends.
+
+const WS_URL = "ws://localhost:8000/ws";
+const MAX_RETRY_MS = 30000;
+
+const listeners = new Set();
+let socket = null;
+let retryMs = 1000;
+let retryTimer = null;
+
+const connect = () => {
+  const token = localStorage.getItem("token");
+  if (!token || socket) return;
+
+  socket = new WebSocket(`${WS_URL}?token=${encodeURIComponent(token)}`);
+  socket.onopen = () => {
+    retryMs = 1000;
+  };
+  socket.onmessage = (message) => {
+    const event = JSON.parse(message.data);
+    listeners.forEach((listener) => listener(event));
+  };
+  socket.onclose = (close) => {
+    socket = null;
+    // 1008 means the token was rejected; wait for a new login instead of retrying
+    if (close.code === 1008 || listeners.size === 0) return;
+    retryTimer = setTimeout(connect, retryMs);
+    retryMs = Math.min(retryMs * 2, MAX_RETRY_MS);
+  };
+};
+
+export const subscribeToEvents = (listener) => {
+  listeners.add(listener);
+  connect();
+  return () => {
+    listeners.delete(listener);
+    if (listeners.size === 0) {
+      clearTimeout(retryTimer);
+      if (socket) socket.close();
+    }
+  };
+};